@@ -13,6 +13,24 @@ PROJECT_NAME = os.getenv('PROJECT_NAME', 'movies')
 REDIS_HOST = os.getenv('REDIS_HOST', '127.0.0.1')
 REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
 
+# Кэш в памяти процесса (L1) перед Redis: число записей и время жизни (с)
+CACHE_L1_MAX_SIZE = int(os.getenv('CACHE_L1_MAX_SIZE', 10000))
+CACHE_L1_TTL = float(os.getenv('CACHE_L1_TTL', 30))
+# Блокировка в Redis на время запроса к Elasticsearch при промахе (с), 0 - только внутри процесса;
+# сколько другие процессы ждут её результат (с)
+CACHE_LOCK_TTL = float(os.getenv('CACHE_LOCK_TTL', 0))
+CACHE_LOCK_WAIT = float(os.getenv('CACHE_LOCK_WAIT', 2))
+# Сколько после срока записи (с) отдавать её устаревшей, обновляя в фоне;
+# размытие срока (доля) и коэффициент раннего обновления, 0 - без него
+CACHE_STALE_TTL = float(os.getenv('CACHE_STALE_TTL', 60))
+CACHE_TTL_JITTER = float(os.getenv('CACHE_TTL_JITTER', 0.1))
+CACHE_EARLY_REFRESH_BETA = float(os.getenv('CACHE_EARLY_REFRESH_BETA', 1))
+# Отрицательные записи (нет фильма, пустой поиск): время жизни (с) и число записей в памяти процесса
+CACHE_NEGATIVE_TTL = float(os.getenv('CACHE_NEGATIVE_TTL', 30))
+CACHE_NEGATIVE_MAX_SIZE = int(os.getenv('CACHE_NEGATIVE_MAX_SIZE', 1000))
+# Служебная статистика кэша по /api/cache/stats: только для внутренней сети, по умолчанию выключена
+CACHE_STATS_ENABLED = os.getenv('CACHE_STATS_ENABLED', 'False') == 'True'
+
 # Настройки Elasticsearch
 ELASTIC_HOST = os.getenv('ELASTIC_HOST', '127.0.0.1')
 ELASTIC_PORT = int(os.getenv('ELASTIC_PORT', 9200))
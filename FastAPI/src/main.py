@@ -5,9 +5,10 @@ from redis.asyncio import Redis
 from dotenv import load_dotenv
 load_dotenv() # load before config file!
 
-from db import elastic, redis
+from db import cache, elastic, redis
 from core import config
 from api.v1 import films, genres, persons
+from services.cache import LocalCache, TwoTierCache
 
 
 app = FastAPI(
@@ -23,6 +24,12 @@ app = FastAPI(
 @app.on_event('startup')
 async def startup():
     redis.redis = Redis(host=config.REDIS_HOST, port=config.REDIS_PORT)
+    cache.cache = TwoTierCache(redis.redis, LocalCache(config.CACHE_L1_MAX_SIZE, config.CACHE_L1_TTL),
+                               lock_ttl=config.CACHE_LOCK_TTL, lock_wait=config.CACHE_LOCK_WAIT,
+                               stale_ttl=config.CACHE_STALE_TTL, ttl_jitter=config.CACHE_TTL_JITTER,
+                               early_refresh_beta=config.CACHE_EARLY_REFRESH_BETA,
+                               negatives=LocalCache(config.CACHE_NEGATIVE_MAX_SIZE, config.CACHE_NEGATIVE_TTL),
+                               negative_ttl=config.CACHE_NEGATIVE_TTL)
     elastic.es = AsyncElasticsearch(
         hosts=[f'http://{config.ELASTIC_HOST}:{config.ELASTIC_PORT}'])
 
@@ -32,6 +39,12 @@ async def shutdown():
     await redis.redis.close()
     await elastic.es.close()
 
+if config.CACHE_STATS_ENABLED:
+    @app.get('/api/cache/stats', include_in_schema=False)
+    async def cache_stats() -> dict:
+        # попадания по уровням кэша в этом процессе
+        return cache.cache.get_stats()
+
 # Подключаем роутер к серверу, указав префикс
 app.include_router(films.router, prefix='/api/v1')
 app.include_router(persons.router, prefix='/api/v1')
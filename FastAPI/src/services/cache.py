@@ -0,0 +1,411 @@
+import asyncio
+import functools
+import logging
+import math
+import random
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from redis.asyncio import Redis
+
+from .common import NOT_FOUND, Cache
+
+logger = logging.getLogger(__name__)
+
+# Нет значения в кэше (None - тоже значение)
+MISSING = object()
+
+# Значение отрицательной записи в Redis: у источника нет данных по ключу
+NEGATIVE_VALUE = b'\x00not-found'
+
+# Снять блокировку, только если она всё ещё наша
+RELEASE_LOCK_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+'''
+
+SKETCH_DEPTH = 4
+SKETCH_SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0x27D4EB2F165667C5)
+MAX_FREQUENCY = 15
+
+
+class FrequencySketch:
+    """Приблизительные частоты обращений к ключам (count-min sketch, как в TinyLFU).
+
+    4-битные счётчики; после 10 * capacity обращений все счётчики делятся
+    пополам, чтобы старые популярные ключи со временем уступали новым.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        width = 1 << max(4, (4 * capacity - 1).bit_length())
+        self.mask = width - 1
+        self.rows = [bytearray(width) for _ in range(SKETCH_DEPTH)]
+        self.sample_size = 10 * capacity
+        self.additions = 0
+
+    def _indexes(self, key: str):
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        return [((h * seed) >> 32) & self.mask for seed in SKETCH_SEEDS]
+
+    def increment(self, key: str) -> None:
+        added = False
+        for row, i in zip(self.rows, self._indexes(key)):
+            if row[i] < MAX_FREQUENCY:
+                row[i] += 1
+                added = True
+        if added:
+            self.additions += 1
+            if self.additions >= self.sample_size:
+                self._age()
+
+    def frequency(self, key: str) -> int:
+        return min(row[i] for row, i in zip(self.rows, self._indexes(key)))
+
+    def _age(self) -> None:
+        self.rows = [bytearray(value >> 1 for value in row) for row in self.rows]
+        self.additions //= 2
+
+
+class LocalCache:
+    """Кэш в памяти процесса (L1): ограничение размера, TTL и частотный допуск (TinyLFU).
+
+    Вытесняется самый давно использованный ключ, но новый ключ при полном
+    кэше занимает его место, только если запрашивался не реже: разовые запросы
+    (перебор страниц, сканеры) не выталкивают горячие фильмы.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 30) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sketch = FrequencySketch(max_size)
+        self._data: 'OrderedDict[str, Tuple[float, Any]]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str) -> Any:
+        """Значение или MISSING."""
+        self.sketch.increment(key)
+        item = self._data.get(key)
+        if item is None:
+            return MISSING
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return MISSING
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        """Положить значение; False - ключ не допущен в полный кэш."""
+        now = time.monotonic()
+        expires_at = now + (self.ttl if ttl is None else min(ttl, self.ttl))
+        if key in self._data:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            return True
+        if len(self._data) >= self.max_size:
+            victim, (victim_expires_at, _) = next(iter(self._data.items()))
+            if victim_expires_at > now and self.sketch.frequency(key) < self.sketch.frequency(victim):
+                return False
+            del self._data[victim]
+        self._data[key] = (expires_at, value)
+        return True
+
+    def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+
+class TierStats:
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def dict(self) -> Dict[str, Any]:
+        return {'hits': self.hits, 'misses': self.misses, 'hit_ratio': round(self.hit_ratio, 4)}
+
+
+class TwoTierCache(Cache):
+    """Двухуровневый кэш: L1 в памяти процесса перед общим L2 в Redis.
+
+    В L1 лежат уже разобранные объекты (модели pydantic): попадание в L1
+    не требует ни запроса к Redis, ни разбора JSON. В L2 - сериализованные
+    значения, общие для всех процессов.
+
+    Промахи по одному ключу объединяются (single flight): в процессе идёт
+    один запрос к источнику, остальные ждут его результат. С lock_ttl > 0
+    то же между процессами: запрос делает процесс, взявший блокировку
+    в Redis, остальные до lock_wait секунд ждут значение в L2.
+
+    Записи устаревают мягко (stale-while-revalidate): ключ живёт в Redis
+    ex + stale_ttl секунд, и последние stale_ttl секунд get() отдаёт старое
+    значение, обновляя его в фоне через refresh(). Срок ex размывается на
+    ±ttl_jitter, а до мягкого срока запись обновляется заранее с вероятностью,
+    растущей к концу срока (XFetch, коэффициент early_refresh_beta), -
+    записи, сделанные вместе, не истекают одновременно.
+
+    Отрицательные записи (set_negative: фильма нет, поиск пуст) живут
+    negative_ttl секунд без мягкого срока, а в памяти процесса - в отдельном
+    L1 negatives, чтобы перебор несуществующих id не вытеснял горячие ключи.
+    get() возвращает для них NOT_FOUND, а не None (промах).
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        local: LocalCache,
+        lock_ttl: float = 0,
+        lock_wait: float = 2.0,
+        lock_poll: float = 0.05,
+        stale_ttl: float = 0,
+        ttl_jitter: float = 0,
+        early_refresh_beta: float = 0,
+        negatives: Optional[LocalCache] = None,
+        negative_ttl: float = 30,
+    ) -> None:
+        self.redis = redis
+        self.local = local
+        self.negatives = negatives if negatives is not None else LocalCache(1000, negative_ttl)
+        self.negative_ttl = negative_ttl
+        self.lock_ttl = lock_ttl
+        self.lock_wait = lock_wait
+        self.lock_poll = lock_poll
+        self.stale_ttl = stale_ttl
+        self.ttl_jitter = ttl_jitter
+        self.early_refresh_beta = early_refresh_beta
+        self.stats = {'l1': TierStats(), 'l2': TierStats()}
+        self.coalesced = 0
+        self.lock_waits = 0
+        self.stale_hits = 0
+        self.early_refreshes = 0
+        self.refresh_errors = 0
+        self.negative_hits = 0
+        # среднее время запроса к источнику (с) для раннего обновления
+        self.fetch_time = 0.0
+        self._flights: Dict[str, asyncio.Future] = {}
+
+    async def get(
+        self,
+        key: str,
+        loads: Optional[Callable[[bytes], Any]] = None,
+        refresh: Optional[Callable[[], Awaitable[Any]]] = None,
+    ) -> Optional[Any]:
+        """Значение ключа, NOT_FOUND для отрицательной записи или None (промах).
+
+        loads разбирает значение из Redis перед записью в L1.
+
+        refresh() перезаписывает ключ из источника: вызывается в фоне,
+        если значение устарело или выпало раннее обновление.
+        """
+        value = self._get_local(key)
+        if value is not MISSING:
+            return value
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get(key)
+            pipe.pttl(key)
+            raw, pttl = await pipe.execute()
+        return self._from_remote(key, raw, pttl, loads, refresh)
+
+    async def set(self, key: str, value: Any, ex: int, dumps: Optional[Callable[[Any], str]] = None):
+        """Записать в оба уровня; dumps сериализует значение для Redis.
+
+        ex - мягкий срок, размытый на ttl_jitter; в Redis ключ живёт ещё stale_ttl.
+        """
+        ex = self._jittered(ex)
+        self.negatives.delete(key)
+        self.local.set(key, value, ex)
+        await self.redis.set(key, dumps(value) if dumps else value, px=int((ex + self.stale_ttl) * 1000))
+
+    async def get_many(
+        self,
+        keys: List[str],
+        loads: Optional[Callable[[bytes], Any]] = None,
+        refresh: Optional[Callable[[str], Awaitable[Any]]] = None,
+    ) -> List[Optional[Any]]:
+        """Значения ключей (NOT_FOUND, None) в том же порядке: из L1, остальные - одним конвейером.
+
+        Устаревшие значения обрабатываются как в get(): refresh(key) обновляет ключ в фоне.
+        """
+        values: List[Optional[Any]] = []
+        remote = []
+        for i, key in enumerate(keys):
+            value = self._get_local(key)
+            if value is MISSING:
+                remote.append(i)
+                value = None
+            values.append(value)
+        if not remote:
+            return values
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for i in remote:
+                pipe.get(keys[i])
+                pipe.pttl(keys[i])
+            replies = await pipe.execute()
+        for i, raw, pttl in zip(remote, replies[::2], replies[1::2]):
+            key_refresh = functools.partial(refresh, keys[i]) if refresh else None
+            values[i] = self._from_remote(keys[i], raw, pttl, loads, key_refresh)
+        return values
+
+    async def set_many(self, items: Dict[str, Any], ex: int, dumps: Optional[Callable[[Any], str]] = None):
+        """Записать несколько ключей в оба уровня, в Redis - одним конвейером."""
+        if not items:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key, value in items.items():
+                key_ex = self._jittered(ex)
+                self.negatives.delete(key)
+                self.local.set(key, value, key_ex)
+                pipe.set(key, dumps(value) if dumps else value, px=int((key_ex + self.stale_ttl) * 1000))
+            await pipe.execute()
+
+    def _from_remote(self, key: str, raw: Optional[bytes], pttl: int,
+                     loads: Optional[Callable[[bytes], Any]],
+                     refresh: Optional[Callable[[], Awaitable[Any]]]) -> Optional[Any]:
+        """Значение из ответа Redis (GET и PTTL): запись в L1, фоновое обновление устаревшего."""
+        if raw is None:
+            self.stats['l2'].misses += 1
+            return None
+        self.stats['l2'].hits += 1
+        if raw == NEGATIVE_VALUE:
+            self.negative_hits += 1
+            self.negatives.set(key, NOT_FOUND, pttl / 1000 if pttl > 0 else None)
+            return NOT_FOUND
+        value = loads(raw) if loads else raw
+
+        # до мягкого срока осталось; у ключа без срока (pttl = -1) - бесконечно
+        fresh_for = pttl / 1000 - self.stale_ttl if pttl >= 0 else math.inf
+        if fresh_for <= 0:
+            self.stale_hits += 1
+            if refresh:
+                self._refresh(key, refresh, loads)
+            return value
+        if refresh and self._refresh_early(fresh_for):
+            self.early_refreshes += 1
+            self._refresh(key, refresh, loads)
+        self.local.set(key, value, fresh_for)
+        return value
+
+    def _get_local(self, key: str) -> Any:
+        """Значение или NOT_FOUND из L1, иначе MISSING; считает попадания."""
+        value = self.local.get(key)
+        if value is MISSING:
+            value = self.negatives.get(key)
+        if value is MISSING:
+            self.stats['l1'].misses += 1
+            return MISSING
+        self.stats['l1'].hits += 1
+        if value is NOT_FOUND:
+            self.negative_hits += 1
+        return value
+
+    def _jittered(self, ex: float) -> float:
+        if not self.ttl_jitter:
+            return ex
+        return ex * random.uniform(1 - self.ttl_jitter, 1 + self.ttl_jitter)
+
+    async def set_negative(self, key: str):
+        """Запомнить на negative_ttl, что у источника нет данных по ключу."""
+        self.local.delete(key)
+        self.negatives.set(key, NOT_FOUND)
+        await self.redis.set(key, NEGATIVE_VALUE, px=int(self.negative_ttl * 1000))
+
+    def _refresh_early(self, fresh_for: float) -> bool:
+        # XFetch: -fetch_time * beta * ln(rand) >= fresh_for, тем вероятнее, чем меньше осталось
+        if not self.early_refresh_beta or not self.fetch_time:
+            return False
+        return -self.fetch_time * self.early_refresh_beta * math.log(1 - random.random()) >= fresh_for
+
+    def _refresh(self, key: str, refresh: Callable[[], Awaitable[Any]],
+                 loads: Optional[Callable[[bytes], Any]]) -> None:
+        """Обновить ключ в фоне, если его ещё не загружают."""
+        if key in self._flights:
+            return
+        flight = asyncio.ensure_future(self.coalesce(key, refresh, loads))
+        flight.add_done_callback(self._refresh_done)
+
+    def _refresh_done(self, flight: asyncio.Future) -> None:
+        if flight.cancelled():
+            return
+        error = flight.exception()
+        if error is not None:
+            self.refresh_errors += 1
+            logger.warning('Background cache refresh failed: %r', error)
+
+    async def coalesce(self, key: str, fetch: Callable[[], Awaitable[Any]],
+                       loads: Optional[Callable[[bytes], Any]] = None) -> Any:
+        """Результат fetch() для промаха по key, один на все одновременные промахи процесса."""
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+        else:
+            # задача, а не корутина запроса: отмена первого запроса не отменяет ожидающих
+            flight = asyncio.ensure_future(self._fetch_locked(key, fetch, loads))
+            self._flights[key] = flight
+            flight.add_done_callback(lambda _: self._flights.pop(key, None))
+        return await asyncio.shield(flight)
+
+    async def _fetch_locked(self, key: str, fetch: Callable[[], Awaitable[Any]],
+                            loads: Optional[Callable[[bytes], Any]]) -> Any:
+        if not self.lock_ttl:
+            return await self._timed(fetch)
+        lock_key = f"lock:{key}"
+        token = uuid.uuid4().hex
+        if await self.redis.set(lock_key, token, nx=True, px=int(self.lock_ttl * 1000)):
+            try:
+                return await self._timed(fetch)
+            finally:
+                await self.redis.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+
+        # другой процесс уже запрашивает источник: ждём его результат в Redis
+        # (устаревшее значение, которое он сейчас обновляет, не подходит)
+        self.lock_waits += 1
+        deadline = time.monotonic() + self.lock_wait
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.lock_poll)
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.get(key)
+                pipe.pttl(key)
+                pipe.exists(lock_key)
+                raw, pttl, locked = await pipe.execute()
+            if raw == NEGATIVE_VALUE:
+                return NOT_FOUND
+            fresh_for = pttl / 1000 - self.stale_ttl if pttl >= 0 else math.inf
+            if raw is not None and fresh_for > 0:
+                value = loads(raw) if loads else raw
+                self.local.set(key, value, fresh_for)
+                return value
+            if not locked:
+                break
+        return await self._timed(fetch)
+
+    async def _timed(self, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        started = time.monotonic()
+        value = await fetch()
+        self.fetch_time += 0.1 * (time.monotonic() - started - self.fetch_time)
+        return value
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Доля попаданий по уровням, размер L1, объединённые промахи и фоновые обновления."""
+        return {
+            'l1': dict(self.stats['l1'].dict(), size=len(self.local), max_size=self.local.max_size,
+                       negative_size=len(self.negatives), negative_max_size=self.negatives.max_size),
+            'l2': self.stats['l2'].dict(),
+            'coalesced': self.coalesced,
+            'lock_waits': self.lock_waits,
+            'stale_hits': self.stale_hits,
+            'early_refreshes': self.early_refreshes,
+            'refresh_errors': self.refresh_errors,
+            'negative_hits': self.negative_hits,
+            'fetch_time': round(self.fetch_time, 4),
+        }
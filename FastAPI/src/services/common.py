@@ -1,6 +1,6 @@
 import json
 from abc import ABC, abstractmethod
-from typing import Optional, List, Any
+from typing import Optional, List, Any, Awaitable, Callable, Dict
 
 from elasticsearch import AsyncElasticsearch, NotFoundError
 from pydantic import BaseModel
@@ -8,6 +8,9 @@ from redis.asyncio import Redis
 
 FILM_CACHE_EXPIRE_IN_SECONDS = 60 * 5  # 5 минут
 
+# Отрицательная запись кэша: у источника нет данных по ключу (в отличие от промаха - None)
+NOT_FOUND = object()
+
 
 class AsyncSearchEngine(ABC):
     @abstractmethod
@@ -21,13 +24,38 @@ class AsyncSearchEngine(ABC):
 
 class Cache(ABC):
     @abstractmethod
-    async def get(self, key: str) -> Optional[Any]:
+    async def get(self, key: str, loads: Optional[Callable[[bytes], Any]] = None,
+                  refresh: Optional[Callable[[], Awaitable[Any]]] = None) -> Optional[Any]:
+        """Значение, NOT_FOUND или None; refresh() реализация может вызвать в фоне для устаревшего значения."""
         pass
 
     @abstractmethod
-    async def set(self, key: str, value: str):
+    async def set(self, key: str, value: Any, ex: int, dumps: Optional[Callable[[Any], str]] = None):
+        pass
+
+    async def set_negative(self, key: str):
+        """Запомнить, что данных по ключу нет; реализация может не поддерживать."""
         pass
 
+    async def get_many(self, keys: List[str], loads: Optional[Callable[[bytes], Any]] = None,
+                       refresh: Optional[Callable[[str], Awaitable[Any]]] = None) -> List[Optional[Any]]:
+        """Значения ключей (NOT_FOUND, None) в том же порядке; реализация может читать за один запрос.
+
+        refresh(key) - как refresh() в get(), для каждого ключа.
+        """
+        return [await self.get(key, loads=loads, refresh=(lambda key=key: refresh(key)) if refresh else None)
+                for key in keys]
+
+    async def set_many(self, items: Dict[str, Any], ex: int, dumps: Optional[Callable[[Any], str]] = None):
+        """Записать несколько ключей; реализация может писать за один запрос."""
+        for key, value in items.items():
+            await self.set(key, value, ex, dumps=dumps)
+
+    async def coalesce(self, key: str, fetch: Callable[[], Awaitable[Any]],
+                       loads: Optional[Callable[[bytes], Any]] = None) -> Any:
+        """Загрузить значение при промахе; реализация может объединять одновременные промахи."""
+        return await fetch()
+
 
 class ElasticAsyncSearchEngine(AsyncSearchEngine):
 
@@ -41,6 +69,11 @@ class ElasticAsyncSearchEngine(AsyncSearchEngine):
             return None
         return doc['_source']
 
+    async def get_by_ids(self, entity_ids: List[str]) -> List[dict]:
+        """Документы по списку id одним запросом; ненайденные пропускаются."""
+        docs = await self.search_engine.mget(index=self.index, ids=entity_ids)
+        return [doc['_source'] for doc in docs['docs'] if doc.get('found')]
+
     async def search(
         self,
         filter_by: Optional[str],
@@ -86,22 +119,34 @@ class CommonService(ElasticAsyncSearchEngine):
     async def get_by_id(self, entity_id: str) -> Optional[BaseModel]:
         entity = await self._entity_from_cache(entity_id)
         if not entity:
-            dct = await super().get_by_id(entity_id)
-            if not dct:
-                return None
-            entity = self.model(**dct)
-            await self._put_entity_to_cache(entity)
+            # одновременные промахи по ключу ждут один запрос к search_engine
+            entity = await self.cache.coalesce(f"{self.index}:{entity_id}",
+                                               lambda: self._entity_from_search_engine(entity_id),
+                                               loads=self.model.parse_raw)
+
+        return None if entity is NOT_FOUND else entity
 
+    async def _entity_from_search_engine(self, entity_id: str) -> Optional[BaseModel]:
+        dct = await super().get_by_id(entity_id)
+        if not dct:
+            await self.cache.set_negative(f"{self.index}:{entity_id}")
+            return None
+        entity = self.model(**dct)
+        await self._put_entity_to_cache(entity)
         return entity
 
     async def _entity_from_cache(self, entity_id: str) -> Optional[BaseModel]:
         cache_key = f"{self.index}:{entity_id}"
-        cached_data = await self.cache.get(cache_key)
-        lst = self.model.parse_raw(cached_data) if cached_data else None
-        return lst
+        return await self.cache.get(cache_key, loads=self.model.parse_raw,
+                                    refresh=lambda: self._entity_from_search_engine(entity_id))
 
     async def _put_entity_to_cache(self, entity: BaseModel):
-        await self.cache.set(f"{self.index}:{entity.id}", entity.json(), FILM_CACHE_EXPIRE_IN_SECONDS)
+        await self.cache.set(f"{self.index}:{entity.id}", entity, ex=FILM_CACHE_EXPIRE_IN_SECONDS,
+                             dumps=lambda entity: entity.json())
+
+    async def _put_entities_to_cache(self, entities: List[BaseModel]):
+        await self.cache.set_many({f"{self.index}:{entity.id}": entity for entity in entities},
+                                  ex=FILM_CACHE_EXPIRE_IN_SECONDS, dumps=lambda entity: entity.json())
 
     async def get_list(
         self,
@@ -112,27 +157,59 @@ class CommonService(ElasticAsyncSearchEngine):
         sort_by: Optional[str] = None
     ) -> List[BaseModel]:
 
-        # check cache
-        cache_key = f"{self.index}:{filter_by}:{query}:{page}:{per_page}:{sort_by}"
+        # check cache: в ключе списка только id, тела - в ключах сущностей
+        cache_key = f"{self.index}:ids:{filter_by}:{query}:{page}:{per_page}:{sort_by}"
 
-        lst = await self._list_from_cache(cache_key)
-        if lst:
-            return lst
+        def fetch():
+            return self._ids_from_search_engine(cache_key, filter_by, query, page, per_page, sort_by)
 
-        # go to search_engine
+        ids = await self.cache.get(cache_key, loads=json.loads, refresh=fetch)
+        if ids is None:
+            # go to search_engine: одновременные промахи по ключу ждут один запрос
+            ids = await self.cache.coalesce(cache_key, fetch, loads=json.loads)
+        if ids is NOT_FOUND:
+            return []
+        return await self._entities_by_ids(ids)
+
+    async def _ids_from_search_engine(
+        self,
+        cache_key: str,
+        filter_by: Optional[str],
+        query: Optional[str],
+        page: int,
+        per_page: int,
+        sort_by: Optional[str]
+    ) -> List[str]:
         lste = await self.search(filter_by=filter_by, query=query,
                                  page=page, per_page=per_page, sort_by=sort_by)
         lst = [self.model(**item) for item in lste]
 
-        # Сохраняем результаты в кэш
-        await self.cache.set(cache_key, json.dumps([row.dict() for row in lst]), ex=FILM_CACHE_EXPIRE_IN_SECONDS)
-
-        return lst
-
-    async def _list_from_cache(self, cache_key) -> List[dict]:
-        cached_data = await self.cache.get(cache_key)
-        print(94, cached_data)
-        lst = [self.model(**row) for row in json.loads(cached_data)
-               ] if cached_data and not cached_data == b'[]' else None
-        # lst = self.model.parse_raw(cached_data) if cached_data and not cached_data==b'[]' else None
-        return lst
+        # Сохраняем результаты в кэш; пустой результат - отрицательной записью
+        if not lst:
+            await self.cache.set_negative(cache_key)
+            return []
+        await self._put_entities_to_cache(lst)
+        ids = [entity.id for entity in lst]
+        await self.cache.set(cache_key, ids, ex=FILM_CACHE_EXPIRE_IN_SECONDS, dumps=json.dumps)
+
+        return ids
+
+    async def _entities_by_ids(self, ids: List[str]) -> List[BaseModel]:
+        """Сущности по id в том же порядке: из кэша, недостающие - из search_engine с записью в кэш.
+
+        Сущности, которых больше нет (отрицательная запись или нет в индексе), пропускаются.
+        """
+        keys = [f"{self.index}:{entity_id}" for entity_id in ids]
+        key_ids = dict(zip(keys, ids))
+        cached = await self.cache.get_many(keys, loads=self.model.parse_raw,
+                                           refresh=lambda key: self._entity_from_search_engine(key_ids[key]))
+        entities = dict(zip(ids, cached))
+        missing = [entity_id for entity_id, entity in entities.items() if entity is None]
+        if missing:
+            found = [self.model(**dct) for dct in await self.get_by_ids(missing)]
+            await self._put_entities_to_cache(found)
+            entities.update((entity.id, entity) for entity in found)
+            for entity_id in set(missing) - {entity.id for entity in found}:
+                await self.cache.set_negative(f"{self.index}:{entity_id}")
+        return [entities[entity_id] for entity_id in ids
+                if entities[entity_id] is not None and entities[entity_id] is not NOT_FOUND]
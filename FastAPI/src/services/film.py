@@ -2,14 +2,13 @@ from functools import lru_cache
 from typing import List
 
 from fastapi import Depends
-from redis.asyncio import Redis
 from elasticsearch import AsyncElasticsearch
 
 from models.film import Film
-from .common import CommonService
+from .common import Cache, CommonService
 
 from db.elastic import get_elastic
-from db.redis import get_redis
+from db.cache import get_cache
 
 
 class FilmService(CommonService):
@@ -28,7 +27,7 @@ class FilmService(CommonService):
 
 @lru_cache()
 def get_film_service(
-        cache: Redis = Depends(get_redis),
+        cache: Cache = Depends(get_cache),
         search_engine: AsyncElasticsearch = Depends(get_elastic),
 ) -> FilmService:
     return FilmService(cache, search_engine)
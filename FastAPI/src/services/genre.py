@@ -1,14 +1,13 @@
 from functools import lru_cache
 
 from fastapi import Depends
-from redis.asyncio import Redis
 from elasticsearch import AsyncElasticsearch
 
 from models.genre import Genre
-from .common import CommonService
+from .common import Cache, CommonService
 
 from db.elastic import get_elastic
-from db.redis import get_redis
+from db.cache import get_cache
 
 
 class GenreService(CommonService):
@@ -18,7 +17,7 @@ class GenreService(CommonService):
 
 @lru_cache()
 def get_genre_service(
-        cache: Redis = Depends(get_redis),
+        cache: Cache = Depends(get_cache),
         search_engine: AsyncElasticsearch = Depends(get_elastic),
 ) -> GenreService:
     return GenreService(cache, search_engine)
@@ -1,14 +1,13 @@
 from functools import lru_cache
 
 from fastapi import Depends
-from redis.asyncio import Redis
 from elasticsearch import AsyncElasticsearch
 
 from models.person import Person
-from .common import CommonService
+from .common import Cache, CommonService
 
 from db.elastic import get_elastic
-from db.redis import get_redis
+from db.cache import get_cache
 
 
 class PersonService(CommonService):
@@ -18,7 +17,7 @@ class PersonService(CommonService):
 
 @lru_cache()
 def get_person_service(
-        cache: Redis = Depends(get_redis),
+        cache: Cache = Depends(get_cache),
         search_engine: AsyncElasticsearch = Depends(get_elastic),
 ) -> PersonService:
     return PersonService(cache, search_engine)
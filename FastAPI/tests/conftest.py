@@ -0,0 +1,115 @@
+import asyncio
+import os
+import sys
+import time
+
+from elasticsearch import NotFoundError
+
+# модули сервиса импортируются так же, как в контейнере: из src
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+
+class FakeRedis:
+    """Redis в памяти: команды, которые использует TwoTierCache."""
+
+    def __init__(self):
+        # ключ -> (значение, момент истечения по time.monotonic() или None)
+        self.data = {}
+
+    def _alive(self, key):
+        item = self.data.get(key)
+        if item is None:
+            return None
+        if item[1] is not None and item[1] <= time.monotonic():
+            del self.data[key]
+            return None
+        return item
+
+    def expire_in(self, key, seconds):
+        """Сдвинуть срок ключа, не дожидаясь его в тесте."""
+        self.data[key] = (self.data[key][0], time.monotonic() + seconds)
+
+    async def get(self, key):
+        item = self._alive(key)
+        return item[0] if item else None
+
+    async def set(self, key, value, ex=None, px=None, nx=False):
+        if nx and self._alive(key):
+            return None
+        ttl = ex if ex is not None else (px / 1000 if px is not None else None)
+        value = value.encode() if isinstance(value, str) else value
+        self.data[key] = (value, time.monotonic() + ttl if ttl is not None else None)
+        return True
+
+    async def pttl(self, key):
+        item = self._alive(key)
+        if item is None:
+            return -2
+        if item[1] is None:
+            return -1
+        return int((item[1] - time.monotonic()) * 1000)
+
+    async def exists(self, key):
+        return int(self._alive(key) is not None)
+
+    async def mget(self, keys):
+        return [await self.get(key) for key in keys]
+
+    async def eval(self, script, numkeys, key, token):
+        if await self.get(key) == token.encode():
+            del self.data[key]
+            return 1
+        return 0
+
+    def pipeline(self, transaction=False):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return command
+
+    async def execute(self):
+        return [await getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+def make_film(film_id):
+    return {'id': film_id, 'title': f'Film {film_id}', 'description': None, 'imdb_rating': 7.0,
+            'genres': ['Drama'], 'actors_names': [], 'directors_names': [], 'writers_names': []}
+
+
+class FakeElastic:
+    """Elasticsearch в памяти: get, mget и search по индексу фильмов."""
+
+    def __init__(self, films):
+        self.films = {film['id']: film for film in films}
+        self.calls = []
+
+    async def get(self, index, id):
+        self.calls.append(('get', id))
+        await asyncio.sleep(0.01)
+        if id not in self.films:
+            raise NotFoundError(404, 'not_found', {})
+        return {'_source': self.films[id]}
+
+    async def mget(self, index, ids):
+        self.calls.append(('mget', list(ids)))
+        return {'docs': [{'_id': i, 'found': i in self.films, '_source': self.films.get(i)} for i in ids]}
+
+    async def search(self, index, body):
+        self.calls.append(('search', body['from'], body['size']))
+        hits = list(self.films.values())[body['from']:body['from'] + body['size']]
+        return {'hits': {'hits': [{'_source': hit} for hit in hits]}}
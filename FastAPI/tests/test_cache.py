@@ -0,0 +1,46 @@
+import time
+
+from services.cache import MISSING, LocalCache
+
+
+def test_local_cache_admission_keeps_frequent_keys():
+    cache = LocalCache(max_size=2, ttl=30)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    for _ in range(5):
+        assert cache.get('a') == 1
+        assert cache.get('b') == 2
+
+    # разовый ключ не вытесняет часто запрашиваемые
+    assert cache.get('once') is MISSING
+    assert cache.set('once', 3) is False
+    assert cache.get('a') == 1 and cache.get('b') == 2
+
+    # ключ, запрашиваемый чаще, вытесняет самый давно использованный
+    for _ in range(10):
+        cache.get('hot')
+    assert cache.set('hot', 4) is True
+    assert len(cache) == 2
+    assert cache.get('a') is MISSING
+    assert cache.get('b') == 2 and cache.get('hot') == 4
+
+
+def test_local_cache_ttl_and_expired_victim():
+    cache = LocalCache(max_size=1, ttl=30)
+    cache.set('a', 1, ttl=0)
+    assert cache.get('a') is MISSING
+
+    cache.set('b', 2, ttl=0.01)
+    for _ in range(5):
+        cache.get('b')
+    time.sleep(0.02)
+    # истёкшая запись уступает место независимо от частоты
+    assert cache.set('c', 3) is True
+    assert cache.get('c') == 3
+
+
+def test_ttl_is_capped_by_local_ttl():
+    cache = LocalCache(max_size=10, ttl=0.01)
+    cache.set('a', 1, ttl=60)
+    time.sleep(0.02)
+    assert cache.get('a') is MISSING
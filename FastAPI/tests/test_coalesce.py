@@ -0,0 +1,49 @@
+import asyncio
+
+from conftest import FakeRedis
+from services.cache import LocalCache, TwoTierCache
+
+
+def test_concurrent_misses_share_one_fetch():
+    async def run():
+        cache = TwoTierCache(FakeRedis(), LocalCache())
+        calls = 0
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return 'value'
+
+        results = await asyncio.gather(*[cache.coalesce('k', fetch) for _ in range(10)])
+        assert results == ['value'] * 10
+        assert calls == 1
+        assert cache.coalesced == 9
+
+    asyncio.run(run())
+
+
+def test_lock_makes_other_process_wait_for_value():
+    async def run():
+        redis = FakeRedis()
+        first = TwoTierCache(redis, LocalCache(), lock_ttl=1, lock_poll=0.005)
+        second = TwoTierCache(redis, LocalCache(), lock_ttl=1, lock_poll=0.005)
+        calls = 0
+
+        def fetch_into(cache):
+            async def fetch():
+                nonlocal calls
+                calls += 1
+                await asyncio.sleep(0.02)
+                await cache.set('k', b'value', ex=60)
+                return b'value'
+            return fetch
+
+        results = await asyncio.gather(first.coalesce('k', fetch_into(first)),
+                                       second.coalesce('k', fetch_into(second)))
+        assert results == [b'value', b'value']
+        assert calls == 1
+        assert first.lock_waits + second.lock_waits == 1
+        assert 'lock:k' not in redis.data
+
+    asyncio.run(run())
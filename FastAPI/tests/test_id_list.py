@@ -0,0 +1,73 @@
+import asyncio
+import json
+import time
+
+from conftest import FakeElastic, FakeRedis, make_film
+from services.cache import MISSING, LocalCache, TwoTierCache
+from services.common import NOT_FOUND
+from services.film import FilmService
+
+
+def test_list_key_holds_only_ids():
+    async def run():
+        redis = FakeRedis()
+        elastic = FakeElastic([make_film(film_id) for film_id in ('f1', 'f2')])
+        service = FilmService(TwoTierCache(redis, LocalCache()), elastic)
+
+        films = await service.get_list(None, None, page=1, per_page=10)
+        assert [film.id for film in films] == ['f1', 'f2']
+        list_keys = [key for key in redis.data if ':ids:' in key]
+        assert len(list_keys) == 1
+        assert json.loads(redis.data[list_keys[0]][0]) == ['f1', 'f2']
+        # тела фильмов - в ключах сущностей, общих с get_by_id
+        assert json.loads(redis.data['movies:f1'][0])['title'] == 'Film f1'
+
+    asyncio.run(run())
+
+
+def test_get_many_serves_stale_and_caps_local_ttl():
+    async def run():
+        redis = FakeRedis()
+        cache = TwoTierCache(redis, LocalCache(ttl=300), stale_ttl=60)
+        await cache.set_many({'fresh': b'1', 'stale': b'2'}, ex=10)
+        redis.expire_in('stale', 30)
+        cache.local.delete('fresh')
+        cache.local.delete('stale')
+        refreshed = []
+
+        async def refresh(key):
+            refreshed.append(key)
+
+        values = await cache.get_many(['fresh', 'stale', 'absent'], refresh=refresh)
+        assert values == [b'1', b'2', None]
+        await asyncio.sleep(0.01)
+        assert refreshed == ['stale']
+        assert cache.local.get('stale') is MISSING
+        # L1 хранит значение не дольше, чем до его мягкого срока
+        expires_at, _ = cache.local._data['fresh']
+        assert expires_at - time.monotonic() <= 10
+
+    asyncio.run(run())
+
+
+def test_entities_by_ids_keeps_order_and_skips_missing():
+    async def run():
+        redis = FakeRedis()
+        elastic = FakeElastic([make_film(film_id) for film_id in ('f1', 'f2', 'f3')])
+        cache = TwoTierCache(redis, LocalCache())
+        service = FilmService(cache, elastic)
+        await service._put_entities_to_cache([service.model(**make_film('f1')), service.model(**make_film('f3'))])
+
+        films = await service._entities_by_ids(['f3', 'gone', 'f1', 'f2'])
+        assert [film.id for film in films] == ['f3', 'f1', 'f2']
+        # из search_engine - только то, чего нет в кэше
+        assert elastic.calls == [('mget', ['gone', 'f2'])]
+        assert await cache.get('movies:gone') is NOT_FOUND
+        assert await redis.get('movies:f2') is not None
+
+        elastic.calls.clear()
+        films = await service._entities_by_ids(['f2', 'gone', 'f3'])
+        assert [film.id for film in films] == ['f2', 'f3']
+        assert elastic.calls == []
+
+    asyncio.run(run())
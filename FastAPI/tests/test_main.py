@@ -0,0 +1,27 @@
+import importlib
+
+from fastapi.testclient import TestClient
+
+from core import config
+from db import cache
+from services.cache import LocalCache, TwoTierCache
+
+
+def load_app(monkeypatch, enabled):
+    monkeypatch.setattr(config, 'CACHE_STATS_ENABLED', enabled)
+    import main
+    return importlib.reload(main).app
+
+
+def test_cache_stats_are_off_by_default(monkeypatch):
+    assert config.CACHE_STATS_ENABLED is False
+    client = TestClient(load_app(monkeypatch, False))
+    assert client.get('/api/cache/stats').status_code == 404
+
+
+def test_cache_stats_when_enabled(monkeypatch):
+    monkeypatch.setattr(cache, 'cache', TwoTierCache(None, LocalCache()))
+    client = TestClient(load_app(monkeypatch, True))
+    response = client.get('/api/cache/stats')
+    assert response.status_code == 200
+    assert 'l1' in response.json()
@@ -0,0 +1,48 @@
+import asyncio
+
+from conftest import FakeElastic, FakeRedis, make_film
+from services.cache import LocalCache, TwoTierCache
+from services.common import NOT_FOUND
+from services.film import FilmService
+
+
+def test_negative_entry_differs_from_miss():
+    async def run():
+        redis = FakeRedis()
+        cache = TwoTierCache(redis, LocalCache(), negative_ttl=30)
+        assert await cache.get('k') is None
+
+        await cache.set_negative('k')
+        assert await cache.get('k') is NOT_FOUND
+        # другой процесс видит отрицательную запись в Redis
+        other = TwoTierCache(redis, LocalCache())
+        assert await other.get('k') is NOT_FOUND
+        assert await other.get_many(['k', 'absent']) == [NOT_FOUND, None]
+
+        # запись значения снимает отрицательную
+        await cache.set('k', b'value', ex=60)
+        assert await cache.get('k') == b'value'
+
+    asyncio.run(run())
+
+
+def test_missing_entity_is_fetched_once():
+    async def run():
+        elastic = FakeElastic([make_film('f1')])
+        service = FilmService(TwoTierCache(FakeRedis(), LocalCache()), elastic)
+        assert await service.get_by_id('nope') is None
+        assert await service.get_by_id('nope') is None
+        assert elastic.calls == [('get', 'nope')]
+
+    asyncio.run(run())
+
+
+def test_empty_search_is_cached_negatively():
+    async def run():
+        elastic = FakeElastic([make_film('f1')])
+        service = FilmService(TwoTierCache(FakeRedis(), LocalCache()), elastic)
+        assert await service.get_list(None, None, page=3, per_page=10) == []
+        assert await service.get_list(None, None, page=3, per_page=10) == []
+        assert elastic.calls == [('search', 20, 10)]
+
+    asyncio.run(run())
@@ -0,0 +1,70 @@
+import asyncio
+
+from conftest import FakeRedis
+from services import cache as cache_module
+from services.cache import MISSING, LocalCache, TwoTierCache
+
+
+def test_stale_value_is_served_while_refreshing():
+    async def run():
+        redis = FakeRedis()
+        cache = TwoTierCache(redis, LocalCache(), stale_ttl=60)
+        await cache.set('k', b'old', ex=10)
+        # мягкий срок прошёл, в Redis ключ ещё живёт
+        redis.expire_in('k', 30)
+        cache.local.delete('k')
+        refreshed = []
+
+        async def refresh():
+            refreshed.append('k')
+            await cache.set('k', b'new', ex=10)
+            return b'new'
+
+        assert await cache.get('k', refresh=refresh) == b'old'
+        assert cache.stale_hits == 1
+        # устаревшее значение не попадает в L1: следующий запрос снова идёт в Redis
+        assert cache.local.get('k') is MISSING
+        await asyncio.sleep(0.01)
+        assert refreshed == ['k']
+        assert await cache.get('k') == b'new'
+
+    asyncio.run(run())
+
+
+def test_ttl_jitter_spreads_expiry():
+    async def run():
+        redis = FakeRedis()
+        cache = TwoTierCache(redis, LocalCache(), stale_ttl=60, ttl_jitter=0.1)
+        await cache.set_many({f'k{i}': b'v' for i in range(20)}, ex=100)
+        await cache.set('one', b'v', ex=100)
+
+        ttls = [await redis.pttl(key) / 1000 - 60 for key in list(redis.data)]
+        # мягкий срок размыт на ±10%, записи, сделанные вместе, истекают в разное время
+        assert all(89 < ttl <= 110 for ttl in ttls)
+        assert len({round(ttl) for ttl in ttls}) > 1
+
+    asyncio.run(run())
+
+
+def test_early_refresh_near_soft_expiry(monkeypatch):
+    # -fetch_time * beta * ln(1 - 0.5) = 69 с: больше, чем осталось до мягкого срока
+    monkeypatch.setattr(cache_module.random, 'random', lambda: 0.5)
+
+    async def run():
+        redis = FakeRedis()
+        cache = TwoTierCache(redis, LocalCache(), stale_ttl=60, early_refresh_beta=100)
+        cache.fetch_time = 1
+        await cache.set('k', b'old', ex=10)
+        cache.local.delete('k')
+        refreshed = []
+
+        async def refresh():
+            refreshed.append('k')
+            return b'new'
+
+        assert await cache.get('k', refresh=refresh) == b'old'
+        await asyncio.sleep(0.01)
+        assert refreshed == ['k']
+        assert cache.early_refreshes == 1
+
+    asyncio.run(run())
@@ -0,0 +1,321 @@
+"""Нагрузочные замеры ETL на синтетическом каталоге.
+
+    python benchmark.py generate --films 1000000 --persons 500000 --truncate
+    python benchmark.py run --es standin
+    python benchmark.py compare benchmark_results/old.json benchmark_results/new.json
+
+generate заполняет схему content воспроизводимым каталогом (id и связи
+зависят только от номеров строк и --seed). run замеряет сценарии
+full (загрузка с нуля), incremental (изменение части фильмов) и rename
+(переименование популярных персон и жанра) и пишет результат в JSON.
+--es standin подменяет Elasticsearch заглушкой в процессе: тела запросов
+сериализуются, но по сети не уходят - замеряется сама ETL.
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Dict, List
+
+import psycopg2
+from dotenv import load_dotenv
+
+from db import get_connection_params
+
+logger = logging.getLogger(__name__)
+
+# Параметры окружения, от которых зависит скорость ETL: попадают в результаты
+ETL_SETTINGS = (
+    'ETL_BACKEND', 'FILM_EXTRACT_MODE', 'FILM_COALESCE', 'FILM_FANOUT', 'BATCH_SIZE', 'STREAM_CHUNK_SIZE',
+    'PIPELINE_QUEUE_SIZE', 'BULK_STREAMS', 'BULK_CHUNK_SIZE', 'CONTENT_HASH',
+)
+
+CONTENT_TABLES = ('person_film_work', 'genre_film_work', 'person', 'genre', 'film_work')
+# вложенные списки участников в документах фильмов (как etl.PERSON_ROLES)
+PERSON_ROLES = ('directors', 'actors', 'writers')
+
+# Популярность персон: номер персоны = 1 + persons * random()^SKEW, малые номера встречаются чаще
+GENERATE_SQL = '''
+SELECT setseed(%(seed)s);
+
+INSERT INTO content.genre (id, name, description, created_at, updated_at)
+SELECT md5('genre' || g)::uuid, 'Genre ' || g, 'Synthetic genre ' || g, t.ts, t.ts
+FROM generate_series(1, %(genres)s) g,
+LATERAL (SELECT now() - random() * interval '30 days' ts) t;
+
+INSERT INTO content.person (id, full_name, gender, created_at, updated_at)
+SELECT md5('person' || p)::uuid, 'Person ' || p, CASE WHEN random() < 0.5 THEN 'male' ELSE 'female' END, t.ts, t.ts
+FROM generate_series(1, %(persons)s) p,
+LATERAL (SELECT now() - random() * interval '30 days' ts) t;
+
+INSERT INTO content.film_work (id, title, description, creation_date, rating, type, created_at, updated_at)
+SELECT md5('film' || f)::uuid, 'Film ' || f, repeat('Synthetic description ' || f || '. ', 5),
+       date '1950-01-01' + (random() * 27000)::int, round((random() * 100)::numeric) / 10,
+       CASE WHEN random() < 0.8 THEN 'movie' ELSE 'tv_show' END, t.ts, t.ts
+FROM generate_series(1, %(films)s) f,
+LATERAL (SELECT now() - random() * interval '30 days' ts) t;
+
+INSERT INTO content.genre_film_work (id, genre_id, film_work_id, created_at, updated_at)
+SELECT md5('gfw' || f || '-' || k)::uuid, md5('genre' || (1 + (f * 31 + k) %% %(genres)s))::uuid,
+       md5('film' || f)::uuid, now(), now() - random() * interval '30 days'
+FROM generate_series(1, %(films)s) f, generate_series(1, LEAST(%(genres_per_film)s, %(genres)s)) k;
+
+INSERT INTO content.person_film_work (id, person_id, film_work_id, role, created_at, updated_at)
+SELECT DISTINCT ON (c.person, c.film, c.role)
+       md5('pfw' || c.film || '-' || c.role || '-' || c.k)::uuid, md5('person' || c.person)::uuid,
+       md5('film' || c.film)::uuid, c.role, now(), now() - random() * interval '30 days'
+FROM (
+    SELECT f film, r.role, k, 1 + floor(%(persons)s * power(random(), %(skew)s))::int person
+    FROM generate_series(1, %(films)s) f,
+    (VALUES ('actor', %(actors)s), ('director', %(directors)s), ('writer', %(writers)s)) r(role, n),
+    LATERAL generate_series(1, r.n) k
+) c;
+'''
+
+
+def connect():
+    conn = psycopg2.connect(**get_connection_params())
+    conn.set_session(autocommit=True)
+    return conn
+
+
+def count_catalog(cursor) -> Dict[str, int]:
+    counts = {}
+    for table in CONTENT_TABLES:
+        cursor.execute(f"SELECT count(*) FROM content.{table};")
+        counts[table] = cursor.fetchone()[0]
+    return counts
+
+
+def generate(args: argparse.Namespace) -> None:
+    """Заполнить схему content синтетическим каталогом."""
+    conn = connect()
+    with conn.cursor() as cursor:
+        if any(count_catalog(cursor).values()):
+            if not args.truncate:
+                sys.exit("content is not empty: pass --truncate to replace it with a synthetic catalog")
+            cursor.execute(f"TRUNCATE {', '.join('content.' + table for table in CONTENT_TABLES)};")
+        started = time.monotonic()
+        # без триггеров уведомлений и отметок etl.film_document_dirty на каждую строку
+        cursor.execute("SET session_replication_role = replica;")
+        cursor.execute("BEGIN;")
+        cursor.execute(GENERATE_SQL, {
+            'seed': args.seed, 'films': args.films, 'persons': args.persons, 'genres': args.genres,
+            'genres_per_film': args.genres_per_film, 'actors': args.actors, 'directors': args.directors,
+            'writers': args.writers, 'skew': args.skew,
+        })
+        cursor.execute("SELECT to_regclass('etl.film_document_dirty') IS NOT NULL;")
+        if cursor.fetchone()[0]:
+            cursor.execute("TRUNCATE etl.film_document, etl.film_document_dirty;")
+            cursor.execute("INSERT INTO etl.film_document_dirty (film_id) SELECT id FROM content.film_work;")
+        cursor.execute("COMMIT;")
+        cursor.execute("SET session_replication_role = DEFAULT;")
+        cursor.execute(f"ANALYZE {', '.join('content.' + table for table in CONTENT_TABLES)};")
+        print(json.dumps({'seconds': round(time.monotonic() - started, 1), 'catalog': count_catalog(cursor)}))
+    conn.close()
+
+
+class StandInElasticsearch:
+    """Заглушка Elasticsearch в процессе: bulk и update_by_query без сети.
+
+    Тела запросов сериализуются, как это сделал бы клиент, и каждый
+    элемент считается успешно загруженным. Участники загруженных фильмов
+    запоминаются (id -> имя), чтобы update_by_query находил и переименовывал
+    те же фильмы, что и ES.
+    """
+
+    def __init__(self) -> None:
+        # id фильма -> {id участника: имя} по всем ролям
+        self.people: Dict[str, Dict[str, str]] = {}
+
+    def options(self, **kwargs: Any) -> 'StandInElasticsearch':
+        return self
+
+    def ping(self) -> bool:
+        return True
+
+    def bulk(self, operations: Any) -> Dict[str, Any]:
+        if isinstance(operations, (bytes, str)):
+            lines = [json.loads(line) for line in operations.splitlines() if line]
+        else:
+            lines = [json.loads(json.dumps(line, default=str)) for line in operations]
+        items = []
+        lines = iter(lines)
+        for line in lines:
+            op, meta = next(iter(line.items()))
+            items.append({op: {'status': 200}})
+            if op == 'delete':
+                self.people.pop(meta['_id'], None)
+                continue
+            source = next(lines)
+            if op == 'index' and meta['_index'].startswith('movies'):
+                self.people[meta['_id']] = {
+                    person['id']: person['name'] for role in PERSON_ROLES for person in source.get(role) or []
+                }
+        return {'errors': False, 'items': items}
+
+    def update_by_query(self, index: str, query: Dict[str, Any], script: Dict[str, Any], **kwargs: Any) -> Dict[str, Any]:
+        json.dumps({'query': query, 'script': script}, default=str)
+        person_ids = {
+            person_id
+            for clause in query['bool']['should']
+            for terms in clause['nested']['query']['terms'].values()
+            for person_id in terms
+        }
+        names = script['params']['names']
+        total = updated = 0
+        for people in self.people.values():
+            matched = person_ids.intersection(people)
+            if not matched:
+                continue
+            total += 1
+            renamed = {person_id: names[person_id] for person_id in matched if people[person_id] != names[person_id]}
+            if renamed:
+                people.update(renamed)
+                updated += 1
+        return {'total': total, 'updated': updated, 'noops': total - updated, 'version_conflicts': 0, 'failures': []}
+
+
+def timed_cycle(etl: Any, scenario: str) -> Dict[str, Any]:
+    started = time.monotonic()
+    etl.etl_process()
+    result = {'wall_seconds': round(time.monotonic() - started, 3)}
+    result.update(etl.metrics.last_summary)
+    print(f"{scenario}: {result['wall_seconds']} s", file=sys.stderr)
+    return result
+
+
+def touch_films(cursor, films: int, count: int) -> None:
+    """Изменить рейтинг count фильмов, равномерно по каталогу."""
+    stride = max(1, films // max(count, 1))
+    cursor.execute('''
+UPDATE content.film_work SET rating = round((random() * 100)::numeric) / 10, updated_at = now()
+WHERE id IN (SELECT md5('film' || (1 + n * %s))::uuid FROM generate_series(0, %s - 1) n);
+''', [stride, count])
+
+
+def rename_popular(cursor, persons: int, genres: int) -> None:
+    """Переименовать самых популярных персон (малые номера) и один жанр."""
+    cursor.execute('''
+UPDATE content.person SET full_name = full_name || ' *', updated_at = now()
+WHERE id IN (SELECT md5('person' || n)::uuid FROM generate_series(1, %s) n);
+UPDATE content.genre SET name = name || ' *', updated_at = now()
+WHERE id IN (SELECT md5('genre' || n)::uuid FROM generate_series(1, %s) n);
+''', [persons, genres])
+
+
+def run(args: argparse.Namespace) -> None:
+    """Замерить сценарии на текущем каталоге и записать результат в JSON."""
+    workdir = tempfile.mkdtemp(prefix='etl_benchmark_')
+    # файлы прогона - во временном каталоге, чекпоинты рабочего ETL не затрагиваются
+    os.environ.setdefault('CONTENT_HASH_FILE', os.path.join(workdir, 'hashes.sqlite'))
+    os.environ.setdefault('DEAD_LETTER_FILE', os.path.join(workdir, 'dead_letter.jsonl'))
+    logging.basicConfig(level=logging.INFO, filename=os.path.join(workdir, 'etl.log'))
+
+    import etl
+    from state import JsonLogStorage, State
+
+    etl.LOCK_FILE = os.path.join(workdir, 'etl.lock')
+    etl.state = State(JsonLogStorage(os.path.join(workdir, 'state.json')))
+    if args.es == 'standin':
+        etl.es = etl.bulk_loader.es = StandInElasticsearch()
+
+    conn = connect()
+    cursor = conn.cursor()
+    catalog = count_catalog(cursor)
+    results: Dict[str, Any] = {
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'git': git_revision(),
+        'es': args.es,
+        'catalog': catalog,
+        'settings': {name: os.environ.get(name) for name in ETL_SETTINGS if os.environ.get(name) is not None},
+        'scenarios': {},
+    }
+    scenarios = results['scenarios']
+    if 'full' in args.scenarios:
+        scenarios['full'] = timed_cycle(etl, 'full')
+    else:
+        # прочие сценарии меряются от текущего состояния: сначала догоняем его без замера
+        etl.etl_process()
+    if 'incremental' in args.scenarios:
+        touch_films(cursor, catalog['film_work'], args.touch)
+        scenarios['incremental'] = dict(timed_cycle(etl, 'incremental'), films_changed=args.touch)
+    if 'rename' in args.scenarios:
+        rename_popular(cursor, args.rename_persons, args.rename_genres)
+        scenarios['rename'] = dict(timed_cycle(etl, 'rename'),
+                                   persons_renamed=args.rename_persons, genres_renamed=args.rename_genres)
+    conn.close()
+
+    output = args.output or os.path.join('benchmark_results', f"bench_{time.strftime('%Y%m%d%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2, default=str)
+    print(output)
+
+
+def compare(args: argparse.Namespace) -> None:
+    """Сравнить два результата run: время сценариев и отношение new/old."""
+    old, new = (json.load(open(path)) for path in (args.old, args.new))
+    rows: List[str] = []
+    for scenario, result in new['scenarios'].items():
+        before = old['scenarios'].get(scenario)
+        if before is None:
+            continue
+        ratio = result['wall_seconds'] / before['wall_seconds'] if before['wall_seconds'] else float('inf')
+        rows.append(f"{scenario:12} {before['wall_seconds']:>10.3f} {result['wall_seconds']:>10.3f} {ratio:>8.2f}x")
+    print(f"{'scenario':12} {'old, s':>10} {'new, s':>10} {'new/old':>9}")
+    print('\n'.join(rows))
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def main() -> None:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    gen = commands.add_parser('generate', help='заполнить content синтетическим каталогом')
+    gen.add_argument('--films', type=int, default=100000)
+    gen.add_argument('--persons', type=int, default=50000)
+    gen.add_argument('--genres', type=int, default=30)
+    gen.add_argument('--genres-per-film', type=int, default=3)
+    gen.add_argument('--actors', type=int, default=8, help='актёров на фильм')
+    gen.add_argument('--directors', type=int, default=1, help='режиссёров на фильм')
+    gen.add_argument('--writers', type=int, default=2, help='сценаристов на фильм')
+    gen.add_argument('--skew', type=float, default=2.0, help='перекос популярности персон (1 - равномерно)')
+    gen.add_argument('--seed', type=float, default=0.42)
+    gen.add_argument('--truncate', action='store_true', help='очистить непустую схему content')
+    gen.set_defaults(func=generate)
+
+    bench = commands.add_parser('run', help='замерить сценарии ETL')
+    bench.add_argument('--es', choices=('standin', 'real'), default='standin')
+    bench.add_argument('--scenarios', nargs='+', choices=('full', 'incremental', 'rename'),
+                       default=['full', 'incremental', 'rename'])
+    bench.add_argument('--touch', type=int, default=1000, help='фильмов меняется в сценарии incremental')
+    bench.add_argument('--rename-persons', type=int, default=10)
+    bench.add_argument('--rename-genres', type=int, default=1)
+    bench.add_argument('--output', help='файл результата (по умолчанию benchmark_results/bench_<время>.json)')
+    bench.set_defaults(func=run)
+
+    cmp = commands.add_parser('compare', help='сравнить два результата run')
+    cmp.add_argument('old')
+    cmp.add_argument('new')
+    cmp.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+import abc
+import hashlib
+import json
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+import redis
+
+
+def content_hash(source: Dict[str, Any], ignore: Iterable[str] = ()) -> str:
+    """Стабильный хеш документа: ключи отсортированы, поля ignore не учитываются."""
+    body = {key: value for key, value in source.items() if key not in ignore}
+    dump = json.dumps(body, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    return hashlib.blake2b(dump.encode(), digest_size=16).hexdigest()
+
+
+class BaseHashStore(abc.ABC):
+    """Хранилище хешей загруженных документов: '<индекс>:<id>' -> хеш."""
+
+    @abc.abstractmethod
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        """Известные хеши для ключей keys (отсутствующих ключей в ответе нет)."""
+
+    @abc.abstractmethod
+    def set_many(self, hashes: Dict[str, str]) -> None:
+        """Запомнить хеши загруженных документов."""
+
+    @abc.abstractmethod
+    def delete_many(self, keys: List[str]) -> None:
+        """Забыть хеши (документ изменён в обход полной загрузки)."""
+
+    @abc.abstractmethod
+    def clear(self) -> None:
+        """Забыть все хеши."""
+
+
+class SqliteHashStore(BaseHashStore):
+    """Локальное встроенное хранилище хешей (SQLite, WAL)."""
+
+    def __init__(self, file_path: str) -> None:
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(file_path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS doc_hash (key TEXT PRIMARY KEY, hash TEXT NOT NULL) WITHOUT ROWID")
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        hashes = {}
+        with self._lock:
+            # не больше 500 параметров в запросе: ограничение SQLite
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                rows = self._db.execute(
+                    f"SELECT key, hash FROM doc_hash WHERE key IN ({','.join('?' * len(part))})", part)
+                hashes.update(rows)
+        return hashes
+
+    def set_many(self, hashes: Dict[str, str]) -> None:
+        with self._lock:
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.executemany("INSERT OR REPLACE INTO doc_hash (key, hash) VALUES (?, ?)", hashes.items())
+
+    def delete_many(self, keys: List[str]) -> None:
+        with self._lock:
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.executemany("DELETE FROM doc_hash WHERE key = ?", [(key,) for key in keys])
+
+    def clear(self) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM doc_hash")
+
+
+class RedisHashStore(BaseHashStore):
+    """Хранилище хешей в Redis: один хеш (HSET) на все документы."""
+
+    def __init__(self, redis_client: redis.Redis, key: str = 'etl_doc_hash') -> None:
+        self._redis = redis_client
+        self._key = key
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        if not keys:
+            return {}
+        values = self._redis.hmget(self._key, keys)
+        return {
+            key: value.decode() if isinstance(value, bytes) else value
+            for key, value in zip(keys, values) if value is not None
+        }
+
+    def set_many(self, hashes: Dict[str, str]) -> None:
+        if hashes:
+            self._redis.hset(self._key, mapping=hashes)
+
+    def delete_many(self, keys: List[str]) -> None:
+        if keys:
+            self._redis.hdel(self._key, *keys)
+
+    def clear(self) -> None:
+        self._redis.delete(self._key)
+
+
+class ShardedHashStore(BaseHashStore):
+    """Хеши, разложенные по хранилищам шардов: ключ хранится в хранилище route(key).
+
+    Хранилища открываются при первом обращении (open_store(номер шарда)).
+    """
+
+    def __init__(self, open_store: Callable[[int], BaseHashStore], route: Callable[[str], int], shards: int) -> None:
+        self._open_store = open_store
+        self._route = route
+        self._shards = shards
+        self._stores: Dict[int, BaseHashStore] = {}
+        self._lock = threading.Lock()
+
+    def _store(self, shard: int) -> BaseHashStore:
+        with self._lock:
+            if shard not in self._stores:
+                self._stores[shard] = self._open_store(shard)
+            return self._stores[shard]
+
+    def _split(self, keys: Iterable[str]) -> Dict[int, List[str]]:
+        parts: Dict[int, List[str]] = {}
+        for key in keys:
+            parts.setdefault(self._route(key), []).append(key)
+        return parts
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        hashes = {}
+        for shard, part in self._split(keys).items():
+            hashes.update(self._store(shard).get_many(part))
+        return hashes
+
+    def set_many(self, hashes: Dict[str, str]) -> None:
+        for shard, part in self._split(hashes).items():
+            self._store(shard).set_many({key: hashes[key] for key in part})
+
+    def delete_many(self, keys: List[str]) -> None:
+        for shard, part in self._split(keys).items():
+            self._store(shard).delete_many(part)
+
+    def clear(self) -> None:
+        for shard in range(self._shards):
+            self._store(shard).clear()
+
+
+class ContentFilter:
+    """Отбрасывает документы, которые уже загружены в ES с тем же содержимым.
+
+    Для каждого полного документа (index) считается хеш _source без полей
+    ignore (например, updated_at: touch-обновление не меняет документ).
+    Документ с известным хешем не отправляется. Хеши запоминаются только
+    после успешной загрузки; частичные обновления (update) делают хеш
+    документа неизвестным, и следующая полная загрузка пройдёт.
+    Изменения в обход filter() (update_by_query) должны сами забыть
+    хеши затронутых документов через store.delete_many().
+    """
+
+    def __init__(self, store: BaseHashStore, ignore: Iterable[str] = ('updated_at',)) -> None:
+        self.store = store
+        self.ignore = tuple(ignore)
+
+    def filter(self, actions: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Dict[str, str]]:
+        """Действия, которые нужно отправить, и хеши, которые запомнить после их загрузки."""
+        hashes = {}
+        partial = []
+        for action in actions:
+            key = f"{action['_index']}:{action['_id']}"
+            if action.get('_op_type', 'index') == 'index':
+                hashes[key] = content_hash(action['_source'], self.ignore)
+            else:
+                partial.append(key)
+        if partial:
+            self.store.delete_many(partial)
+        if not hashes:
+            return actions, {}
+
+        known = self.store.get_many(list(hashes))
+        unchanged = {key for key, value in hashes.items() if known.get(key) == value}
+        return [
+            action for action in actions
+            if f"{action['_index']}:{action['_id']}" not in unchanged
+        ], {key: value for key, value in hashes.items() if key not in unchanged}
+
+    def commit(self, hashes: Dict[str, str], failed: List[Dict[str, Any]] = ()) -> None:
+        """Запомнить хеши загруженных документов, кроме не загрузившихся (failed)."""
+        for action in failed:
+            hashes.pop(f"{action['_index']}:{action['_id']}", None)
+        self.store.set_many(hashes)
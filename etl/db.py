@@ -0,0 +1,149 @@
+import itertools
+import os
+import threading
+from collections import namedtuple
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+import psycopg2
+
+
+OperationalError = psycopg2.OperationalError
+
+
+def get_connection_params() -> Dict[str, Any]:
+    """Параметры psycopg2.connect() из тех же переменных окружения, что и настройки Django."""
+    return {
+        'dbname': os.environ.get('DB_NAME'),
+        'user': os.environ.get('DB_USER'),
+        'password': os.environ.get('DB_PASSWORD'),
+        'host': os.environ.get('DB_HOST', '127.0.0.1'),
+        'port': os.environ.get('DB_PORT', 5432),
+        'options': '-c search_path=public,content',
+    }
+
+
+class Database:
+    """Postgres напрямую через psycopg2, без Django: строки - namedtuple.
+
+    У каждого потока своё соединение (autocommit), как у соединений Django.
+    """
+
+    OperationalError = OperationalError
+
+    def __init__(self, connection_params: Dict[str, Any]) -> None:
+        """
+        Args:
+            connection_params: Параметры psycopg2.connect().
+        """
+        self.connection_params = connection_params
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: List[Any] = []
+        self._cursor_ids = itertools.count()
+
+    def get_connection_params(self) -> Dict[str, Any]:
+        return dict(self.connection_params)
+
+    def ensure_connection(self) -> None:
+        """Открыть соединение текущего потока; OperationalError, если Postgres недоступен."""
+        self._connection()
+
+    def fetch_rows(self, sql: str, params: Optional[Sequence[Any]] = None) -> List[Any]:
+        """Выполнить запрос и вернуть все строки."""
+        with self._connection().cursor() as cursor:
+            cursor.execute(sql, params)
+            Row = namedtuple('Row', [col.name for col in cursor.description])
+            return [Row(*row) for row in cursor.fetchall()]
+
+    def stream_rows(self, sql: str, params: Optional[Sequence[Any]] = None, itersize: int = 500) -> Iterator[Any]:
+        """Строки запроса по мере чтения серверного (именованного) курсора."""
+        name = f"etl_cursor_{threading.get_ident()}_{next(self._cursor_ids)}"
+        # WITH HOLD: в autocommit курсор должен пережить завершение транзакции DECLARE
+        with self._connection().cursor(name, withhold=True) as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchmany(itersize)
+            if not rows:
+                return
+            # у именованного курсора description появляется только после первого FETCH
+            Row = namedtuple('Row', [col.name for col in cursor.description])
+            while rows:
+                yield from (Row(*row) for row in rows)
+                rows = cursor.fetchmany(itersize)
+
+    def copy_to(self, sql: str, file: Any) -> None:
+        """Выполнить COPY ... TO STDOUT, передавая данные в file.write() по мере чтения."""
+        with self._connection().cursor() as cursor:
+            cursor.copy_expert(sql, file)
+
+    def close(self) -> None:
+        """Закрыть соединение текущего потока."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            with self._lock:
+                if conn in self._connections:
+                    self._connections.remove(conn)
+            conn.close()
+
+    def close_all(self) -> None:
+        """Закрыть соединения всех потоков (перед fork/spawn и при остановке)."""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+    def _connection(self) -> Any:
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and not conn.closed:
+            return conn
+        conn = psycopg2.connect(**self.connection_params)
+        conn.set_session(autocommit=True)
+        self._local.conn = conn
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+
+class DjangoDatabase:
+    """Те же операции через соединение Django (нужен django.setup())."""
+
+    def __init__(self, alias: str = 'default') -> None:
+        from django.db import connections, OperationalError
+
+        self.OperationalError = OperationalError
+        self._connections = connections
+        self.alias = alias
+
+    def get_connection_params(self) -> Dict[str, Any]:
+        return self._connections[self.alias].get_connection_params()
+
+    def ensure_connection(self) -> None:
+        self._connections[self.alias].ensure_connection()
+
+    def fetch_rows(self, sql: str, params: Optional[Sequence[Any]] = None) -> List[Any]:
+        with self._connections[self.alias].cursor() as cursor:
+            cursor.execute(sql, params)
+            Row = namedtuple('Row', [col.name for col in cursor.description])
+            return [Row(*row) for row in cursor.fetchall()]
+
+    def stream_rows(self, sql: str, params: Optional[Sequence[Any]] = None, itersize: int = 500) -> Iterator[Any]:
+        with self._connections[self.alias].chunked_cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchmany(itersize)
+            if not rows:
+                return
+            Row = namedtuple('Row', [col.name for col in cursor.description])
+            while rows:
+                yield from (Row(*row) for row in rows)
+                rows = cursor.fetchmany(itersize)
+
+    def copy_to(self, sql: str, file: Any) -> None:
+        with self._connections[self.alias].cursor() as cursor:
+            cursor.copy_expert(sql, file)
+
+    def close(self) -> None:
+        self._connections[self.alias].close()
+
+    def close_all(self) -> None:
+        self._connections.close_all()
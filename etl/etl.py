@@ -1,37 +1,150 @@
 import os
 import fcntl
 import time
+from collections import namedtuple
 from contextlib import contextmanager
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+import itertools
+import json
 import math
 import logging
+import multiprocessing
+import uuid
+
+import redis
+
+from dotenv import load_dotenv
+from elasticsearch import Elasticsearch
+
+from db import Database, DjangoDatabase, get_connection_params
+from state import State, JsonLogStorage
+from pipeline import Pipeline
+from loader import BulkLoader, BulkLoadError
+from content_hash import ContentFilter, RedisHashStore, ShardedHashStore, SqliteHashStore
+from notify import ChangeListener
+from reindex import VersionedIndex
+from export import NdjsonExporter, copy_sql
+from reconcile import DigestWriter, RangeReconciler
+from metrics import Metrics
+import es_schema
+
+load_dotenv()
 
-import django
-# Установите настройки Django
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
-django.setup()
-from django.db import connections, OperationalError
-from django.db.models import F, Value, CharField
-from django.db.models.functions import Concat
-from elasticsearch import Elasticsearch, helpers
-
-from config import settings
-from state import State, JsonFileStorage
-from movies.models import Genre, Person, Filmwork, GenreFilmwork, PersonFilmwork
-
-logging.basicConfig(level=logging.INFO,
-    filename="etl.log",
-    filemode="w"
-    )
 logger = logging.getLogger(__name__)
 
 # Инициализация клиента Elasticsearch
 ES_SERVER_NAME = os.environ.get('ES_SERVER_NAME','localhost')
 es = Elasticsearch(f"http://{ES_SERVER_NAME}:9200")
 
-BATCH_SIZE = 300
+# Строк источника на один запрос к БД; память не зависит от него, его можно поднимать до десятков тысяч
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', 300))
+# Строки читаются серверным курсором порциями по STREAM_CHUNK_SIZE и идут дальше пачками того же размера:
+# в памяти одновременно не больше (PIPELINE_QUEUE_SIZE + 2) таких пачек
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 500))
 LOCK_FILE = "etl.lock"
 sleepSec = 60
+# 'notify' - прогон по уведомлениям Postgres (LISTEN/NOTIFY) и страховочный раз в SAFETY_POLL_SEC,
+# 'poll' - прежний режим: прогон каждые sleepSec секунд
+ETL_TRIGGER = os.environ.get('ETL_TRIGGER', 'notify')
+SAFETY_POLL_SEC = int(os.environ.get('SAFETY_POLL_SEC', 600))
+# Сколько секунд после первого уведомления копить следующие перед прогоном
+NOTIFY_DEBOUNCE_SEC = float(os.environ.get('NOTIFY_DEBOUNCE_SEC', 1))
+# 'document' - готовые документы фильмов одним запросом на пачку (etl.get_film_doc_by_*_cursor),
+# 'table' - документы из таблицы etl.film_document, которую Postgres поддерживает сам:
+#   прогон пересобирает только отмеченные триггерами фильмы и читает таблицу одним диапазоном,
+# 'orm' - прежний режим: сборка документа через ORM, по нескольку запросов на фильм
+FILM_EXTRACT_MODE = os.environ.get('FILM_EXTRACT_MODE', 'document')
+# Собирать изменённые фильмы из всех источников в один набор, чтобы каждый фильм
+# пересобирался и загружался один раз за цикл, а не по разу на каждый источник
+FILM_COALESCE = os.environ.get('FILM_COALESCE', 'True') == 'True'
+# 'partial' - переименование персоны/жанра обновляет только имена в уже загруженных фильмах
+# (update_by_query для персон, частичный update поля genres для жанров),
+# 'rebuild' - фильмы персоны/жанра пересобираются и загружаются целиком
+FILM_FANOUT = os.environ.get('FILM_FANOUT', 'partial')
+# 'incremental' - обычная работа по изменениям,
+# 'reindex' - сначала полная переиндексация в новые версионные индексы с переключением алиасов,
+# 'export' - то же через COPY ... TO STDOUT (для первой загрузки и восстановления),
+# 'replay' - загрузка файла EXPORT_FILE, записанного в режиме 'export',
+# 'reconcile' - сверка индексов с Postgres по диапазонам id и починка расходящихся документов; затем обычная работа
+ETL_MODE = os.environ.get('ETL_MODE', 'incremental')
+# Файл NDJSON для режимов 'export' (пустой - не писать) и 'replay'
+EXPORT_FILE = os.environ.get('EXPORT_FILE', '')
+# Предельный размер тела bulk-запроса в режимах 'export' и 'replay' (байт)
+EXPORT_BULK_BYTES = int(os.environ.get('EXPORT_BULK_BYTES', 10 * 1024 * 1024))
+REINDEX_BATCH_SIZE = int(os.environ.get('REINDEX_BATCH_SIZE', 2000))
+# Сверка ('reconcile'): диапазон не больше стольких документов сверяется по документам;
+# поля _source, которые не сверяются (через запятую)
+RECONCILE_LEAF_SIZE = int(os.environ.get('RECONCILE_LEAF_SIZE', 500))
+RECONCILE_IGNORE = os.environ.get('RECONCILE_IGNORE', 'updated_at')
+# Число реплик индексов после полной переиндексации
+ES_REPLICAS = int(os.environ.get('ES_REPLICAS', 1))
+# Число процессов-шардов: каждый обрабатывает свою часть фильмов (по хешу id)
+# со своими чекпоинтами; супервизор перезапускает упавшие и раз в SHARD_REPORT_SEC пишет отставание шардов
+ETL_SHARDS = int(os.environ.get('ETL_SHARDS', 1))
+SHARD_REPORT_SEC = int(os.environ.get('SHARD_REPORT_SEC', 30))
+# Чекпоинты дописываются в журнал etl_state.json.log и раз в STATE_COMPACT_EVERY записей сворачиваются в etl_state.json
+STATE_COMPACT_EVERY = int(os.environ.get('STATE_COMPACT_EVERY', 1000))
+# Хеши содержимого загруженных документов: неизменённые документы не отправляются в ES.
+# 'local' - SQLite-файл CONTENT_HASH_FILE (у каждого шарда свой, см. get_hash_file),
+# 'redis' - хеш в Redis (REDIS_HOST), 'off' - отправлять всё
+CONTENT_HASH = os.environ.get('CONTENT_HASH', 'local')
+CONTENT_HASH_FILE = os.environ.get('CONTENT_HASH_FILE', 'etl_hashes.sqlite')
+# Поля, не влияющие на хеш (через запятую)
+CONTENT_HASH_IGNORE = os.environ.get('CONTENT_HASH_IGNORE', 'updated_at')
+REDIS_HOST = os.environ.get('REDIS_HOST', 'redis://localhost:6379')
+# Метрики по HTTP: http://METRICS_HOST:METRICS_PORT/metrics (Prometheus) и /summary (сводка последнего цикла);
+# шард i слушает METRICS_PORT + i, 0 - не запускать
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9108))
+# Номер шарда текущего процесса (задаётся в run_shard)
+SHARD = 0
+# Параллельная загрузка в ES: число потоков bulk, начальный размер чанка,
+# целевая задержка одного bulk-запроса (с), число повторов и файл для отклонённых документов
+BULK_STREAMS = int(os.environ.get('BULK_STREAMS', 4))
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 500))
+BULK_TARGET_LATENCY = float(os.environ.get('BULK_TARGET_LATENCY', 1.0))
+BULK_MAX_RETRIES = int(os.environ.get('BULK_MAX_RETRIES', 5))
+DEAD_LETTER_FILE = os.environ.get('DEAD_LETTER_FILE', 'etl_dead_letter.jsonl')
+# Сколько раз ES сам повторяет частичное обновление, если документ одновременно изменила другая запись
+UPDATE_RETRY_ON_CONFLICT = int(os.environ.get('UPDATE_RETRY_ON_CONFLICT', 3))
+# Внешние версии документов (version_type=external_gte) из updated_at источника: ES отклоняет (409)
+# запись более старой версии поверх новой - от повтора или параллельного загрузчика
+EXTERNAL_VERSIONING = os.environ.get('EXTERNAL_VERSIONING', 'True') == 'True'
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# Сколько дней хранить журнал удалений etl.tombstone (12_postgres_etl_tombstone.sql), 0 - не чистить
+TOMBSTONE_RETENTION_DAYS = int(os.environ.get('TOMBSTONE_RETENTION_DAYS', 30))
+# Ёмкость очередей между стадиями extract -> transform -> load (в пачках)
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', 2))
+# 'psycopg' - запросы к Postgres напрямую через psycopg2, Django не загружается,
+# 'django' - через соединение Django; в режиме FILM_EXTRACT_MODE='orm' Django загружается всегда
+ETL_BACKEND = os.environ.get('ETL_BACKEND', 'psycopg')
+
+def setup_django():
+    import django
+    # Установите настройки Django
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+    django.setup()
+
+USE_DJANGO = ETL_BACKEND == 'django' or FILM_EXTRACT_MODE == 'orm'
+if USE_DJANGO:
+    setup_django()
+
+if ETL_BACKEND == 'django':
+    db = DjangoDatabase()
+else:
+    db = Database(get_connection_params())
+
+# Источник изменений: name - ключ чекпоинта (имя модели Django), table - таблица в схеме schema
+Source = namedtuple('Source', ['name', 'table', 'schema'], defaults=('content',))
+Genre = Source('Genre', 'genre')
+Person = Source('Person', 'person')
+Filmwork = Source('Filmwork', 'film_work')
+GenreFilmwork = Source('GenreFilmwork', 'genre_film_work')
+PersonFilmwork = Source('PersonFilmwork', 'person_film_work')
+# готовые документы фильмов (11_postgres_etl_film_document.sql)
+FilmDocument = Source('FilmDocument', 'film_document', 'etl')
+# журнал удалений (12_postgres_etl_tombstone.sql)
+Tombstone = Source('Tombstone', 'tombstone', 'etl')
 
 models = (
     Genre,
@@ -48,64 +161,208 @@ person_models = (
 genre_models = (
     Genre,
     )    
+
+# источники, изменения которых в режиме FILM_FANOUT='partial' доходят до фильмов частичными обновлениями
+fanout_models = (
+    Genre,
+    Person,
+    )
+
+# Позиция до первой строки: курсор (updated_at, id) в State хранится как {'updated_at': ISO-8601, 'id': uuid}
+INITIAL_POSITION = {'updated_at': '-infinity', 'id': '00000000-0000-0000-0000-000000000000'}
+
+# Ключ State с id документов, ушедших в dead-letter файл: {индекс: [id]}; они загружаются заново в начале цикла
+DEAD_LETTERS_KEY = 'dead_letters'
+
+PERSON_ROLES = ('directors', 'actors', 'writers')
+
+# Представления с готовыми документами для полной выгрузки (10_postgres_etl_export.sql)
+EXPORT_VIEWS = {
+    'movies': 'etl.movies_export',
+    'persons': 'etl.persons_export',
+    'genres': 'etl.genres_export',
+}
+
+# Заменяет имена персон из params.names (id -> имя) во вложенных списках, сортирует их
+# как etl.film_docs (по имени, затем по id) и пересобирает соответствующие *_names;
+# документ без изменений не переиндексируется.
+RENAME_PERSONS_SCRIPT = '''
+boolean changed = false;
+for (String role : params.roles) {
+  def people = ctx._source[role];
+  if (people == null) { continue; }
+  boolean renamed = false;
+  for (def person : people) {
+    if (params.names.containsKey(person.id) && person.name != params.names[person.id]) {
+      person.name = params.names[person.id];
+      renamed = true;
+    }
+  }
+  if (!renamed) { continue; }
+  changed = true;
+  people.sort((a, b) -> { int c = a.name.compareTo(b.name); return c != 0 ? c : a.id.compareTo(b.id); });
+  List names = new ArrayList();
+  for (def person : people) { names.add(person.name); }
+  ctx._source[role + '_names'] = names;
+}
+if (!changed) { ctx.op = 'noop'; }
+'''
     
-def extract_new_filmwork_records(model, combined_key, batch_size=BATCH_SIZE):
+metrics = Metrics()
+
+bulk_loader = BulkLoader(
+    es,
+    streams=BULK_STREAMS,
+    chunk_size=BULK_CHUNK_SIZE,
+    target_latency=BULK_TARGET_LATENCY,
+    max_retries=BULK_MAX_RETRIES,
+    dead_letter_file=DEAD_LETTER_FILE,
+    )
+
+def get_hash_file(shard, shards):
+    if shards == 1:
+        return CONTENT_HASH_FILE
+    name, ext = os.path.splitext(CONTENT_HASH_FILE)
+    return f'{name}.shard{shard}of{shards}{ext}'
+
+def get_hash_shard(key):
+    """Шард, который хранит хеш документа '<индекс>:<id>': фильмы - по id, персоны и жанры - шард 0."""
+    index, doc_id = key.split(':', 1)
+    return get_shard(doc_id) if index == 'movies' else 0
+
+def get_content_filter():
+    if CONTENT_HASH == 'redis':
+        store = RedisHashStore(redis.Redis.from_url(REDIS_HOST.replace('http://', 'redis://')))
+    elif CONTENT_HASH == 'local':
+        if ETL_SHARDS == 1:
+            store = SqliteHashStore(CONTENT_HASH_FILE)
+        else:
+            # шард пишет только в свой файл; чужие открываются, лишь когда нужно забыть хеши их фильмов
+            store = ShardedHashStore(lambda shard: SqliteHashStore(get_hash_file(shard, ETL_SHARDS)),
+                                     get_hash_shard, ETL_SHARDS)
+    else:
+        return None
+    return ContentFilter(store, ignore=[field for field in CONTENT_HASH_IGNORE.split(',') if field])
+
+content_filter = get_content_filter()
+
+def close_connections():
+    """Закрыть соединения с БД текущего потока."""
+    db.close()
+    if USE_DJANGO:
+        from django.db import connections
+        connections.close_all()
+
+def fetch_rows(sql, params=None):
+    """Выполнить запрос и вернуть строки как namedtuple (без создания моделей Django)."""
+    return db.fetch_rows(sql, params)
+
+def stream_rows(sql, params=None, itersize=STREAM_CHUNK_SIZE):
+    """Строки запроса как namedtuple, по мере чтения серверного (именованного) курсора."""
+    return db.stream_rows(sql, params, itersize)
+
+def split_rows(rows, size=STREAM_CHUNK_SIZE):
+    """Разбить поток строк на списки по size; (список, последний ли он)."""
+    rows = iter(rows)
+    chunk = list(itertools.islice(rows, size))
+    while chunk:
+        next_chunk = list(itertools.islice(rows, size))
+        yield chunk, not next_chunk
+        chunk = next_chunk
+
+def position_params(position, batch_size):
+    return [position['updated_at'], position['id'], batch_size]
+
+def next_position(rows):
+    """Позиция (updated_at, id) последней прочитанной строки источника; None - изменений больше нет."""
+    if not rows:
+        return None
+    return {'updated_at': rows[0].max_updated_at.isoformat(), 'id': str(rows[0].max_id)}
+
+# Функции etl.*_cursor(p_updated_at, p_id, p_batch_size) возвращают строки после позиции (updated_at, id)
+# и позицию последней прочитанной строки (max_updated_at, max_id) в каждой строке результата.
+# Строки с id = NULL только сдвигают позицию: источники изменились, но фильмов у них нет.
+CURSOR_ARGS = "%s::timestamptz, %s::uuid, %s"
+
+def stream_cursor_rows(function, position, batch_size):
+    """Поток строк функции etl.*_cursor и позиция после них (из первой строки: она во всех строках одна)."""
     wait_for_db()
-        
-    table_name=model._meta.db_table.lower().split('."')[1]
-           
-    objs = Filmwork.objects.raw(f"SELECT * FROM etl.get_film_work_by_{table_name}_key('{combined_key}', {batch_size});")
-    
-    # logger.info(str(objs.query)) 
 
-    return objs
-    
-def extract_new_person_records(model, combined_key, batch_size=BATCH_SIZE):
+    rows = stream_rows(f"SELECT * FROM etl.{function}({CURSOR_ARGS});", position_params(position, batch_size))
+    first = next(rows, None)
+    if first is None:
+        return iter(()), None
+    return (row for row in itertools.chain([first], rows) if row.id is not None), next_position([first])
+
+def extract_changed_film_ids(model, position, batch_size=BATCH_SIZE):
+    """Только id фильмов, затронутых изменениями модели, и позиция, до которой они прочитаны."""
     wait_for_db()
-    #return None
-    table_name=model._meta.db_table.lower().split('."')[1]
-           
-    objs = Person.objects.raw(f"SELECT * FROM etl.get_person_by_{table_name}_key('{combined_key}', {batch_size});")
-    
-    # logger.info(str(objs.query)) 
 
-    return objs
+    rows = fetch_rows(f"SELECT * FROM etl.get_film_ids_by_{model.table}_cursor({CURSOR_ARGS});",
+                      position_params(position, batch_size))
+
+    return [row.id for row in rows if row.id is not None], next_position(rows)
 
-def extract_new_genre_records(model, combined_key, batch_size=BATCH_SIZE):
+def extract_new_filmwork_records(model, position, batch_size=BATCH_SIZE):
+    film_ids, position = extract_changed_film_ids(model, position, batch_size)
+
+    return extract_filmworks_by_ids(film_ids), position
+
+def extract_new_film_docs(model, position, batch_size=BATCH_SIZE):
+    """Денормализованные документы фильмов: жанры и участники уже собраны в JSON на стороне БД."""
+    return stream_cursor_rows(f"get_film_doc_by_{model.table}_cursor", position, batch_size)
+
+def extract_film_docs_by_ids(film_ids):
     wait_for_db()
-    '''print(76)
-    from django.db import connection
-
-    with connection.cursor() as cursor:
-       cursor.execute("SELECT * FROM pg_proc WHERE proname = 'get_film_work_by_genre_film_work_key';")
-       rows = cursor.fetchall()
-       for row in rows:
-           print(83,row)
-   
-    with connection.cursor() as cursor:
-       cursor.execute("SELECT * FROM pg_proc WHERE proname = 'get_genre_by_genre_key';")
-       rows = cursor.fetchall()
-       for row in rows:
-           print(89,row)
-    return None'''
-    table_name=model._meta.db_table.lower().split('."')[1]
-           
-    objs = Genre.objects.raw(f"SELECT * FROM etl.get_genre_by_{table_name}_key('{combined_key}', {batch_size});")
-    #print(80,combined_key)
-    #objs = Genre.objects.raw(f"SELECT * FROM etl.get_genre_by_{table_name}_key('0', {batch_size});")
-    
-    # logger.info(str(objs.query)) 
+    return stream_rows("SELECT * FROM etl.get_film_docs(%s::uuid[]);", [[str(film_id) for film_id in film_ids]])
+
+def extract_filmworks_by_ids(film_ids):
+    from movies.models import Filmwork
 
-    return objs
+    wait_for_db()
+    return Filmwork.objects.filter(id__in=film_ids).iterator(chunk_size=STREAM_CHUNK_SIZE)
+
+def extract_new_person_records(model, position, batch_size=BATCH_SIZE):
+    return stream_cursor_rows(f"get_person_by_{model.table}_cursor", position, batch_size)
+
+def extract_new_genre_records(model, position, batch_size=BATCH_SIZE):
+    return stream_cursor_rows(f"get_genre_by_{model.table}_cursor", position, batch_size)
+
+def extract_persons_by_ids(person_ids):
+    wait_for_db()
+    return stream_rows("SELECT id, full_name, gender, updated_at FROM content.person WHERE id = ANY(%s::uuid[]);",
+                       [[str(person_id) for person_id in person_ids]])
+
+def extract_genres_by_ids(genre_ids):
+    wait_for_db()
+    return stream_rows("SELECT id, name, description, updated_at FROM content.genre WHERE id = ANY(%s::uuid[]);",
+                       [[str(genre_id) for genre_id in genre_ids]])
     
+def timestamp_version(updated_at):
+    """Версия документа из updated_at: микросекунды от начала эпохи (как version в etl.film_document)."""
+    return (updated_at - EPOCH) // timedelta(microseconds=1)
+
+def external_version(version):
+    """Метаданные bulk-действия с внешней версией; external_gte пропускает повторную запись той же версии."""
+    if not EXTERNAL_VERSIONING:
+        return {}
+    return {"_version": version, "_version_type": "external_gte"}
+
 def transform_filmworks(filmworks):
     transformed_data = []
 
     for filmwork in filmworks:
-        genres = [g.name for g in filmwork.genres.all()]
-        directors = [{"id": p.id, "name": p.full_name} for p in filmwork.persons.filter(personfilmwork__role='director')]
-        actors = [{"id": p.id, "name": p.full_name} for p in filmwork.persons.filter(personfilmwork__role='actor')]
-        writers = [{"id": p.id, "name": p.full_name} for p in filmwork.persons.filter(personfilmwork__role='writer')]
+        genre_objects = list(filmwork.genres.all())
+        # порядок как в etl.film_docs: по имени, затем по id
+        persons = {role: sorted(filmwork.persons.filter(personfilmwork__role=role), key=lambda p: (p.full_name, str(p.id)))
+                   for role in ('director', 'actor', 'writer')}
+        genres = [g.name for g in genre_objects]
+        directors = [{"id": p.id, "name": p.full_name} for p in persons['director']]
+        actors = [{"id": p.id, "name": p.full_name} for p in persons['actor']]
+        writers = [{"id": p.id, "name": p.full_name} for p in persons['writer']]
+        # как в etl.film_docs: самое позднее изменение фильма, его жанров и участников
+        updated_at = max([filmwork.updated_at] + [g.updated_at for g in genre_objects]
+                         + [p.updated_at for role in persons.values() for p in role])
         
         directors_names = [p['name'] for p in directors]
         actors_names = [p['name'] for p in actors]
@@ -123,16 +380,159 @@ def transform_filmworks(filmworks):
                 "directors": directors,
                 "actors": actors,
                 "writers": writers,
-                "updated_at": filmwork.updated_at.isoformat(),
+                "updated_at": updated_at.isoformat(),
             }
         transformed_data.append({
             "_index": "movies",
             "_id": str(filmwork.id),
-            "_source": row
+            "_source": row,
+            **external_version(timestamp_version(updated_at)),
+        })
+
+    return transformed_data
+
+def transform_film_docs(docs):
+    transformed_data = []
+
+    for doc in docs:
+        row = {
+                "id": str(doc.id),
+                "imdb_rating": doc.rating,
+                "genres": doc.genres,
+                "title": doc.title,
+                "description": doc.description,
+                "directors_names": [p['name'] for p in doc.directors],
+                "actors_names": [p['name'] for p in doc.actors],
+                "writers_names": [p['name'] for p in doc.writers],
+                "directors": doc.directors,
+                "actors": doc.actors,
+                "writers": doc.writers,
+                "updated_at": doc.updated_at.isoformat(),
+            }
+        transformed_data.append({
+            "_index": "movies",
+            "_id": str(doc.id),
+            "_source": row,
+            **external_version(timestamp_version(doc.updated_at)),
         })
 
     return transformed_data
 
+def refresh_film_documents():
+    """Пересобрать в etl.film_document все фильмы, отмеченные триггерами."""
+    wait_for_db()
+    refreshed = 0
+    while True:
+        count = fetch_rows("SELECT etl.refresh_film_documents(%s) count;", [BATCH_SIZE])[0].count
+        if not count:
+            break
+        refreshed += count
+    if refreshed:
+        logger.info(f"Film documents refreshed: {refreshed}")
+
+def extract_new_film_documents(model, position, batch_size=BATCH_SIZE):
+    """Готовые документы из etl.film_document, изменившиеся после позиции."""
+    return stream_cursor_rows("get_film_document_cursor", position, batch_size)
+
+def extract_film_documents_by_ids(film_ids):
+    wait_for_db()
+    return stream_rows("SELECT id, doc, version FROM etl.film_document WHERE id = ANY(%s::uuid[]);",
+                       [[str(film_id) for film_id in film_ids]])
+
+def transform_film_documents(rows):
+    return [{
+        "_index": "movies",
+        "_id": str(row.id),
+        "_source": row.doc,
+        **external_version(row.version),
+    } for row in rows]
+
+FILM_EXTRACT_MODES = {
+    'document': (extract_new_film_docs, extract_film_docs_by_ids, transform_film_docs),
+    'table': (extract_new_film_documents, extract_film_documents_by_ids, transform_film_documents),
+    'orm': (extract_new_filmwork_records, extract_filmworks_by_ids, transform_filmworks),
+}
+
+# Документ, затронутый удалением: строка etl.get_tombstone_cursor и текущий документ фильма (None - удалить)
+Removal = namedtuple('Removal', ['tombstone', 'document'])
+
+def extract_tombstones(model, position, batch_size=BATCH_SIZE):
+    """Удаления после позиции и текущие документы затронутых фильмов.
+
+    Фильм, у которого удалили связь, пересобирается; удалённый фильм документа не имеет.
+    Фильмы делятся по шардам, персоны и жанры ведёт шард 0.
+    """
+    wait_for_db()
+    # позиции получают только записи зафиксированных транзакций, в порядке вызовов
+    fetch_rows("SELECT etl.sequence_tombstones() count;")
+    rows, position = stream_cursor_rows("get_tombstone_cursor", position, batch_size)
+    rows = [row for row in rows if (in_shard(row.id) if row.es_index == 'movies' else SHARD == 0)]
+    film_ids = [row.id for row in rows if row.es_index == 'movies']
+    documents = {}
+    if film_ids:
+        _, extract_films_by_ids, _ = FILM_EXTRACT_MODES[FILM_EXTRACT_MODE]
+        documents = {str(document.id): document for document in extract_films_by_ids(film_ids)}
+    return [Removal(row, documents.get(str(row.id))) for row in rows], position
+
+def transform_tombstones(removals):
+    _, _, transform_films = FILM_EXTRACT_MODES[FILM_EXTRACT_MODE]
+    actions = transform_films([removal.document for removal in removals if removal.document is not None])
+    removed_at = {str(removal.tombstone.id): timestamp_version(removal.tombstone.version_at) for removal in removals}
+    for action in actions:
+        # удалённая связь могла быть самым поздним изменением фильма: версия не должна стать меньше
+        if '_version' in action:
+            action['_version'] = max(action['_version'], removed_at[action['_id']])
+    actions += [{
+        "_op_type": "delete",
+        "_index": removal.tombstone.es_index,
+        "_id": str(removal.tombstone.id),
+        **external_version(timestamp_version(removal.tombstone.version_at)),
+    } for removal in removals if removal.document is None]
+    return actions
+
+def purge_tombstones():
+    """Удалить из журнала удалений записи старше TOMBSTONE_RETENTION_DAYS."""
+    if not TOMBSTONE_RETENTION_DAYS or SHARD != 0:
+        return
+    count = fetch_rows("SELECT etl.purge_tombstones(%s * interval '1 day') count;", [TOMBSTONE_RETENTION_DAYS])[0].count
+    if count:
+        logger.info(f"Tombstones purged: {count}")
+
+def extract_film_genres(model, position, batch_size=BATCH_SIZE):
+    """Только поле genres фильмов, затронутых изменениями жанров."""
+    return stream_cursor_rows("get_film_genres_by_genre_cursor", position, batch_size)
+
+def transform_film_genres(rows):
+    return [{
+        "_op_type": "update",
+        "_index": "movies",
+        "_id": str(row.id),
+        "_retry_on_conflict": UPDATE_RETRY_ON_CONFLICT,
+        "doc": {"genres": row.genres},
+    } for row in rows]
+
+def transform_person_renames(persons):
+    """Один update_by_query на пачку персон вместо пересборки всех их фильмов."""
+    names = {str(person.id): person.full_name for person in persons}
+    if not names:
+        return []
+    return [{
+        "query": {
+            "bool": {
+                "should": [
+                    {"nested": {"path": role, "query": {"terms": {f"{role}.id": list(names)}}}}
+                    for role in PERSON_ROLES
+                ],
+                "minimum_should_match": 1,
+            }
+        },
+        "script": {
+            "source": RENAME_PERSONS_SCRIPT,
+            "lang": "painless",
+            "params": {"names": names, "roles": list(PERSON_ROLES)},
+        },
+    }]
+
 def transform_persons(persons):
     transformed_data = []
     for person in persons:
@@ -144,7 +544,8 @@ def transform_persons(persons):
         transformed_data.append({
             "_index": "persons",
             "_id": str(person.id),
-            "_source": row
+            "_source": row,
+            **external_version(timestamp_version(person.updated_at)),
         })
     return transformed_data
     
@@ -159,26 +560,68 @@ def transform_genres(genres):
         transformed_data.append({
             "_index": "genres",
             "_id": str(genre.id),
-            "_source": row
+            "_source": row,
+            **external_version(timestamp_version(genre.updated_at)),
         })
     return transformed_data
         
 def load(transformed_data):
     #logger.info(transformed_data)
     wait_for_es()
-    helpers.bulk(es, transformed_data, request_timeout=130)
+    return bulk_loader.load(transformed_data)
+
+def load_changed(actions):
+    """Загрузка без документов, которые уже лежат в ES с тем же содержимым."""
+    if content_filter is None:
+        return load(actions)
+    changed, hashes = content_filter.filter(actions)
+    bulk_loader.stats.add(unchanged=len(actions) - len(changed))
+    actions = changed
+    failed = load(actions) if actions else []
+    content_filter.commit(hashes, failed)
+    return failed
+
+def load_by_query(requests):
+    """update_by_query по запросам; документы, изменённые параллельной записью, обновляются повтором.
+
+    Скрипт идемпотентен: при повторе уже обновлённые документы не меняются (noop).
+    Запрос меняет документы в обход ContentFilter, поэтому хеши фильмов
+    переименованных персон забываются до него: следующая полная загрузка
+    этих фильмов не будет пропущена как неизменённая.
+    """
+    wait_for_es()
+    for body in requests:
+        forget_film_hashes(extract_film_ids_by_persons(list(body["script"]["params"]["names"])))
+        for attempt in range(BULK_MAX_RETRIES + 1):
+            response = es.options(request_timeout=130).update_by_query(
+                index="movies", query=body["query"], script=body["script"], conflicts='proceed')
+            logger.info(f"Updated by query: {response['updated']} of {response['total']}, "
+                        f"version conflicts: {response['version_conflicts']}")
+            metrics.inc('etl_docs_updated_by_query_total', response['updated'])
+            metrics.inc('etl_version_conflicts_total', response['version_conflicts'], kind='update_by_query')
+            if not response['version_conflicts']:
+                break
+
+def extract_film_ids_by_persons(person_ids):
+    wait_for_db()
+    rows = fetch_rows("SELECT DISTINCT film_work_id id FROM content.person_film_work WHERE person_id = ANY(%s::uuid[]);",
+                      [person_ids])
+    return [row.id for row in rows]
+
+def forget_film_hashes(film_ids):
+    """Забыть хеши содержимого фильмов, изменённых в ES в обход load_changed()."""
+    if content_filter is None or not film_ids:
+        return
+    content_filter.store.delete_many([f"movies:{film_id}" for film_id in film_ids])
 
 def wait_for_db(initial_interval=5, max_interval=300):
-    db_conn = connections['default']
-    params = db_conn.get_connection_params()
-    #logger.info(params)
     interval = initial_interval
 
     while True:
         try:
-            db_conn.ensure_connection()
+            db.ensure_connection()
             break
-        except OperationalError:
+        except db.OperationalError:
             logger.info(f"PostgreSQL is unavailable - sleeping for {interval} seconds")
             time.sleep(interval)
             interval = min(max_interval, interval * 2)  # Удвоение интервала до максимума
@@ -209,64 +652,571 @@ def release_lock(lock_file):
     fcntl.flock(lock_file, fcntl.LOCK_UN)
     lock_file.close()
 
+# load=None - bulk-загрузка через load_changed()
+Stream = namedtuple('Stream', ['index', 'model', 'extract', 'transform', 'load'], defaults=(None,))
+Batch = namedtuple('Batch', ['stream', 'checkpoints', 'records', 'actions'])
+
+def get_streams():
+    """Потоки изменений: (индекс ES, модель-источник изменений, extract, transform)."""
+    extract_films, _, transform_films = FILM_EXTRACT_MODES[FILM_EXTRACT_MODE]
+    streams = []
+    if FILM_EXTRACT_MODE == 'table':
+        streams.append(Stream('movies', FilmDocument, extract_shard(extract_films), transform_films))
+    elif not is_coalescing():
+        streams += [Stream('movies', model, extract_films, transform_films) for model in get_film_models()]
+    # удаления: фильмы делит по шардам сам extract_tombstones
+    streams.append(Stream('movies', Tombstone, extract_tombstones, transform_tombstones))
+    if SHARD != 0:
+        # персоны, жанры и частичные обновления не делятся по фильмам - их ведёт шард 0
+        return streams
+    # в режиме 'table' переименования уже учтены в документах таблицы
+    if FILM_FANOUT == 'partial' and FILM_EXTRACT_MODE != 'table':
+        streams.append(Stream('movies', Person, extract_new_person_records, transform_person_renames, load_by_query))
+        streams.append(Stream('movies', Genre, extract_film_genres, transform_film_genres))
+    streams += [Stream('persons', model, extract_new_person_records, transform_persons) for model in person_models]
+    streams += [Stream('genres', model, extract_new_genre_records, transform_genres) for model in genre_models]
+    return streams
+
+def is_coalescing():
+    # в таблице документов фильм и так один; иначе шарды фильтруют фильмы по id, а это возможно только в change set
+    if FILM_EXTRACT_MODE == 'table':
+        return False
+    return FILM_COALESCE or ETL_SHARDS > 1
+
+def get_shard(film_id):
+    return uuid.UUID(str(film_id)).int % ETL_SHARDS
+
+def in_shard(film_id):
+    return get_shard(film_id) == SHARD
+
+def extract_shard(extract):
+    """Extract, оставляющий только фильмы текущего шарда."""
+    if ETL_SHARDS == 1:
+        return extract
+
+    def extract_in_shard(model, position, batch_size=BATCH_SIZE):
+        records, position = extract(model, position, batch_size)
+        return (record for record in records if in_shard(record.id)), position
+    return extract_in_shard
+
+def get_film_models():
+    """Источники, изменения которых приводят к полной пересборке фильмов."""
+    if FILM_EXTRACT_MODE == 'table':
+        return (FilmDocument,)
+    if FILM_FANOUT == 'partial':
+        return tuple(model for model in models if model not in fanout_models)
+    return models
+
+def get_state_key(stream):
+    # для фильмов ключи прежние, чтобы не потерять сохранённые чекпоинты
+    if stream.index == 'movies':
+        return stream.model.name
+    return f"{stream.index}:{stream.model.name}"
+
+def get_position(state_key):
+    state_dict = state.get_state(state_key)
+    if state_dict and 'cursor' in state_dict:
+        return state_dict['cursor']
+    # прежний текстовый last_processed_combined_key не переводим: его порядок не хронологический
+    return INITIAL_POSITION
+
+def extract_film_change_sets():
+    """Стадия change set: фильмы, затронутые изменениями во всех источниках.
+
+    За один шаг из каждого источника берётся до BATCH_SIZE изменений, id фильмов
+    объединяются без повторов, и каждый фильм собирается один раз.
+    Документы читаются серверным курсором и идут пачками по STREAM_CHUNK_SIZE.
+    Чекпоинты всех источников передаются с последней пачкой набора
+    и сохраняются вместе после её загрузки.
+    """
+    _, extract_films_by_ids, transform_films = FILM_EXTRACT_MODES[FILM_EXTRACT_MODE]
+    stream = Stream('movies', Filmwork, extract_films_by_ids, transform_films)
+    # позиции чтения ведём локально: чекпоинты в State отстают на пачки, ещё стоящие в очередях
+    film_models = get_film_models()
+    positions = {model.name: get_position(model.name) for model in film_models}
+    while True:
+        film_ids = set()
+        checkpoints = {}
+        for model in film_models:
+            ids, position = extract_changed_film_ids(model, positions[model.name])
+            if position:
+                checkpoints[model.name] = position
+                film_ids.update(film_id for film_id in ids if in_shard(film_id))
+        if not checkpoints:
+            return
+        positions.update(checkpoints)
+
+        yield from split_batches(stream, extract_films_by_ids(sorted(film_ids)) if film_ids else [], checkpoints)
+
+def split_batches(stream, records, checkpoints):
+    """Поток записей - пачки по STREAM_CHUNK_SIZE; чекпоинты едут с последней."""
+    empty = True
+    for chunk, is_last in split_rows(records):
+        empty = False
+        yield Batch(stream, checkpoints if is_last else {}, chunk, None)
+    if empty:
+        # пустая пачка тоже нужна: она сохраняет чекпоинты источников без записей
+        yield Batch(stream, checkpoints, [], None)
+
+def extract_batches():
+    """Стадия extract: пачки всех потоков по очереди, пока есть изменения."""
+    if is_coalescing():
+        yield from extract_film_change_sets()
+    for stream in get_streams():
+        state_key = get_state_key(stream)
+        position = get_position(state_key)
+        while True:
+            records, position = stream.extract(stream.model, position)
+            if position is None:
+                break
+            yield from split_batches(stream, records, {state_key: position})
+
+def transform_batch(batch):
+    metrics.inc('etl_rows_extracted_total', len(batch.records), index=batch.stream.index)
+    with metrics.timer('transform'):
+        return batch._replace(records=None, actions=batch.stream.transform(batch.records))
+
+def load_batch(batch):
+    """Стадия load: чекпоинты сдвигаются только после загрузки пачки.
+
+    Документы, окончательно отклонённые ES (записанные в dead-letter файл),
+    не держат чекпоинт: их id сохраняются вместе с ним под DEAD_LETTERS_KEY,
+    и retry_dead_letters() загружает их заново в следующих циклах.
+    Конфликты версий (409) ошибкой не считаются.
+    """
+    dead_letters = bulk_loader.stats.dead_letters
+    with metrics.timer('load'):
+        (batch.stream.load or load_changed)(batch.actions)
+    changes = {state_key: {'cursor': position} for state_key, position in batch.checkpoints.items()}
+    if bulk_loader.stats.dead_letters > dead_letters:
+        changes[DEAD_LETTERS_KEY] = add_dead_letters(state.get_state(DEAD_LETTERS_KEY), bulk_loader.dead_lettered)
+        logger.error(f"{batch.stream.index}: {bulk_loader.stats.dead_letters - dead_letters} documents "
+                     f"are not loaded (see {DEAD_LETTER_FILE}), they will be retried next cycle")
+    # чекпоинты пачки сохраняются одной записью
+    state.set_states(changes)
+    for state_key, position in batch.checkpoints.items():
+        logger.info(f"Processed: {state_key}: {position['updated_at']} {position['id']}")
+        metrics.set('etl_indexed_updated_at_seconds', datetime.fromisoformat(position['updated_at']).timestamp(),
+                    source=state_key)
+
+def add_dead_letters(recorded, actions):
+    """Id документов dead-letter (recorded) вместе с id отклонённых действий actions."""
+    dead_letters = {index: set(ids) for index, ids in (recorded or {}).items()}
+    for action in actions:
+        dead_letters.setdefault(action['_index'], set()).add(str(action['_id']))
+    return {index: sorted(ids) for index, ids in dead_letters.items() if ids}
+
+def retry_dead_letters():
+    """Загрузить заново документы, ранее ушедшие в dead-letter файл, в их текущем виде из Postgres.
+
+    Документы, которых в Postgres больше нет, удаляются. Снова отклонённые
+    остаются под DEAD_LETTERS_KEY до следующего цикла.
+    """
+    recorded = state.get_state(DEAD_LETTERS_KEY)
+    if not recorded:
+        return
+    sources = get_sources_by_ids()
+    dead_lettered = []
+    for index, ids in recorded.items():
+        extract_by_ids, transform = sources[index]
+        for chunk, _ in split_rows(ids, BATCH_SIZE):
+            actions = transform(extract_by_ids(chunk))
+            found = {action['_id'] for action in actions}
+            actions += [{"_op_type": "delete", "_index": index, "_id": doc_id} for doc_id in chunk if doc_id not in found]
+            load_changed(actions)
+            dead_lettered += bulk_loader.dead_lettered
+    remaining = add_dead_letters({}, dead_lettered)
+    state.set_state(DEAD_LETTERS_KEY, remaining)
+    retried = sum(len(ids) for ids in recorded.values())
+    logger.info(f"Dead letters retried: {retried}, still rejected: {sum(len(ids) for ids in remaining.values())}")
+
+def get_sources_by_ids():
+    """Чтение и преобразование документов по списку id для каждого индекса."""
+    _, extract_films_by_ids, transform_films = FILM_EXTRACT_MODES[FILM_EXTRACT_MODE]
+    return {
+        'movies': (extract_films_by_ids, transform_films),
+        'persons': (extract_persons_by_ids, transform_persons),
+        'genres': (extract_genres_by_ids, transform_genres),
+    }
+
 def etl_process():
     lock_file = acquire_lock()
+    bulk_loader.stats.reset()
+    metrics.begin_cycle()
     try:
-        #outer loop (batch loop)
+        if FILM_EXTRACT_MODE == 'table':
+            with metrics.timer('refresh'):
+                refresh_film_documents()
+        retry_dead_letters()
+        Pipeline(
+            source=lambda: metrics.timed('extract', extract_batches()),
+            stages=[transform_batch],
+            sink=load_batch,
+            queue_size=PIPELINE_QUEUE_SIZE,
+            thread_cleanup=close_connections,
+        ).run()
+        purge_tombstones()
+        logger.info("No more data to process. ETL-process finished.")
+    finally:
+        logger.info(f"Load stats: {bulk_loader.stats.summary()}")
+        log_cycle_summary()
+        release_lock(lock_file)
+
+def log_cycle_summary():
+    """Перенести счётчики загрузки в метрики и записать сводку цикла одной JSON-строкой."""
+    load_stats = bulk_loader.stats.summary()
+    metrics.inc('etl_docs_loaded_total', load_stats['docs'])
+    metrics.inc('etl_docs_unchanged_total', load_stats['unchanged'])
+    metrics.inc('etl_version_conflicts_total', load_stats['conflicts'])
+    metrics.inc('etl_bulk_requests_total', load_stats['requests'])
+    metrics.inc('etl_bulk_retried_total', load_stats['retried'])
+    metrics.inc('etl_bulk_errors_total', load_stats['rejected'], kind='rejected')
+    metrics.inc('etl_bulk_errors_total', load_stats['dead_letters'], kind='dead_letter')
+    try:
+        lag = get_lag()
+    except db.OperationalError as error:
+        logger.info(f"Lag is unavailable: {error}")
+        lag = {}
+    for source, seconds in lag.items():
+        if seconds is not None:
+            metrics.set('etl_lag_seconds', seconds, source=source)
+    summary = metrics.end_cycle(lag_seconds=lag)
+    logger.info(f"Cycle summary: {json.dumps(summary)}")
+
+def extract_all_batches(streams, batch_size=REINDEX_BATCH_SIZE):
+    """Стадия extract полной переиндексации: все строки источников с начала, без чекпоинтов."""
+    for stream in streams:
+        position = INITIAL_POSITION
         while True:
-            for model in models:#inner loop (model loop)                
-                # get last_processed_combined_key for model from stored state
-                last_processed_combined_key=None
-                state_dict = state.get_state(model.__name__)
-                if state_dict:
-                    combined_key = state_dict['last_processed_combined_key']
-                else:
-                    combined_key = ''
-                
-                # process filmworks
-                filmwork_objs = extract_new_filmwork_records(model,combined_key)
-                if filmwork_objs:
-                    last_processed_combined_key = filmwork_objs[0].max_in_combined_key
-                    
-                    transformed_data = transform_filmworks(filmwork_objs)
-                
-                    load(transformed_data)
-                
-                # process persons
-                if model in person_models:
-                    person_objs = extract_new_person_records(model, combined_key)
-                    if person_objs:
-                        transformed_data = transform_persons(person_objs)
-                        load(transformed_data)
-                        
-                # process genres
-                if model in genre_models:
-                    genre_objs = extract_new_genre_records(model, combined_key)
-                    if genre_objs:
-                        transformed_data = transform_genres(genre_objs)
-                        load(transformed_data)                        
-                # is this the end?
-                if not filmwork_objs:
-                    logger.info("No more data to process. ETL-process finished.")
-                    break# this inner, then outer loops
-                
-                # store last_processed_combined_key
-                
-                state.set_state(model.__name__, {
-                    'last_processed_combined_key':last_processed_combined_key
-                    }
-                )
-                logger.info(f"Processed: {model.__name__}: {last_processed_combined_key}")
-            else:
-                continue# outer loop, normal continuation
-            break# outer loop after inner loop breaked
+            records, position = stream.extract(stream.model, position, batch_size)
+            if position is None:
+                break
+            yield from split_batches(stream, records, {})
+
+@contextmanager
+def rebuild_indices(names, stats):
+    """Новые версионные индексы для полной пересборки.
+
+    Алиасы переключаются на них, если блок завершился без ошибок
+    и ни один документ не ушёл в dead-letter файл; иначе недозагруженные
+    индексы удаляются, а алиасы остаются на прежних индексах. После
+    переключения чекпоинты всех шардов отматываются к началу пересборки:
+    изменения, сделанные во время неё, могли попасть только в прежние
+    индексы и применятся к новым следующим прогоном.
+    """
+    lock_file = acquire_lock()
+    stats.reset()
+    if content_filter is not None:
+        # новые индексы заполняются целиком: хеши прежних документов больше не подтверждают содержимое ES
+        content_filter.store.clear()
+    wait_for_db()
+    started_at = fetch_rows("SELECT clock_timestamp() started_at;")[0].started_at
+    wait_for_es()
+    indices = {
+        name: VersionedIndex(es, name, es_schema.SETTINGS, es_schema.MAPPINGS[name], replicas=ES_REPLICAS)
+        for name in names
+    }
+    try:
+        for index in indices.values():
+            index.create()
+        yield indices
+        if stats.dead_letters:
+            raise BulkLoadError(f"Reindex: {stats.dead_letters} documents are not loaded (see {DEAD_LETTER_FILE}), "
+                                f"aliases are not switched")
+        for index in indices.values():
+            index.publish()
+        rewind_checkpoints(started_at)
+    except BaseException:
+        for index in indices.values():
+            if not index.published:
+                index.drop()
+        raise
     finally:
-        release_lock(lock_file)            
+        logger.info(f"Load stats: {stats.summary()}")
+        release_lock(lock_file)
 
-if __name__ == "__main__":
-    storage = JsonFileStorage('etl_state.json')
-    state = State(storage)
+def rewind_checkpoints(started_at):
+    """Отмотать чекпоинты всех шардов, ушедшие дальше started_at, к позиции (started_at, нулевой id)."""
+    position = {'updated_at': started_at.isoformat(), 'id': INITIAL_POSITION['id']}
+    for shard in range(ETL_SHARDS):
+        shard_state = State(get_state_storage(get_state_file(shard, ETL_SHARDS)))
+        changes = {}
+        for key, value in shard_state.current_state.items():
+            cursor = value.get('cursor') if isinstance(value, dict) else None
+            if cursor is None or cursor['updated_at'] == INITIAL_POSITION['updated_at']:
+                continue
+            if datetime.fromisoformat(cursor['updated_at']) >= started_at:
+                changes[key] = dict(value, cursor=position)
+        shard_state.set_states(changes)
+        if changes:
+            logger.info(f"Shard {shard}: checkpoints rewound to {position['updated_at']}: {sorted(changes)}")
+
+def full_reindex():
+    """Полная переиндексация без простоя: версионные индексы и атомарное переключение алиасов."""
+    extract_films, _, transform_films = FILM_EXTRACT_MODES[FILM_EXTRACT_MODE]
+    streams = [
+        Stream('movies', Filmwork, extract_films, transform_films),
+        Stream('persons', Person, extract_new_person_records, transform_persons),
+        Stream('genres', Genre, extract_new_genre_records, transform_genres),
+    ]
+    with rebuild_indices([stream.index for stream in streams], bulk_loader.stats) as indices:
+        if FILM_EXTRACT_MODE == 'table':
+            refresh_film_documents()
+
+        def transform_to_new_indices(batch):
+            batch = transform_batch(batch)
+            for action in batch.actions:
+                action['_index'] = indices[action['_index']].name
+            return batch
+
+        def load_to_new_indices(batch):
+            failed = load(batch.actions)
+            if failed:
+                raise BulkLoadError(f"Reindex: {len(failed)} documents are not loaded")
+
+        Pipeline(
+            source=lambda: extract_all_batches(streams),
+            stages=[transform_to_new_indices],
+            sink=load_to_new_indices,
+            queue_size=PIPELINE_QUEUE_SIZE,
+            thread_cleanup=close_connections,
+        ).run()
+    logger.info("Full reindex finished.")
+
+def full_export():
+    """Полная пересборка индексов выгрузкой COPY ... TO STDOUT прямо в тела bulk-запросов.
+
+    Без постраничных запросов: скорость ограничена сетью и диском.
+    При заданном EXPORT_FILE тот же NDJSON (с именами алиасов) пишется в файл для replay_export().
+    """
+    exporter = get_exporter()
+    export_file = open(EXPORT_FILE, 'w') if EXPORT_FILE else None
+    try:
+        with rebuild_indices(EXPORT_VIEWS, exporter.stats) as indices:
+            wait_for_db()
+            try:
+                for name, index in indices.items():
+                    with exporter.writer(index.name, export_file, file_index=name) as writer:
+                        db.copy_to(copy_sql(EXPORT_VIEWS[name]), writer)
+                    exporter.flush()
+                    logger.info(f"Exported {name} to {index.name}")
+            finally:
+                # при сбое COPY или загрузки отправки не должны писать в индексы, которые rebuild_indices удалит
+                exporter.cancel()
+    finally:
+        if export_file is not None:
+            export_file.close()
+    logger.info("Full export finished.")
+
+def replay_export():
+    """Загрузить в текущие индексы NDJSON-файл EXPORT_FILE, записанный full_export()."""
+    exporter = get_exporter()
+    lock_file = acquire_lock()
+    try:
+        wait_for_es()
+        with open(EXPORT_FILE) as file:
+            exporter.replay(file)
+        logger.info(f"Replayed {EXPORT_FILE}")
+    finally:
+        logger.info(f"Load stats: {exporter.stats.summary()}")
+        release_lock(lock_file)
+
+def without_version(actions):
+    """Действия без внешней версии: запись текущего документа поверх любой версии в индексе."""
+    for action in actions:
+        action.pop('_version', None)
+        action.pop('_version_type', None)
+    return actions
+
+def reconcile():
+    """Сверка индексов с Postgres по диапазонам id; расходящиеся документы загружаются заново через load().
+
+    Документы Postgres читаются через COPY из представлений полной выгрузки,
+    в ES сравниваются число документов и дайджесты диапазонов (reconcile.RangeReconciler).
+    Лишние в ES документы удаляются. Починка пишется без внешней версии: версия
+    расходящегося документа в индексе может быть выше выводимой сейчас из Postgres.
+    """
+    repairs = get_sources_by_ids()
+    ignore = [field for field in RECONCILE_IGNORE.split(',') if field]
+    lock_file = acquire_lock()
+    bulk_loader.stats.reset()
+    try:
+        wait_for_db()
+        wait_for_es()
+        if FILM_EXTRACT_MODE == 'table':
+            refresh_film_documents()
+        for name, view in EXPORT_VIEWS.items():
+            with DigestWriter(ignore) as writer:
+                db.copy_to(copy_sql(view), writer)
+            reconciler = RangeReconciler(es, name, writer.digests, ignore, leaf_size=RECONCILE_LEAF_SIZE)
+            stale, extra = reconciler.diff()
+            logger.info(f"Reconcile {name}: {len(writer.digests)} documents, {reconciler.ranges} ranges "
+                        f"in {reconciler.requests} requests, {len(stale)} to reload, {len(extra)} to delete")
+            extract_by_ids, transform = repairs[name]
+            failed = []
+            for chunk, _ in split_rows(stale, BATCH_SIZE):
+                failed += load(without_version(transform(extract_by_ids(chunk))))
+            for chunk, _ in split_rows(extra, BATCH_SIZE):
+                failed += load([{"_op_type": "delete", "_index": name, "_id": doc_id} for doc_id in chunk])
+            if failed:
+                logger.error(f"Reconcile {name}: {len(failed)} of {len(stale) + len(extra)} documents "
+                             f"are not repaired (see {DEAD_LETTER_FILE})")
+            if content_filter is not None and (stale or extra):
+                # хеши загруженного расходились с индексом: не полагаемся на них
+                content_filter.store.delete_many([f"{name}:{doc_id}" for doc_id in stale + extra])
+    finally:
+        logger.info(f"Load stats: {bulk_loader.stats.summary()}")
+        release_lock(lock_file)
+    logger.info("Reconcile finished.")
+
+def get_exporter():
+    return NdjsonExporter(
+        es,
+        streams=BULK_STREAMS,
+        max_bytes=EXPORT_BULK_BYTES,
+        max_retries=BULK_MAX_RETRIES,
+        dead_letter_file=DEAD_LETTER_FILE,
+        external_versioning=EXTERNAL_VERSIONING,
+    )
+
+def run_on_notify():
+    """Запускать ETL сразу после изменений в источнике, а без них - раз в SAFETY_POLL_SEC."""
+    wait_for_db()
+    listener = ChangeListener(db.get_connection_params())
+    # подписываемся до первого прогона, чтобы не пропустить изменения во время него
+    listener.listen()
+    try:
+        while True:
+            etl_process()
+            changes = listener.wait(timeout=SAFETY_POLL_SEC, debounce=NOTIFY_DEBOUNCE_SEC)
+            if changes:
+                logger.info(f"Notified: {len(changes)} changes")
+    finally:
+        listener.close()
+
+def run_forever():
+    if ETL_TRIGGER == 'notify':
+        run_on_notify()
+    else:
+        while True:
+            etl_process()
+            # Ждем 1 минуту обновлений в источнике
+            time.sleep(sleepSec)
+
+def setup_logging(filemode="a", format=logging.BASIC_FORMAT):
+    logging.basicConfig(level=logging.INFO,
+        filename="etl.log",
+        filemode=filemode,
+        format=format,
+        force=True
+        )
+
+def get_state_file(shard, shards):
+    if shards == 1:
+        return 'etl_state.json'
+    return f'etl_state.shard{shard}of{shards}.json'
+
+def get_state_storage(file_path):
+    return JsonLogStorage(file_path, compact_every=STATE_COMPACT_EVERY)
+
+def run_shard(shard, shards):
+    """Точка входа процесса-шарда: свои чекпоинты, lock-файл и только свои фильмы."""
+    global state, SHARD, LOCK_FILE
+    setup_logging(format=f"%(levelname)s:shard{shard}:%(name)s:%(message)s")
+    SHARD = shard
+    LOCK_FILE = f"etl.shard{shard}.lock"
+    state = State(get_state_storage(get_state_file(shard, shards)))
+    start_metrics_server(METRICS_PORT + shard if METRICS_PORT else 0)
+    run_forever()
+
+def start_metrics_server(port):
+    if not port:
+        return
+    try:
+        metrics.serve(METRICS_HOST, port)
+    except OSError as error:
+        logger.error(f"Metrics server is not started: {error}")
+
+def get_lag_seconds(newest_updated_at, state_dict):
+    if newest_updated_at is None:
+        return 0.0
+    if not state_dict or 'cursor' not in state_dict:
+        # шард ещё не сохранил ни одного чекпоинта
+        return None
+    indexed_updated_at = datetime.fromisoformat(state_dict['cursor']['updated_at'])
+    return max(0.0, (newest_updated_at - indexed_updated_at).total_seconds())
+
+def get_newest_updated_at(models):
+    return {
+        model: fetch_rows(f"SELECT max(updated_at) updated_at FROM {model.schema}.{model.table};")[0].updated_at
+        for model in set(models)
+    }
+
+def get_lag():
+    """Отставание по чекпоинтам (с): самое новое updated_at источника минус сохранённое в чекпоинте.
+
+    Растёт, только пока изменения источника не проиндексированы; время
+    от последнего проиндексированного изменения - etl_indexed_updated_at_seconds.
+    """
+    sources = {}
+    if is_coalescing():
+        sources.update({model.name: model for model in get_film_models()})
+    sources.update({get_state_key(stream): stream.model for stream in get_streams()})
+    newest = get_newest_updated_at(sources.values())
+    return {key: get_lag_seconds(newest[model], state.get_state(key)) for key, model in sources.items()}
+
+def get_shard_lag(shards):
+    """Отставание шардов (с): самое новое updated_at источника минус сохранённое в чекпоинте шарда."""
+    wait_for_db()
+    newest = {model.name: updated_at for model, updated_at in get_newest_updated_at(get_film_models()).items()}
+    lag = {}
+    for shard in range(shards):
+        # журнал шарда пишет его процесс: только читаем, не обрезая недописанную строку
+        shard_state = get_state_storage(get_state_file(shard, shards)).peek_state()
+        lag[shard] = {name: get_lag_seconds(updated_at, shard_state.get(name)) for name, updated_at in newest.items()}
+    return lag
+
+def supervise_shards(shards):
+    """Запустить процессы-шарды, перезапускать упавшие и периодически сообщать их отставание."""
+    context = multiprocessing.get_context('spawn')
+    workers = {}
+
+    def start(shard):
+        process = context.Process(target=run_shard, args=(shard, shards), name=f"etl-shard-{shard}", daemon=True)
+        process.start()
+        workers[shard] = process
+
+    # соединения с БД не должны переходить в дочерние процессы
+    db.close_all()
+    for shard in range(shards):
+        start(shard)
     while True:
-        etl_process()
-        # Ждем 1 минуту обновлений в источнике
-        time.sleep(sleepSec)
\ No newline at end of file
+        time.sleep(SHARD_REPORT_SEC)
+        for shard, process in list(workers.items()):
+            if not process.is_alive():
+                logger.error(f"Shard {shard} exited with code {process.exitcode}. Restarting.")
+                start(shard)
+        try:
+            for shard, lag in get_shard_lag(shards).items():
+                logger.info(f"Shard {shard} lag, seconds: {lag}")
+        finally:
+            db.close_all()
+
+if __name__ == "__main__":
+    setup_logging()
+    if ETL_MODE == 'reindex':
+        full_reindex()
+    elif ETL_MODE == 'export':
+        full_export()
+    elif ETL_MODE == 'replay':
+        replay_export()
+    elif ETL_MODE == 'reconcile':
+        reconcile()
+    if ETL_SHARDS > 1:
+        # у супервизора своих чекпоинтов нет: журнал каждого шарда пишет только процесс шарда
+        supervise_shards(ETL_SHARDS)
+    else:
+        # чекпоинты читаются после пересборки: она могла их отмотать
+        state = State(get_state_storage(get_state_file(0, 1)))
+        start_metrics_server(METRICS_PORT)
+        run_forever()
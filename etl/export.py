@@ -0,0 +1,262 @@
+import io
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, List, Optional, TextIO, Tuple
+
+from elasticsearch import ApiError, ConnectionError, ConnectionTimeout, Elasticsearch
+
+from loader import RETRY_STATUSES, LoadStats, is_version_conflict
+
+logger = logging.getLogger(__name__)
+
+# Разделители COPY в формате CSV, которых не бывает в тексте JSON: строки выходят без экранирования
+COPY_OPTIONS = "FORMAT csv, DELIMITER e'\\x02', QUOTE e'\\x01'"
+COPY_DELIMITER = '\x02'
+# Версия документа без updated_at (NULL в COPY - пустая строка): старше любой настоящей
+NULL_VERSION = '0'
+
+# Пара строк NDJSON: действие и документ
+Item = Tuple[str, str]
+
+
+def copy_sql(view: str) -> str:
+    """COPY представления (id, doc, version) в поток: одна строка - id, внешняя версия и готовый JSON документа."""
+    return f"COPY (SELECT id, version, doc FROM {view}) TO STDOUT WITH ({COPY_OPTIONS})"
+
+
+class NdjsonExporter:
+    """Массовая выгрузка в Elasticsearch готовыми телами bulk-запросов (NDJSON).
+
+    Строки COPY ... TO STDOUT превращаются в NDJSON без разбора JSON
+    в Python и копятся в тело запроса до max_bytes; тела отправляются
+    в несколько потоков, не больше 2 * streams одновременно. Тот же
+    NDJSON можно писать в файл и потом загрузить его повторно (replay).
+    Элементы с 429/5xx повторяются с экспоненциальной задержкой, прочие
+    отказы пишутся в dead-letter файл в формате BulkLoader.
+    С external_versioning документы пишутся с внешней версией (external_gte),
+    и повторная загрузка старого файла не затирает более новые документы:
+    такие элементы (409) только считаются.
+    """
+
+    def __init__(
+        self,
+        es: Elasticsearch,
+        streams: int = 4,
+        max_bytes: int = 10 * 1024 * 1024,
+        max_retries: int = 5,
+        initial_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        request_timeout: int = 130,
+        dead_letter_file: str = 'etl_dead_letter.jsonl',
+        external_versioning: bool = True,
+    ) -> None:
+        """
+        Args:
+            es: Клиент Elasticsearch.
+            streams: Число параллельных bulk-запросов.
+            max_bytes: Предельный размер тела одного bulk-запроса.
+            max_retries: Число повторов отклонённых элементов.
+            initial_backoff: Первая задержка перед повтором (с).
+            max_backoff: Предельная задержка перед повтором (с).
+            request_timeout: Таймаут bulk-запроса (с).
+            dead_letter_file: Файл для окончательно отклонённых документов.
+            external_versioning: Писать документы с внешней версией из COPY.
+        """
+        self.es = es.options(request_timeout=request_timeout)
+        self.max_bytes = max_bytes
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.dead_letter_file = dead_letter_file
+        self.external_versioning = external_versioning
+        self.stats = LoadStats()
+        self._executor = ThreadPoolExecutor(max_workers=streams, thread_name_prefix='export')
+        self._slots = threading.BoundedSemaphore(2 * streams)
+        self._lock = threading.Lock()
+        self._futures: List[Future] = []
+
+    def writer(self, index: str, file: Optional[TextIO] = None, file_index: Optional[str] = None) -> 'CopyWriter':
+        """Файлоподобный приёмник для cursor.copy_expert().
+
+        Args:
+            index: Индекс, в который идут документы.
+            file: Куда дополнительно писать NDJSON (None - не писать).
+            file_index: Имя индекса в файле (по умолчанию index), например алиас вместо версионного индекса.
+        """
+        return CopyWriter(self, index, file, file_index or index)
+
+    def replay(self, file: TextIO) -> None:
+        """Загрузить NDJSON-файл, записанный writer(file=...)."""
+        items: List[Item] = []
+        size = 0
+        try:
+            for action in file:
+                source = next(file)
+                items.append((action, source))
+                size += len(action) + len(source)
+                if size >= self.max_bytes:
+                    self.send(items)
+                    items, size = [], 0
+            if items:
+                self.send(items)
+            self.flush()
+        finally:
+            self.cancel()
+
+    def send(self, items: List[Item]) -> None:
+        """Отправить пачку в фоне; при всех занятых потоках - подождать."""
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._load, items)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        with self._lock:
+            self._futures.append(future)
+
+    def flush(self) -> None:
+        """Дождаться всех отправок; исключение первой неудачной."""
+        with self._lock:
+            futures, self._futures = self._futures, []
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def cancel(self) -> None:
+        """Отменить ещё не начатые отправки и дождаться идущих (после сбоя посреди выгрузки)."""
+        with self._lock:
+            futures, self._futures = self._futures, []
+        for future in futures:
+            future.cancel()
+        for future in futures:
+            if not future.cancelled() and future.exception() is not None:
+                logger.error(f"Export: cancelled after a failure, bulk request failed too: {future.exception()!r}")
+
+    def _load(self, items: List[Item]) -> None:
+        attempt = 0
+        while items:
+            retry, error = self._send(items)
+            if not retry:
+                return
+            attempt += 1
+            if attempt > self.max_retries:
+                if error is not None:
+                    raise error
+                self._dead_letter(retry)
+                return
+            self.stats.add(retried=len(retry))
+            time.sleep(min(self.max_backoff, self.initial_backoff * 2 ** (attempt - 1)))
+            items = [item for item, _ in retry]
+
+    def _send(self, items: List[Item]) -> Tuple[List[Tuple[Item, Any]], Optional[Exception]]:
+        """Один bulk-запрос; элементы для повтора и ошибка транспорта, если была."""
+        body = ''.join(action + source for action, source in items).encode()
+        try:
+            response = self.es.bulk(operations=body)
+        except (ConnectionError, ConnectionTimeout) as error:
+            return [(item, error) for item in items], error
+        except ApiError as error:
+            if error.meta.status not in RETRY_STATUSES:
+                raise
+            self.stats.add(requests=1, rejected=len(items))
+            return [(item, error) for item in items], None
+
+        retry = []
+        dead = []
+        conflicts = 0
+        rejected = 0
+        if response['errors']:
+            for item, result in zip(items, response['items']):
+                result = next(iter(result.values()))
+                status = result.get('status', 500)
+                if 200 <= status < 300:
+                    continue
+                if status == 409 and is_version_conflict(result.get('error')):
+                    # в индексе документ не старше: replay старого файла его не затирает
+                    conflicts += 1
+                elif status in RETRY_STATUSES:
+                    rejected += status == 429
+                    retry.append((item, result.get('error')))
+                else:
+                    dead.append((item, result.get('error')))
+        self.stats.add(requests=1, docs=len(items) - len(retry) - len(dead) - conflicts,
+                       conflicts=conflicts, rejected=rejected)
+        if dead:
+            self._dead_letter(dead)
+        return retry, None
+
+    def _dead_letter(self, failed: List[Tuple[Item, Any]]) -> None:
+        with self._lock:
+            with open(self.dead_letter_file, 'a') as file:
+                for (action, source), error in failed:
+                    meta = json.loads(action)['index']
+                    record = {'_index': meta['_index'], '_id': meta['_id'], '_source': json.loads(source)}
+                    if 'version' in meta:
+                        record.update(_version=meta['version'], _version_type=meta['version_type'])
+                    file.write(json.dumps({'action': record, 'error': error}, default=str) + '\n')
+        self.stats.add(dead_letters=len(failed))
+        logger.error(f"Export: {len(failed)} items written to {self.dead_letter_file}")
+
+
+class CopyWriter(io.TextIOBase):
+    """Приёмник COPY: строки 'id<0x02>version<0x02>doc' -> пары строк NDJSON в тела bulk-запросов и в файл."""
+
+    def __init__(self, exporter: NdjsonExporter, index: str, file: Optional[TextIO], file_index: str) -> None:
+        self.exporter = exporter
+        self.index = json.dumps(index)
+        self.file = file
+        self.file_index = json.dumps(file_index)
+        self._tail = ''
+        self._items: List[Item] = []
+        self._size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        if isinstance(data, bytes):
+            data = data.decode()
+        lines = (self._tail + data).split('\n')
+        self._tail = lines.pop()
+        for line in lines:
+            self._add(line)
+        return len(data)
+
+    def __exit__(self, exc_type: Any, *args: Any) -> None:
+        if exc_type is not None:
+            # COPY оборвался: недочитанный остаток не отправляется
+            self._tail = ''
+            self._items, self._size = [], 0
+        super().__exit__(exc_type, *args)
+
+    def close(self) -> None:
+        """Отправить остаток; документы уходят в ES, но ответы ждёт exporter.flush()."""
+        if self.closed:
+            return
+        if self._tail:
+            self._add(self._tail)
+            self._tail = ''
+        if self._items:
+            self.exporter.send(self._items)
+            self._items, self._size = [], 0
+        super().close()
+
+    def _add(self, line: str) -> None:
+        doc_id, version, source = line.split(COPY_DELIMITER, 2)
+        version = version or NULL_VERSION
+        source += '\n'
+        meta = f',"version":{version},"version_type":"external_gte"' if self.exporter.external_versioning else ''
+        action = f'{{"index":{{"_index":{self.index},"_id":"{doc_id}"{meta}}}}}\n'
+        if self.file is not None:
+            self.file.write(f'{{"index":{{"_index":{self.file_index},"_id":"{doc_id}"{meta}}}}}\n')
+            self.file.write(source)
+        self._items.append((action, source))
+        self._size += len(action) + len(source)
+        if self._size >= self.exporter.max_bytes:
+            self.exporter.send(self._items)
+            self._items, self._size = [], 0
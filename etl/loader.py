@@ -0,0 +1,213 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from elasticsearch import ApiError, ConnectionError, ConnectionTimeout, Elasticsearch, helpers
+
+logger = logging.getLogger(__name__)
+
+# Статусы, при которых элемент (или весь запрос) имеет смысл повторить
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+class BulkLoadError(Exception):
+    """Документы не загрузились окончательно (записаны в dead-letter файл)."""
+
+
+def is_version_conflict(error: Any) -> bool:
+    """Элемент отклонён, потому что в индексе версия документа не старше."""
+    return isinstance(error, dict) and error.get('type') == 'version_conflict_engine_exception'
+
+
+class LoadStats:
+    """Счётчики загрузки за один прогон ETL."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        self.started = time.monotonic()
+        self.docs = 0
+        self.unchanged = 0
+        self.conflicts = 0
+        self.requests = 0
+        self.rejected = 0
+        self.retried = 0
+        self.dead_letters = 0
+
+    def add(self, **counters: int) -> None:
+        with self._lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def summary(self) -> Dict[str, Any]:
+        elapsed = time.monotonic() - self.started
+        return {
+            'docs': self.docs,
+            'seconds': round(elapsed, 3),
+            'docs_per_sec': round(self.docs / elapsed, 1) if elapsed else 0.0,
+            'unchanged': self.unchanged,
+            'conflicts': self.conflicts,
+            'requests': self.requests,
+            'rejected': self.rejected,
+            'retried': self.retried,
+            'dead_letters': self.dead_letters,
+        }
+
+
+class BulkLoader:
+    """Параллельная загрузка в Elasticsearch с адаптивным размером пачки.
+
+    Действия делятся на чанки, которые отправляются в несколько потоков.
+    Размер чанка растёт, пока ES отвечает быстрее target_latency и без отказов,
+    и уменьшается при медленных ответах и 429 (AIMD). Повторяются только
+    не загрузившиеся элементы, с экспоненциальной задержкой; окончательно
+    отклонённые элементы пишутся построчно (JSON) в dead-letter файл.
+    Конфликт версий (409) - не ошибка: в индексе уже более новый документ,
+    такие элементы только считаются. Частичное обновление (update) с 409
+    не устарело, а разошлось с параллельной записью документа: оно повторяется.
+    """
+
+    def __init__(
+        self,
+        es: Elasticsearch,
+        streams: int = 4,
+        chunk_size: int = 500,
+        min_chunk_size: int = 50,
+        max_chunk_size: int = 5000,
+        target_latency: float = 1.0,
+        max_retries: int = 5,
+        initial_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        request_timeout: int = 130,
+        dead_letter_file: str = 'etl_dead_letter.jsonl',
+    ) -> None:
+        self.es = es.options(request_timeout=request_timeout)
+        self.streams = streams
+        self.chunk_size = chunk_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.dead_letter_file = dead_letter_file
+        self.stats = LoadStats()
+        self._lock = threading.Lock()
+        # действия, ушедшие в dead-letter файл при последнем load()
+        self.dead_lettered: List[Dict[str, Any]] = []
+        self._conflicts: List[Dict[str, Any]] = []
+        self._executor = ThreadPoolExecutor(max_workers=streams, thread_name_prefix='bulk')
+
+    def load(self, actions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Загрузить действия; исключение - только если ES недоступен после всех повторов.
+
+        Возвращает не загрузившиеся действия: записанные в dead-letter файл
+        (они же - в dead_lettered) и отклонённые из-за более новой версии в индексе.
+        """
+        self.dead_lettered = []
+        self._conflicts = []
+        pending = list(actions)
+        attempt = 0
+        while pending:
+            retry: List[Tuple[Dict[str, Any], Any]] = []
+            for failed in self._executor.map(self._send_chunk, self._split(pending)):
+                retry += failed
+            if not retry:
+                return self.dead_lettered + self._conflicts
+
+            attempt += 1
+            if attempt > self.max_retries:
+                errors = [error for _, error in retry if isinstance(error, Exception)]
+                if errors:
+                    raise errors[-1]
+                self._dead_letter(retry)
+                return self.dead_lettered + self._conflicts
+
+            self.stats.add(retried=len(retry))
+            sleep = min(self.max_backoff, self.initial_backoff * 2 ** (attempt - 1))
+            logger.info(f"Bulk: retrying {len(retry)} items in {sleep} seconds (attempt {attempt})")
+            time.sleep(sleep)
+            pending = [action for action, _ in retry]
+
+    def _split(self, actions: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        # чанков не меньше, чем потоков, иначе небольшая пачка уйдёт одним запросом
+        size = min(self.chunk_size, max(self.min_chunk_size, -(-len(actions) // self.streams)))
+        return [actions[i:i + size] for i in range(0, len(actions), size)]
+
+    def _send_chunk(self, chunk: List[Dict[str, Any]]) -> List[Tuple[Dict[str, Any], Any]]:
+        """Отправить чанк; вернуть элементы для повтора вместе с причиной."""
+        operations = []
+        for action in chunk:
+            op, source = helpers.expand_action(action)
+            operations.append(op)
+            if source is not None:
+                operations.append(source)
+
+        started = time.monotonic()
+        try:
+            response = self.es.bulk(operations=operations)
+        except (ConnectionError, ConnectionTimeout) as error:
+            self._adapt(time.monotonic() - started, rejected=True)
+            return [(action, error) for action in chunk]
+        except ApiError as error:
+            if error.meta.status not in RETRY_STATUSES:
+                raise
+            self.stats.add(requests=1, rejected=len(chunk))
+            self._adapt(time.monotonic() - started, rejected=True)
+            return [(action, error) for action in chunk]
+
+        retry = []
+        dead = []
+        conflicts = []
+        rejected = 0
+        for action, item in zip(chunk, response['items']):
+            result = next(iter(item.values()))
+            status = result.get('status', 500)
+            if 200 <= status < 300:
+                continue
+            if status == 404 and 'update' in item:
+                # частичное обновление ещё не загруженного документа: он придёт целиком своим потоком
+                continue
+            if status == 404 and 'delete' in item:
+                # документа уже нет
+                continue
+            if status == 409 and 'update' not in item and is_version_conflict(result.get('error')):
+                conflicts.append(action)
+            elif status in RETRY_STATUSES or (status == 409 and 'update' in item):
+                rejected += status == 429
+                retry.append((action, result.get('error')))
+            else:
+                dead.append((action, result.get('error')))
+
+        self.stats.add(requests=1, docs=len(chunk) - len(retry) - len(dead) - len(conflicts),
+                       conflicts=len(conflicts), rejected=rejected)
+        if conflicts:
+            with self._lock:
+                self._conflicts += conflicts
+        self._adapt(time.monotonic() - started, rejected=bool(rejected))
+        if dead:
+            self._dead_letter(dead)
+        return retry
+
+    def _adapt(self, latency: float, rejected: bool) -> None:
+        with self._lock:
+            if rejected:
+                self.chunk_size = max(self.min_chunk_size, self.chunk_size // 2)
+            elif latency > self.target_latency:
+                self.chunk_size = max(self.min_chunk_size, int(self.chunk_size * 0.75))
+            else:
+                self.chunk_size = min(self.max_chunk_size, self.chunk_size + self.min_chunk_size)
+
+    def _dead_letter(self, failed: List[Tuple[Dict[str, Any], Optional[Any]]]) -> None:
+        with self._lock:
+            self.dead_lettered += [action for action, _ in failed]
+            with open(self.dead_letter_file, 'a') as file:
+                for action, error in failed:
+                    file.write(json.dumps({'action': action, 'error': error}, default=str) + '\n')
+        self.stats.add(dead_letters=len(failed))
+        logger.error(f"Bulk: {len(failed)} items written to {self.dead_letter_file}")
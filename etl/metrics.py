@@ -0,0 +1,176 @@
+import bisect
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterable, Iterator, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм длительности стадий (с)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Гистограмма с накопительными корзинами, как в Prometheus."""
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    """Метрики ETL в памяти процесса.
+
+    Гистограммы длительности стадий (etl_stage_seconds{stage=...}),
+    счётчики (*_total) и показатели (gauge). Отдаются по HTTP в текстовом
+    формате Prometheus (/metrics) и сводкой последнего цикла в JSON (/summary).
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.stages: Dict[str, Histogram] = defaultdict(Histogram)
+        self.counters: Dict[Tuple[str, Labels], float] = defaultdict(float)
+        self.gauges: Dict[Tuple[str, Labels], float] = {}
+        self.last_summary: Dict[str, Any] = {}
+        self._cycle_started = time.monotonic()
+        self._cycle_counters: Dict[Tuple[str, Labels], float] = {}
+        self._cycle_stages: Dict[str, Tuple[int, float]] = {}
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.stages[stage].observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.monotonic() - started)
+
+    def timed(self, stage: str, iterable: Iterable[Any]) -> Iterator[Any]:
+        """Итерация с замером времени получения каждого элемента (для стадии-генератора)."""
+        iterator = iter(iterable)
+        while True:
+            started = time.monotonic()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.observe(stage, time.monotonic() - started)
+            yield item
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        with self._lock:
+            self.counters[(name, _labels(labels))] += value
+
+    def set(self, name: str, value: float, **labels: Any) -> None:
+        with self._lock:
+            self.gauges[(name, _labels(labels))] = value
+
+    def begin_cycle(self) -> None:
+        """Запомнить значения на начало цикла: сводка считается по разнице."""
+        with self._lock:
+            self._cycle_started = time.monotonic()
+            self._cycle_counters = dict(self.counters)
+            self._cycle_stages = {stage: (hist.count, hist.sum) for stage, hist in self.stages.items()}
+
+    def end_cycle(self, **extra: Any) -> Dict[str, Any]:
+        """Сводка цикла: длительность, счётчики и скорость за цикл, время стадий; extra добавляется как есть."""
+        with self._lock:
+            seconds = time.monotonic() - self._cycle_started
+            totals: Dict[str, float] = defaultdict(float)
+            for key, value in self.counters.items():
+                delta = value - self._cycle_counters.get(key, 0)
+                if delta:
+                    totals[key[0]] += delta
+            stages = {}
+            for stage, hist in self.stages.items():
+                count, total = self._cycle_stages.get(stage, (0, 0.0))
+                if hist.count > count:
+                    stages[stage] = {
+                        'count': hist.count - count,
+                        'seconds': round(hist.sum - total, 3),
+                        'avg_seconds': round((hist.sum - total) / (hist.count - count), 4),
+                    }
+        summary: Dict[str, Any] = {'seconds': round(seconds, 3)}
+        for name, value in totals.items():
+            summary[name] = value
+        for name in ('etl_rows_extracted_total', 'etl_docs_loaded_total'):
+            summary[name.replace('_total', '_per_sec')] = round(totals.get(name, 0) / seconds, 1) if seconds else 0.0
+        summary['stages'] = stages
+        summary.update(extra)
+        self.last_summary = summary
+        return summary
+
+    def render(self) -> str:
+        """Текстовый формат Prometheus."""
+        lines = []
+        with self._lock:
+            lines.append('# TYPE etl_stage_seconds histogram')
+            for stage, hist in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, count in zip(hist.buckets + (float('inf'),), hist.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'etl_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'etl_stage_seconds_sum{{stage="{stage}"}} {hist.sum}')
+                lines.append(f'etl_stage_seconds_count{{stage="{stage}"}} {hist.count}')
+            for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f'# TYPE {name} {kind}')
+                    for (metric, labels), value in sorted(values.items()):
+                        if metric == name:
+                            lines.append(f'{name}{_format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, host: str, port: int) -> ThreadingHTTPServer:
+        """Запустить HTTP-сервер метрик в фоновом потоке."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path == '/metrics':
+                    body, content_type = metrics.render(), 'text/plain; version=0.0.4'
+                elif self.path == '/summary':
+                    body, content_type = json.dumps(metrics.last_summary, default=str), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                data = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        logger.info(f"Metrics: http://{host}:{port}/metrics")
+        return server
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
@@ -0,0 +1,81 @@
+import json
+import logging
+import select
+import time
+from typing import Any, Dict, List
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'etl_changes'
+
+
+class ChangeListener:
+    """Ожидание уведомлений Postgres (LISTEN/NOTIFY) об изменениях в данных.
+
+    Использует отдельное соединение в режиме autocommit; пока уведомлений нет,
+    процесс спит в select() и не нагружает ни Postgres, ни себя.
+    """
+
+    def __init__(self, connection_params: Dict[str, Any], channel: str = NOTIFY_CHANNEL) -> None:
+        """
+        Args:
+            connection_params: Параметры psycopg2.connect().
+            channel: Канал, который слушает ETL.
+        """
+        self.connection_params = connection_params
+        self.channel = channel
+        self._conn = None
+
+    def listen(self) -> None:
+        """Подписаться на канал; уведомления копятся в соединении до вызова wait()."""
+        self._conn = psycopg2.connect(**self.connection_params)
+        self._conn.set_session(autocommit=True)
+        with self._conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {self.channel};")
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def wait(self, timeout: float, debounce: float = 1.0) -> List[Dict[str, Any]]:
+        """Дождаться изменений.
+
+        Возвращает уведомления, пришедшие за timeout секунд; после первого
+        уведомления ещё debounce секунд собирает следующие, чтобы серия правок
+        обрабатывалась одним прогоном ETL. Пустой список - уведомлений не было
+        (или соединение было потеряно) и пора выполнить страховочный прогон.
+        """
+        try:
+            if self._conn is None:
+                self.listen()
+            changes = self._collect(timeout)
+            if changes and debounce:
+                changes += self._collect(debounce, wait_all=True)
+            return changes
+        except psycopg2.OperationalError as error:
+            logger.info(f"LISTEN connection lost: {error}")
+            self.close()
+            time.sleep(min(timeout, 5))
+            return []
+
+    def _collect(self, timeout: float, wait_all: bool = False) -> List[Dict[str, Any]]:
+        changes = []
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return changes
+            if select.select([self._conn], [], [], remaining) == ([], [], []):
+                return changes
+            self._conn.poll()
+            while self._conn.notifies:
+                notify = self._conn.notifies.pop(0)
+                try:
+                    changes.append(json.loads(notify.payload))
+                except ValueError:
+                    changes.append({'payload': notify.payload})
+            if changes and not wait_all:
+                return changes
@@ -0,0 +1,127 @@
+import logging
+import queue
+import threading
+from typing import Any, Callable, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SIZE = 2
+POLL_INTERVAL = 0.5
+
+# Маркер конца потока данных
+_DONE = object()
+
+
+class Pipeline:
+    """Конвейер ETL.
+
+    Источник и каждая промежуточная стадия работают в отдельных потоках
+    и связаны ограниченными очередями: пока одна пачка загружается,
+    следующая уже извлекается и преобразуется. Заполненная очередь
+    блокирует предыдущую стадию (backpressure), поэтому в памяти
+    одновременно находится не больше queue_size пачек на стадию.
+
+    Последняя стадия (sink) выполняется в вызывающем потоке и получает
+    пачки строго в порядке их извлечения.
+    """
+
+    def __init__(
+        self,
+        source: Callable[[], Iterable[Any]],
+        stages: List[Callable[[Any], Any]],
+        sink: Callable[[Any], None],
+        queue_size: int = QUEUE_SIZE,
+        thread_cleanup: Optional[Callable[[], None]] = None,
+    ) -> None:
+        """
+        Args:
+            source: Функция, возвращающая итератор пачек.
+            stages: Промежуточные стадии, каждая преобразует одну пачку.
+            sink: Завершающая стадия (загрузка, сохранение состояния).
+            queue_size: Ёмкость каждой очереди между стадиями.
+            thread_cleanup: Вызывается при завершении каждого рабочего потока
+                (например, чтобы закрыть соединения с БД этого потока).
+        """
+        self.source = source
+        self.stages = stages
+        self.sink = sink
+        self.queue_size = queue_size
+        self.thread_cleanup = thread_cleanup
+        self._stop = threading.Event()
+        self._errors: List[BaseException] = []
+
+    def _fail(self, error: BaseException) -> None:
+        self._errors.append(error)
+        self._stop.set()
+
+    def _put(self, out_queue: queue.Queue, item: Any) -> bool:
+        while not self._stop.is_set():
+            try:
+                out_queue.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, in_queue: queue.Queue) -> Any:
+        while not self._stop.is_set():
+            try:
+                return in_queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _cleanup(self) -> None:
+        if self.thread_cleanup:
+            self.thread_cleanup()
+
+    def _run_source(self, out_queue: queue.Queue) -> None:
+        try:
+            for item in self.source():
+                if not self._put(out_queue, item):
+                    return
+            self._put(out_queue, _DONE)
+        except BaseException as error:
+            logger.exception("Pipeline source failed")
+            self._fail(error)
+        finally:
+            self._cleanup()
+
+    def _run_stage(self, stage: Callable, in_queue: queue.Queue, out_queue: queue.Queue) -> None:
+        try:
+            while True:
+                item = self._get(in_queue)
+                if item is _DONE:
+                    self._put(out_queue, _DONE)
+                    return
+                if not self._put(out_queue, stage(item)):
+                    return
+        except BaseException as error:
+            logger.exception("Pipeline stage %s failed", getattr(stage, '__name__', stage))
+            self._fail(error)
+        finally:
+            self._cleanup()
+
+    def run(self) -> None:
+        """Прогнать все пачки источника через стадии; ошибка любой стадии пробрасывается."""
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._run_source, args=(queues[0],), daemon=True)]
+        for i, stage in enumerate(self.stages):
+            threads.append(threading.Thread(
+                target=self._run_stage, args=(stage, queues[i], queues[i + 1]), daemon=True))
+
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = self._get(queues[-1])
+                if item is _DONE:
+                    break
+                self.sink(item)
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+
+        if self._errors:
+            raise self._errors[0]
@@ -0,0 +1,257 @@
+import bisect
+import hashlib
+import io
+import json
+import logging
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List, Tuple
+
+from elasticsearch import Elasticsearch
+
+from export import COPY_DELIMITER
+
+logger = logging.getLogger(__name__)
+
+HEX_DIGITS = '0123456789abcdef'
+# Позиции дефисов в текстовом uuid
+UUID_HYPHENS = (8, 13, 18, 23)
+UUID_LENGTH = 36
+# Больше любого символа uuid: [prefix, prefix + PREFIX_END) - все id с префиксом
+PREFIX_END = '~'
+
+# Те же canonical() и digest(), что в Python ниже: каноническая строка документа
+# (ключи по порядку, числа как Java Double.toString) и первые 32 бита её SHA-256
+DIGEST_FUNCTIONS = '''
+String canonical(def value) {
+  if (value == null) { return 'null'; }
+  if (value instanceof Map) {
+    List keys = new ArrayList(value.keySet());
+    Collections.sort(keys);
+    StringBuilder b = new StringBuilder('{');
+    for (def key : keys) { b.append(key).append(':').append(canonical(value.get(key))).append(','); }
+    return b.append('}').toString();
+  }
+  if (value instanceof List) {
+    StringBuilder b = new StringBuilder('[');
+    for (def item : value) { b.append(canonical(item)).append(','); }
+    return b.append(']').toString();
+  }
+  if (value instanceof Boolean) { return value.toString(); }
+  if (value instanceof Number) { return Double.toString(value.doubleValue()); }
+  return value.toString();
+}
+long digest(Map source, List ignore) {
+  Map body = new HashMap(source);
+  for (def key : ignore) { body.remove(key); }
+  return Long.parseLong(canonical(body).sha256().substring(0, 8), 16);
+}
+'''
+
+RANGE_DIGEST_AGG = {
+    'init_script': 'state.count = 0L; state.sum = 0L;',
+    'map_script': DIGEST_FUNCTIONS + 'state.count += 1; state.sum += digest(params[\'_source\'], params.ignore);',
+    'combine_script': 'return [state.count, state.sum];',
+    'reduce_script': '''
+long count = 0; long sum = 0;
+for (s in states) { if (s != null) { count += ((Number) s[0]).longValue(); sum += ((Number) s[1]).longValue(); } }
+return [count, sum];
+''',
+}
+
+DOC_DIGEST_SCRIPT = DIGEST_FUNCTIONS + 'return digest(params[\'_source\'], params.ignore);'
+
+
+def java_double(value: float) -> str:
+    """Double.toString() из Java: кратчайшая запись, вне [1e-3, 1e7) - с экспонентой."""
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return 'Infinity' if value > 0 else '-Infinity'
+    if value == 0 or 1e-3 <= abs(value) < 1e7:
+        return repr(value)
+    sign, digits, exponent = Decimal(repr(value)).normalize().as_tuple()
+    mantissa = ''.join(map(str, digits))
+    return f"{'-' if sign else ''}{mantissa[0]}.{mantissa[1:] or '0'}E{exponent + len(digits) - 1}"
+
+
+def canonical(value: Any) -> str:
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, dict):
+        # ключи в порядке Java String.compareTo: по UTF-16 кодовым единицам, а не по кодовым точкам
+        keys = sorted(value, key=lambda key: key.encode('utf-16-be', 'surrogatepass'))
+        return '{' + ''.join(f'{key}:{canonical(value[key])},' for key in keys) + '}'
+    if isinstance(value, list):
+        return '[' + ''.join(f'{canonical(item)},' for item in value) + ']'
+    if isinstance(value, (int, float)):
+        return java_double(float(value))
+    return str(value)
+
+
+def document_digest(source: Dict[str, Any], ignore: Iterable[str] = ()) -> int:
+    """32-битный дайджест документа; в ES тот же считает DIGEST_FUNCTIONS."""
+    body = {key: value for key, value in source.items() if key not in ignore}
+    return int(hashlib.sha256(canonical(body).encode()).hexdigest()[:8], 16)
+
+
+def child_prefixes(prefix: str) -> List[str]:
+    """Поддиапазоны диапазона id с префиксом prefix: следующий символ uuid."""
+    if len(prefix) in UUID_HYPHENS:
+        return [prefix + '-']
+    return [prefix + digit for digit in HEX_DIGITS]
+
+
+class DigestWriter(io.TextIOBase):
+    """Приёмник COPY представления (id, version, doc): дайджест каждого документа."""
+
+    def __init__(self, ignore: Iterable[str] = ()) -> None:
+        self.ignore = tuple(ignore)
+        self.digests: Dict[str, int] = {}
+        self._tail = ''
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        if isinstance(data, bytes):
+            data = data.decode()
+        lines = (self._tail + data).split('\n')
+        self._tail = lines.pop()
+        for line in lines:
+            self._add(line)
+        return len(data)
+
+    def close(self) -> None:
+        if self._tail:
+            self._add(self._tail)
+            self._tail = ''
+        super().close()
+
+    def _add(self, line: str) -> None:
+        doc_id, _, source = line.split(COPY_DELIMITER, 2)
+        self.digests[doc_id] = document_digest(json.loads(source), self.ignore)
+
+
+class RangeReconciler:
+    """Сверка индекса Elasticsearch с документами Postgres по диапазонам id, как в дереве Меркла.
+
+    Пространство id делится по префиксам текстового uuid (16 поддиапазонов
+    на уровень). Для диапазона сравниваются число документов и сумма их
+    дайджестов: в Postgres - по дайджестам в памяти, в ES - одной агрегацией
+    на уровень (scripted_metric по _source). Дальше делятся только
+    расходящиеся диапазоны; в небольших диапазонах (до leaf_size документов)
+    сравниваются дайджесты отдельных документов.
+    """
+
+    def __init__(
+        self,
+        es: Elasticsearch,
+        index: str,
+        digests: Dict[str, int],
+        ignore: Iterable[str] = (),
+        leaf_size: int = 500,
+        max_ranges: int = 256,
+        request_timeout: int = 600,
+    ) -> None:
+        """
+        Args:
+            es: Клиент Elasticsearch.
+            index: Индекс (или алиас) для сверки.
+            digests: Дайджесты документов Postgres: id -> document_digest().
+            ignore: Поля _source, не входящие в дайджест.
+            leaf_size: Диапазон не больше стольких документов сверяется по документам.
+            max_ranges: Предельное число диапазонов в одном запросе агрегации.
+            request_timeout: Таймаут запросов к ES (с).
+        """
+        self.es = es.options(request_timeout=request_timeout)
+        self.index = index
+        self.digests = digests
+        self.ignore = list(ignore)
+        self.leaf_size = leaf_size
+        self.max_ranges = max_ranges
+        self.ids = sorted(digests)
+        # суммы дайджестов нарастающим итогом: сумма диапазона - разность двух элементов
+        self._sums = [0]
+        for doc_id in self.ids:
+            self._sums.append(self._sums[-1] + digests[doc_id])
+        self.requests = 0
+        self.ranges = 0
+
+    def diff(self) -> Tuple[List[str], List[str]]:
+        """id для переиндексации (нет в ES или содержимое другое) и id лишних в ES документов."""
+        stale: List[str] = []
+        extra: List[str] = []
+        pending = ['']
+        while pending:
+            remote = self._remote_ranges(pending)
+            next_level = []
+            for prefix in pending:
+                local = self._local_range(prefix)
+                if local == remote[prefix]:
+                    continue
+                if len(prefix) == UUID_LENGTH or max(local[0], remote[prefix][0]) <= self.leaf_size:
+                    self._diff_leaf(prefix, stale, extra)
+                else:
+                    next_level += child_prefixes(prefix)
+            pending = next_level
+        return stale, extra
+
+    def _bounds(self, prefix: str) -> Tuple[int, int]:
+        return bisect.bisect_left(self.ids, prefix), bisect.bisect_left(self.ids, prefix + PREFIX_END)
+
+    def _local_range(self, prefix: str) -> Tuple[int, int]:
+        low, high = self._bounds(prefix)
+        return high - low, self._sums[high] - self._sums[low]
+
+    def _remote_ranges(self, prefixes: List[str]) -> Dict[str, Tuple[int, int]]:
+        """Число документов и сумма дайджестов диапазонов в ES, по max_ranges диапазонов на запрос."""
+        result = {}
+        for start in range(0, len(prefixes), self.max_ranges):
+            chunk = prefixes[start:start + self.max_ranges]
+            response = self.es.search(index=self.index, size=0, aggs={
+                'ranges': {
+                    'filters': {'filters': {f'r{prefix}': self._query(prefix) for prefix in chunk}},
+                    'aggs': {'digest': {'scripted_metric': dict(RANGE_DIGEST_AGG, params={'ignore': self.ignore})}},
+                },
+            })
+            self.requests += 1
+            buckets = response['aggregations']['ranges']['buckets']
+            for prefix in chunk:
+                bucket = buckets[f'r{prefix}']
+                count, total = bucket['digest']['value'] if bucket['doc_count'] else (0, 0)
+                result[prefix] = (int(count), int(total))
+        self.ranges += len(prefixes)
+        return result
+
+    def _diff_leaf(self, prefix: str, stale: List[str], extra: List[str]) -> None:
+        low, high = self._bounds(prefix)
+        local = {doc_id: self.digests[doc_id] for doc_id in self.ids[low:high]}
+        remote = {}
+        search_after = None
+        while True:
+            response = self.es.search(
+                index=self.index,
+                query=self._query(prefix),
+                sort=[{'id': 'asc'}],
+                size=self.leaf_size,
+                source=False,
+                script_fields={'digest': {'script': {'source': DOC_DIGEST_SCRIPT, 'params': {'ignore': self.ignore}}}},
+                search_after=search_after,
+            )
+            self.requests += 1
+            hits = response['hits']['hits']
+            for hit in hits:
+                remote[hit['_id']] = int(hit['fields']['digest'][0])
+            if len(hits) < self.leaf_size:
+                break
+            search_after = hits[-1]['sort']
+        stale += [doc_id for doc_id, digest in local.items() if remote.get(doc_id) != digest]
+        extra += [doc_id for doc_id in remote if doc_id not in local]
+
+    @staticmethod
+    def _query(prefix: str) -> Dict[str, Any]:
+        if not prefix:
+            return {'match_all': {}}
+        return {'prefix': {'id': prefix}}
@@ -0,0 +1,89 @@
+import logging
+import time
+from typing import Any, Dict, List
+
+from elasticsearch import Elasticsearch, NotFoundError
+
+logger = logging.getLogger(__name__)
+
+
+class VersionedIndex:
+    """Версионный индекс за алиасом для полной переиндексации без простоя.
+
+    Данные заливаются в новый индекс <alias>_<время> с настройками для
+    массовой загрузки (без refresh и реплик), затем индекс сливается в один
+    сегмент, настройки возвращаются, и алиас атомарно переключается на него.
+    Читатели (FastAPI) обращаются к алиасу и не видят частично заполненный индекс.
+    """
+
+    def __init__(
+        self,
+        es: Elasticsearch,
+        alias: str,
+        settings: Dict[str, Any],
+        mappings: Dict[str, Any],
+        replicas: int = 1,
+        request_timeout: int = 600,
+    ) -> None:
+        """
+        Args:
+            es: Клиент Elasticsearch.
+            alias: Имя, по которому индекс читают клиенты (movies, persons, genres).
+            settings: Рабочие настройки индекса.
+            mappings: Маппинг индекса.
+            replicas: Число реплик после загрузки.
+            request_timeout: Таймаут служебных запросов (forcemerge может идти долго).
+        """
+        self.es = es.options(request_timeout=request_timeout)
+        self.alias = alias
+        self.settings = settings
+        self.mappings = mappings
+        self.replicas = replicas
+        self.name = f"{alias}_{time.strftime('%Y%m%d%H%M%S')}"
+        self.published = False
+
+    def create(self) -> None:
+        """Создать индекс с настройками для максимальной скорости bulk-загрузки."""
+        settings = dict(self.settings, refresh_interval='-1', number_of_replicas=0)
+        self.es.indices.create(index=self.name, settings=settings, mappings=self.mappings)
+        logger.info(f"Reindex: created {self.name}")
+
+    def publish(self) -> None:
+        """Слить сегменты, вернуть рабочие настройки и переключить алиас на новый индекс.
+
+        Сегменты сливаются, пока реплик нет: реплики копируют уже слитый индекс,
+        а не строятся из загрузки и не сливаются заново.
+        """
+        self.es.indices.refresh(index=self.name)
+        self.es.indices.forcemerge(index=self.name, max_num_segments=1)
+        self.es.indices.put_settings(index=self.name, settings={
+            'refresh_interval': self.settings.get('refresh_interval', '1s'),
+            'number_of_replicas': self.replicas,
+        })
+        # дать репликам скопироваться (не дольше таймаута health): поиск до этого обслуживают первичные шарды
+        self.es.cluster.health(index=self.name, wait_for_no_initializing_shards=True)
+        self.es.indices.refresh(index=self.name)
+
+        old_indices = self._alias_indices()
+        actions: List[Dict[str, Any]] = [{'remove': {'index': index, 'alias': self.alias}} for index in old_indices]
+        if not old_indices and self.es.indices.exists(index=self.alias):
+            # индекс, созданный вручную по es_schema.txt, занимает имя алиаса: удаляем его той же операцией
+            actions.append({'remove_index': {'index': self.alias}})
+        actions.append({'add': {'index': self.name, 'alias': self.alias}})
+        self.es.indices.update_aliases(actions=actions)
+        self.published = True
+        logger.info(f"Reindex: alias {self.alias} -> {self.name}")
+
+        for index in old_indices:
+            self.es.indices.delete(index=index)
+            logger.info(f"Reindex: deleted {index}")
+
+    def drop(self) -> None:
+        """Удалить недозагруженный индекс (алиас на него не переключался)."""
+        self.es.indices.delete(index=self.name, ignore_unavailable=True)
+
+    def _alias_indices(self) -> List[str]:
+        try:
+            return list(self.es.indices.get_alias(name=self.alias))
+        except NotFoundError:
+            return []
@@ -19,14 +19,34 @@ class BaseStorage(abc.ABC):
     def retrieve_state(self) -> Dict[str, Any]:
         """Получить состояние из хранилища."""
 
+    def update_state(self, changes: Dict[str, Any], state: Dict[str, Any]) -> None:
+        """Сохранить изменённые ключи (changes) полного состояния state.
+
+        По умолчанию состояние переписывается целиком; хранилища,
+        умеющие писать по ключам, переопределяют этот метод.
+        """
+        self.save_state(state)
+
 
 import json
-from typing import Any, Dict
+import os
+from typing import Any, Dict, Tuple
+
+def fsync_dir(file_path: str) -> None:
+    """Сбросить на диск каталог файла, чтобы переименование пережило сбой питания."""
+    fd = os.open(os.path.dirname(os.path.abspath(file_path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 
 class JsonFileStorage(BaseStorage):
     """Реализация хранилища, использующего локальный файл.
 
-    Формат хранения: JSON
+    Формат хранения: JSON. Файл пишется атомарно: во временный файл
+    с fsync и переименованием, поэтому после сбоя в нём остаётся
+    либо старое, либо новое состояние целиком.
     """
     
     def __init__(self, file_path: str) -> None:
@@ -34,8 +54,13 @@ class JsonFileStorage(BaseStorage):
 
     def save_state(self, state: Dict[str, Any]) -> None:
         """Сохранить состояние в хранилище."""
-        with open(self.file_path, 'w') as file:
+        tmp_path = f"{self.file_path}.tmp"
+        with open(tmp_path, 'w') as file:
             json.dump(state, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.file_path)
+        fsync_dir(self.file_path)
 
     def retrieve_state(self) -> Dict[str, Any]:
         """Получить состояние из хранилища."""
@@ -47,12 +72,112 @@ class JsonFileStorage(BaseStorage):
         except json.JSONDecodeError:
             return {}
 
+class JsonLogStorage(BaseStorage):
+    """Хранилище в виде снимка и журнала изменений.
+
+    Каждое обновление - одна дописанная в журнал <file_path>.log строка
+    JSON только с изменёнными ключами (append + fsync), без перезаписи
+    всего состояния. Раз в compact_every записей журнал сворачивается:
+    снимок атомарно перезаписывается через JsonFileStorage, журнал обнуляется.
+    Снимок совместим с JsonFileStorage. Недописанная при сбое последняя
+    строка журнала при чтении отбрасывается и обрезается в файле.
+    """
+
+    def __init__(self, file_path: str, compact_every: int = 1000) -> None:
+        """
+        Args:
+            file_path: Файл снимка состояния.
+            compact_every: Через сколько записей журнала сворачивать его в снимок.
+        """
+        self.snapshot = JsonFileStorage(file_path)
+        self.log_path = f"{file_path}.log"
+        self.compact_every = compact_every
+        self._log_records = 0
+
+    def save_state(self, state: Dict[str, Any]) -> None:
+        """Сохранить состояние в хранилище."""
+        self._append(state)
+        self._compact(state)
+
+    def update_state(self, changes: Dict[str, Any], state: Dict[str, Any]) -> None:
+        """Дописать изменённые ключи в журнал; при необходимости свернуть его."""
+        self._append(changes)
+        if self._log_records >= self.compact_every:
+            self._compact(state)
+
+    def _append(self, changes: Dict[str, Any]) -> None:
+        with open(self.log_path, 'a') as file:
+            file.write(json.dumps(changes) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        self._log_records += 1
+
+    def _compact(self, state: Dict[str, Any]) -> None:
+        """Свернуть журнал в снимок state.
+
+        Изменения уже дописаны в журнал, и его последняя запись по каждому
+        ключу совпадает со снимком: сбой до обнуления журнала лишь повторит
+        при чтении уже учтённые записи и не откатит ключи.
+        """
+        self.snapshot.save_state(state)
+        self._truncate_log()
+
+    def _truncate_log(self) -> None:
+        with open(self.log_path, 'w') as file:
+            os.fsync(file.fileno())
+        self._log_records = 0
+
+    def retrieve_state(self) -> Dict[str, Any]:
+        """Получить состояние из хранилища: снимок плюс журнал.
+
+        Недописанный хвост журнала обрезается до последней целой строки,
+        иначе следующая запись приклеилась бы к обрывку и тоже не читалась.
+        Вызывать только из процесса, который пишет в это хранилище.
+        """
+        state, good, torn = self._read()
+        if torn:
+            with open(self.log_path, 'r+b') as file:
+                file.truncate(good)
+                os.fsync(file.fileno())
+        return state
+
+    def peek_state(self) -> Dict[str, Any]:
+        """Прочитать состояние без изменения файлов: для чужого хранилища, в которое пишет другой процесс."""
+        return self._read()[0]
+
+    def _read(self) -> Tuple[Dict[str, Any], int, bool]:
+        """Состояние, длина целой части журнала и есть ли за ней обрывок."""
+        state = self.snapshot.retrieve_state()
+        self._log_records = 0
+        good = 0
+        try:
+            with open(self.log_path, 'rb') as file:
+                for line in file:
+                    if not line.endswith(b'\n'):
+                        # обрыв записи при сбое: дальше строк быть не может
+                        break
+                    try:
+                        state.update(json.loads(line))
+                    except json.JSONDecodeError:
+                        break
+                    good += len(line)
+                    self._log_records += 1
+                return state, good, file.seek(0, os.SEEK_END) > good
+        except FileNotFoundError:
+            return state, 0, False
+
 import redis
 from typing import Any, Dict
 import json
 
 class RedisStorage(BaseStorage):
-    """Реализация хранилища, использующего Redis."""
+    """Реализация хранилища, использующего Redis.
+
+    Состояние хранится в хеше: поле на ключ состояния, значение - JSON.
+    Обновление пишет только изменённые поля одним HSET.
+    Прежний формат (одна JSON-строка под ключом) читается и при первой
+    записи заменяется хешем.
+    """
     
     def __init__(self, redis_client: redis.Redis, key: str = 'app_state') -> None:
         """Инициализация хранилища.
@@ -66,14 +191,28 @@ class RedisStorage(BaseStorage):
 
     def save_state(self, state: Dict[str, Any]) -> None:
         """Сохранить состояние в хранилище."""
-        self._redis.set(self._key, json.dumps(state))
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.delete(self._key)
+        if state:
+            pipe.hset(self._key, mapping={key: json.dumps(value) for key, value in state.items()})
+        pipe.execute()
+
+    def update_state(self, changes: Dict[str, Any], state: Dict[str, Any]) -> None:
+        """Записать только изменённые ключи."""
+        if self._redis.type(self._key) not in (b'hash', 'hash', b'none', 'none'):
+            self.save_state(state)
+            return
+        self._redis.hset(self._key, mapping={key: json.dumps(value) for key, value in changes.items()})
 
     def retrieve_state(self) -> Dict[str, Any]:
         """Получить состояние из хранилища."""
-        state = self._redis.get(self._key)
-        if state is None:
-            return {}
-        return json.loads(state)
+        if self._redis.type(self._key) in (b'string', 'string'):
+            return json.loads(self._redis.get(self._key))
+        state = self._redis.hgetall(self._key)
+        return {
+            key.decode() if isinstance(key, bytes) else key: json.loads(value)
+            for key, value in state.items()
+        }
 
 class State:
     """Класс для работы с состояниями."""
@@ -84,8 +223,14 @@ class State:
 
     def set_state(self, key: str, value: Any) -> None:
         """Установить состояние для определённого ключа."""
-        self.current_state[key] = value
-        self.storage.save_state(self.current_state)
+        self.set_states({key: value})
+
+    def set_states(self, values: Dict[str, Any]) -> None:
+        """Установить состояние для нескольких ключей одной записью в хранилище."""
+        if not values:
+            return
+        self.current_state.update(values)
+        self.storage.update_state(values, self.current_state)
 
     def get_state(self, key: str) -> Any:
         """Получить состояние по определённому ключу."""
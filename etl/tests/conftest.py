@@ -0,0 +1,55 @@
+import os
+import sys
+
+import pytest
+
+# модули ETL импортируются так же, как в контейнере: из каталога etl
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+# без файла хешей в рабочем каталоге: тесты ContentFilter создают хранилище сами
+os.environ.setdefault('CONTENT_HASH', 'off')
+
+VERSION_CONFLICT = {'type': 'version_conflict_engine_exception', 'reason': 'version conflict'}
+MAPPING_ERROR = {'type': 'mapper_parsing_exception', 'reason': 'failed to parse'}
+
+
+class FakeElasticsearch:
+    """Elasticsearch для BulkLoader: статус каждого элемента bulk задаётся по id документа.
+
+    statuses[id] - статусы по попыткам (последний повторяется), по умолчанию 201.
+    """
+
+    def __init__(self):
+        self.statuses = {}
+        self.requests = []
+        self._attempts = {}
+
+    def options(self, **kwargs):
+        return self
+
+    def bulk(self, operations):
+        items = []
+        request = []
+        operations = iter(operations)
+        for operation in operations:
+            op_type, meta = next(iter(operation.items()))
+            if op_type != 'delete':
+                next(operations)
+            doc_id = meta['_id']
+            request.append((op_type, doc_id))
+            statuses = self.statuses.get(doc_id, [201])
+            attempt = self._attempts.get(doc_id, 0)
+            self._attempts[doc_id] = attempt + 1
+            status = statuses[min(attempt, len(statuses) - 1)]
+            result = {'_index': meta['_index'], '_id': doc_id, 'status': status}
+            if status == 409:
+                result['error'] = VERSION_CONFLICT
+            elif status >= 300:
+                result['error'] = MAPPING_ERROR if status == 400 else {'type': 'es_rejected_execution_exception'}
+            items.append({op_type: result})
+        self.requests.append(request)
+        return {'errors': any(next(iter(item.values()))['status'] >= 300 for item in items), 'items': items}
+
+
+@pytest.fixture
+def fake_es():
+    return FakeElasticsearch()
@@ -0,0 +1,55 @@
+import pytest
+
+from content_hash import ContentFilter, SqliteHashStore, content_hash
+
+
+def film_action(film_id, title, **source):
+    return {'_index': 'movies', '_id': film_id, '_source': {'id': film_id, 'title': title, **source}}
+
+
+@pytest.fixture
+def content_filter(tmp_path):
+    return ContentFilter(SqliteHashStore(str(tmp_path / 'etl_hashes.sqlite')))
+
+
+def test_content_hash_ignores_key_order_and_ignored_fields():
+    assert content_hash({'a': 1, 'b': [1, 2]}) == content_hash({'b': [1, 2], 'a': 1})
+    assert content_hash({'a': 1, 'updated_at': 'x'}, ['updated_at']) == content_hash({'a': 1})
+    assert content_hash({'a': 1}) != content_hash({'a': 2})
+
+
+def test_unchanged_documents_are_skipped_after_commit(content_filter):
+    actions = [film_action('f1', 'A', updated_at='1'), film_action('f2', 'B')]
+    changed, hashes = content_filter.filter(actions)
+    assert changed == actions
+    content_filter.commit(hashes)
+
+    # touch-обновление (только updated_at) не меняет документ
+    actions = [film_action('f1', 'A', updated_at='2'), film_action('f2', 'B2')]
+    changed, hashes = content_filter.filter(actions)
+    assert changed == [actions[1]]
+    assert list(hashes) == ['movies:f2']
+
+
+def test_hashes_are_not_committed_before_load(content_filter):
+    action = film_action('f1', 'A')
+    content_filter.filter([action])
+    assert content_filter.filter([action])[0] == [action]
+
+
+def test_failed_documents_are_not_remembered(content_filter):
+    ok, failed = film_action('f1', 'A'), film_action('f2', 'B')
+    _, hashes = content_filter.filter([ok, failed])
+    content_filter.commit(hashes, [failed])
+
+    assert content_filter.filter([ok, failed])[0] == [failed]
+
+
+def test_partial_update_forgets_hash(content_filter):
+    action = film_action('f1', 'A')
+    content_filter.commit(content_filter.filter([action])[1])
+    update = {'_op_type': 'update', '_index': 'movies', '_id': 'f1', 'doc': {'title': 'B'}}
+
+    assert content_filter.filter([update]) == ([update], {})
+    # содержимое в ES изменилось в обход полного документа: следующая загрузка пройдёт
+    assert content_filter.filter([action])[0] == [action]
@@ -0,0 +1,117 @@
+from collections import namedtuple
+
+import pytest
+
+import etl
+from content_hash import ContentFilter, SqliteHashStore
+from loader import BulkLoader
+from state import JsonLogStorage, State
+
+POSITION = {'updated_at': '2026-10-18T12:00:00+00:00', 'id': '00000000-0000-0000-0000-000000000001'}
+
+
+def film_action(film_id):
+    return {'_index': 'movies', '_id': film_id, '_source': {'id': film_id, 'title': film_id}}
+
+
+@pytest.fixture
+def etl_state(tmp_path, monkeypatch):
+    state = State(JsonLogStorage(str(tmp_path / 'etl_state.json')))
+    monkeypatch.setattr(etl, 'state', state, raising=False)
+    return state
+
+
+@pytest.fixture
+def bulk_loader(tmp_path, monkeypatch, fake_es):
+    loader = BulkLoader(fake_es, streams=1, max_retries=1, initial_backoff=0,
+                        dead_letter_file=str(tmp_path / 'dead_letter.jsonl'))
+    monkeypatch.setattr(etl, 'bulk_loader', loader)
+    monkeypatch.setattr(etl, 'content_filter', None)
+    monkeypatch.setattr(etl, 'wait_for_es', lambda: None)
+    return loader
+
+
+def test_rejected_document_does_not_hold_checkpoint(fake_es, bulk_loader, etl_state):
+    fake_es.statuses['bad'] = [400]
+    batch = etl.Batch(etl.Stream('movies', etl.Filmwork, None, None), {'Filmwork': POSITION}, None,
+                      [film_action('f1'), film_action('bad')])
+
+    etl.load_batch(batch)
+
+    assert etl_state.get_state('Filmwork') == {'cursor': POSITION}
+    assert etl_state.get_state(etl.DEAD_LETTERS_KEY) == {'movies': ['bad']}
+    # чекпоинт и id отклонённых документов пишутся одной записью журнала
+    with open(etl_state.storage.log_path) as file:
+        assert len(file.readlines()) == 1
+
+
+def test_dead_letters_are_retried_next_cycle(fake_es, bulk_loader, etl_state, monkeypatch):
+    etl_state.set_state(etl.DEAD_LETTERS_KEY, {'movies': ['bad', 'gone', 'still-bad']})
+    fake_es.statuses['still-bad'] = [400]
+    films = {'bad', 'still-bad'}
+    monkeypatch.setattr(etl, 'get_sources_by_ids', lambda: {
+        'movies': (lambda ids: [film_id for film_id in ids if film_id in films],
+                   lambda ids: [film_action(film_id) for film_id in ids]),
+    })
+
+    etl.retry_dead_letters()
+
+    assert sorted(fake_es.requests[0]) == [('delete', 'gone'), ('index', 'bad'), ('index', 'still-bad')]
+    assert etl_state.get_state(etl.DEAD_LETTERS_KEY) == {'movies': ['still-bad']}
+
+
+def test_add_dead_letters_merges_ids():
+    recorded = {'movies': ['f2'], 'genres': []}
+    actions = [film_action('f1'), film_action('f2'), {'_op_type': 'delete', '_index': 'persons', '_id': 'p1'}]
+    assert etl.add_dead_letters(recorded, actions) == {'movies': ['f1', 'f2'], 'persons': ['p1']}
+
+
+def test_genre_updates_retry_on_conflict():
+    Row = namedtuple('Row', ['id', 'genres'])
+    action, = etl.transform_film_genres([Row('f1', ['Drama'])])
+    assert action['_op_type'] == 'update'
+    assert action['_retry_on_conflict'] == etl.UPDATE_RETRY_ON_CONFLICT
+
+
+def test_update_by_query_forgets_film_hashes(tmp_path, monkeypatch):
+    store = SqliteHashStore(str(tmp_path / 'hashes.sqlite'))
+    store.set_many({'movies:f1': 'a', 'movies:f2': 'b', 'movies:f3': 'c'})
+    monkeypatch.setattr(etl, 'content_filter', ContentFilter(store))
+    monkeypatch.setattr(etl, 'wait_for_es', lambda: None)
+    monkeypatch.setattr(etl, 'extract_film_ids_by_persons', lambda person_ids: ['f1', 'f2'])
+    known_before_update = []
+
+    class Elasticsearch:
+        def options(self, **kwargs):
+            return self
+
+        def update_by_query(self, index, query, script, conflicts):
+            known_before_update.append(store.get_many(['movies:f1', 'movies:f2', 'movies:f3']))
+            return {'updated': 2, 'total': 2, 'version_conflicts': 0}
+
+    monkeypatch.setattr(etl, 'es', Elasticsearch())
+    Person = namedtuple('Person', ['id', 'full_name'])
+
+    etl.load_by_query(etl.transform_person_renames([Person('p1', 'New Name')]))
+
+    assert known_before_update == [{'movies:f3': 'c'}]
+
+
+def test_sharded_hashes_stay_in_owner_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(etl, 'ETL_SHARDS', 2)
+    monkeypatch.setattr(etl, 'CONTENT_HASH', 'local')
+    monkeypatch.setattr(etl, 'CONTENT_HASH_FILE', str(tmp_path / 'etl_hashes.sqlite'))
+    film_ids = [f'00000000-0000-0000-0000-00000000000{i}' for i in (1, 2)]
+    content_filter = etl.get_content_filter()
+    content_filter.store.set_many({f'movies:{film_id}': 'h' for film_id in film_ids})
+    content_filter.store.set_many({'genres:g1': 'h'})
+
+    for shard in (0, 1):
+        store = SqliteHashStore(etl.get_hash_file(shard, 2))
+        keys = [f'movies:{film_id}' for film_id in film_ids] + ['genres:g1']
+        expected = {key for key in keys if etl.get_hash_shard(key) == shard}
+        assert set(store.get_many(keys)) == expected
+
+    # update_by_query шарда 0 забывает хеши фильмов любого шарда
+    content_filter.store.delete_many([f'movies:{film_id}' for film_id in film_ids])
+    assert content_filter.store.get_many([f'movies:{film_id}' for film_id in film_ids]) == {}
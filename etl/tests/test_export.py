@@ -0,0 +1,61 @@
+import json
+import threading
+
+import pytest
+
+from export import COPY_DELIMITER, NdjsonExporter
+
+
+class BlockingBulkClient:
+    """bulk по NDJSON: ответ ждёт release, чтобы отправки оставались в очереди."""
+
+    def __init__(self):
+        self.bodies = []
+        self.release = threading.Event()
+
+    def options(self, **kwargs):
+        return self
+
+    def bulk(self, operations):
+        self.release.wait(5)
+        lines = operations.decode().splitlines()
+        self.bodies.append(lines)
+        return {'errors': False, 'items': [{'index': {'status': 201}} for _ in lines[::2]]}
+
+
+def copy_line(doc_id, version):
+    return COPY_DELIMITER.join([doc_id, version, json.dumps({'id': doc_id})]) + '\n'
+
+
+def test_null_version_is_written_as_oldest(tmp_path):
+    es = BlockingBulkClient()
+    es.release.set()
+    exporter = NdjsonExporter(es, streams=1, dead_letter_file=str(tmp_path / 'dead_letter.jsonl'))
+
+    with exporter.writer('movies') as writer:
+        writer.write(copy_line('f1', ''))
+        writer.write(copy_line('f2', '1700000000000000'))
+    exporter.flush()
+
+    actions = [json.loads(line)['index'] for line in es.bodies[0][::2]]
+    assert [action['version'] for action in actions] == [0, 1700000000000000]
+
+
+def test_failed_copy_cancels_pending_requests(tmp_path):
+    es = BlockingBulkClient()
+    exporter = NdjsonExporter(es, streams=1, max_bytes=1, dead_letter_file=str(tmp_path / 'dead_letter.jsonl'))
+
+    with pytest.raises(RuntimeError):
+        with exporter.writer('movies') as writer:
+            for i in range(2):
+                writer.write(copy_line(f'f{i}', '1'))
+            # обрыв COPY посреди строки
+            writer.write('f3' + COPY_DELIMITER)
+            raise RuntimeError('COPY failed')
+
+    # первый запрос отвечает, когда cancel() уже отменил второй, ждавший потока
+    threading.Timer(0.1, es.release.set).start()
+    exporter.cancel()
+    # первый дождались, второй не отправлен, как и недописанная строка
+    assert [len(body) for body in es.bodies] == [2]
+    assert exporter._futures == []
@@ -0,0 +1,99 @@
+import json
+
+from conftest import MAPPING_ERROR
+from loader import BulkLoader
+
+
+def make_loader(es, tmp_path, **kwargs):
+    kwargs.setdefault('streams', 1)
+    kwargs.setdefault('initial_backoff', 0)
+    return BulkLoader(es, dead_letter_file=str(tmp_path / 'dead_letter.jsonl'), **kwargs)
+
+
+def test_update_conflict_is_retried(fake_es, tmp_path):
+    fake_es.statuses['f1'] = [409, 200]
+    loader = make_loader(fake_es, tmp_path)
+
+    failed = loader.load([{'_op_type': 'update', '_index': 'movies', '_id': 'f1', 'doc': {'genres': ['Drama']}}])
+
+    assert failed == []
+    assert fake_es.requests == [[('update', 'f1')], [('update', 'f1')]]
+    assert loader.stats.dead_letters == 0
+
+
+def index_action(doc_id):
+    return {'_index': 'movies', '_id': doc_id, '_source': {'id': doc_id}}
+
+
+def test_chunk_size_grows_additively_and_halves_on_rejection(fake_es, tmp_path):
+    loader = make_loader(fake_es, tmp_path, chunk_size=100, min_chunk_size=10, target_latency=60)
+
+    loader.load([index_action('f1')])
+    assert loader.chunk_size == 110
+
+    fake_es.statuses['f2'] = [429, 201]
+    loader.load([index_action('f2')])
+    # 429 делит размер пополам, успешный повтор снова прибавляет min_chunk_size
+    assert loader.chunk_size == 110 // 2 + 10
+    assert loader.stats.rejected == 1
+
+
+def test_slow_responses_shrink_chunk_size(fake_es, tmp_path):
+    loader = make_loader(fake_es, tmp_path, chunk_size=100, min_chunk_size=10, target_latency=0)
+
+    loader.load([index_action('f1')])
+    assert loader.chunk_size == 75
+
+    for _ in range(10):
+        loader.load([index_action('f1')])
+    assert loader.chunk_size == 10
+
+
+def test_only_failed_items_are_retried(fake_es, tmp_path):
+    fake_es.statuses['f2'] = [503, 201]
+    loader = make_loader(fake_es, tmp_path, min_chunk_size=10)
+
+    failed = loader.load([index_action(doc_id) for doc_id in ('f1', 'f2', 'f3')])
+
+    assert failed == []
+    assert fake_es.requests == [[('index', 'f1'), ('index', 'f2'), ('index', 'f3')], [('index', 'f2')]]
+    assert loader.stats.retried == 1
+    assert loader.stats.docs == 3
+
+
+def test_item_failures_are_classified(fake_es, tmp_path):
+    fake_es.statuses.update({'newer': [409], 'not_loaded': [404], 'gone': [404], 'broken': [400]})
+    loader = make_loader(fake_es, tmp_path)
+    conflict = index_action('newer')
+    broken = index_action('broken')
+
+    failed = loader.load([
+        index_action('f1'),
+        conflict,
+        {'_op_type': 'update', '_index': 'movies', '_id': 'not_loaded', 'doc': {'title': 'x'}},
+        {'_op_type': 'delete', '_index': 'movies', '_id': 'gone'},
+        broken,
+    ])
+
+    # более новая версия в индексе - не ошибка, но и не загрузка; 404 на update и delete - успех
+    assert failed == [broken, conflict]
+    assert loader.dead_lettered == [broken]
+    assert loader.stats.conflicts == 1
+    assert loader.stats.dead_letters == 1
+    assert len(fake_es.requests) == 1
+    with open(tmp_path / 'dead_letter.jsonl') as file:
+        assert [json.loads(line) for line in file] == [{'action': broken, 'error': MAPPING_ERROR}]
+
+
+def test_items_are_dead_lettered_after_retries(fake_es, tmp_path):
+    fake_es.statuses['busy'] = [503]
+    loader = make_loader(fake_es, tmp_path, max_retries=2)
+    action = index_action('busy')
+
+    assert loader.load([action, index_action('f1')]) == [action]
+    assert len(fake_es.requests) == 3
+    assert loader.dead_lettered == [action]
+
+    # следующий load() начинает список заново
+    assert loader.load([index_action('f2')]) == []
+    assert loader.dead_lettered == []
@@ -0,0 +1,63 @@
+import threading
+
+import pytest
+
+from pipeline import Pipeline
+
+
+def run_pipeline(source, stages, sink, **kwargs):
+    cleaned = []
+    before = set(threading.enumerate())
+    pipeline = Pipeline(source=source, stages=stages, sink=sink,
+                        thread_cleanup=lambda: cleaned.append(threading.current_thread().name), **kwargs)
+    try:
+        pipeline.run()
+    finally:
+        # все рабочие потоки завершились и вызвали thread_cleanup
+        assert len(cleaned) == len(stages) + 1
+        assert set(threading.enumerate()) <= before
+
+
+def test_batches_pass_all_stages_in_order():
+    loaded = []
+    run_pipeline(lambda: iter(range(20)), [lambda x: x * 2, lambda x: x + 1], loaded.append)
+    assert loaded == [x * 2 + 1 for x in range(20)]
+
+
+def test_source_error_is_raised():
+    def source():
+        yield 1
+        raise ValueError('source')
+
+    loaded = []
+    with pytest.raises(ValueError, match='source'):
+        run_pipeline(source, [lambda x: x], loaded.append)
+    assert loaded in ([], [1])
+
+
+def test_stage_error_stops_source():
+    produced = []
+
+    def source():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+
+    def stage(x):
+        if x == 3:
+            raise ValueError('stage')
+        return x
+
+    with pytest.raises(ValueError, match='stage'):
+        run_pipeline(source, [stage], lambda x: None, queue_size=1)
+    # источник остановлен, а не дочитан до конца
+    assert len(produced) < 1000
+
+
+def test_sink_error_stops_blocked_stages():
+    def sink(x):
+        raise ValueError('sink')
+
+    # источник и стадия ждут на заполненных очередях и должны выйти по остановке
+    with pytest.raises(ValueError, match='sink'):
+        run_pipeline(lambda: iter(range(1000)), [lambda x: x], sink, queue_size=1)
@@ -0,0 +1,54 @@
+import pytest
+
+from reconcile import canonical, document_digest, java_double
+
+
+# Ожидаемые строки - то, что вернёт canonical() из DIGEST_FUNCTIONS (Double.toString в JDK 19+)
+@pytest.mark.parametrize('value, expected', [
+    (0.0, '0.0'),
+    (-0.0, '-0.0'),
+    (1.0, '1.0'),
+    (7.5, '7.5'),
+    (0.1, '0.1'),
+    (0.001, '0.001'),
+    (0.0001, '1.0E-4'),
+    (1.5e-5, '1.5E-5'),
+    (9999999.0, '9999999.0'),
+    (1e7, '1.0E7'),
+    (-12345678.9, '-1.23456789E7'),
+    (1e16, '1.0E16'),
+    (1.7976931348623157e308, '1.7976931348623157E308'),
+    (float('nan'), 'NaN'),
+    (float('-inf'), '-Infinity'),
+])
+def test_java_double(value, expected):
+    assert java_double(value) == expected
+
+
+@pytest.mark.parametrize('value, expected', [
+    (None, 'null'),
+    (True, 'true'),
+    (42, '42.0'),
+    (8.1, '8.1'),
+    ('', ''),
+    ('Амели', 'Амели'),
+    ('null', 'null'),
+    ([], '[]'),
+    ([1, None, 'a'], '[1.0,null,a,]'),
+    ([[1, [2.5]], [], [None]], '[[1.0,[2.5,],],[],[null,],]'),
+    ({'b': 1, 'a': [{'y': None, 'x': 'z'}]}, '{a:[{x:z,y:null,},],b:1.0,}'),
+    ({'title': 'Ёлки', 'rating': None}, '{rating:null,title:Ёлки,}'),
+    # Java сравнивает строки по UTF-16: суррогатная пара (U+1F600) раньше U+FF21
+    ({'Ａ': 1, '\U0001f600': 2}, '{\U0001f600:2.0,Ａ:1.0,}'),
+])
+def test_canonical(value, expected):
+    assert canonical(value) == expected
+
+
+def test_document_digest_ignores_fields_and_key_order():
+    source = {'id': 'f1', 'title': 'Ёлки', 'imdb_rating': 7.0, 'genres': ['Comedy'], 'updated_at': '2026-10-18'}
+    reordered = dict(reversed(list(source.items())))
+    assert document_digest(source, ['updated_at']) == document_digest(reordered, ['updated_at'])
+    assert document_digest(source, ['updated_at']) == document_digest(dict(source, updated_at='x'), ['updated_at'])
+    assert document_digest(source) != document_digest(dict(source, imdb_rating=7.1))
+    assert 0 <= document_digest(source) < 2 ** 32
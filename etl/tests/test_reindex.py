@@ -0,0 +1,44 @@
+from reindex import VersionedIndex
+
+
+class RecordingClient:
+    """Клиент Elasticsearch, записывающий служебные вызовы по порядку."""
+
+    def __init__(self):
+        self.calls = []
+
+    def options(self, **kwargs):
+        return self
+
+    def __getattr__(self, name):
+        return Namespace(self.calls, name)
+
+
+class Namespace:
+    def __init__(self, calls, name):
+        self.calls = calls
+        self.name = name
+
+    def __getattr__(self, method):
+        def call(**kwargs):
+            self.calls.append((f'{self.name}.{method}', kwargs))
+            if method == 'get_alias':
+                return {'movies_old': {}}
+            return {}
+        return call
+
+
+def test_publish_merges_before_adding_replicas():
+    es = RecordingClient()
+    index = VersionedIndex(es, 'movies', {'refresh_interval': '1s'}, {}, replicas=1)
+
+    index.publish()
+
+    calls = [name for name, _ in es.calls]
+    assert calls[:5] == ['indices.refresh', 'indices.forcemerge', 'indices.put_settings',
+                         'cluster.health', 'indices.refresh']
+    assert calls[5:] == ['indices.get_alias', 'indices.update_aliases', 'indices.delete']
+    assert es.calls[2][1]['settings'] == {'refresh_interval': '1s', 'number_of_replicas': 1}
+    assert es.calls[6][1]['actions'] == [{'remove': {'index': 'movies_old', 'alias': 'movies'}},
+                                         {'add': {'index': index.name, 'alias': 'movies'}}]
+    assert index.published
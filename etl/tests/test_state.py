@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from state import JsonLogStorage, State
+
+
+def test_torn_log_tail_is_dropped_and_truncated(tmp_path):
+    path = str(tmp_path / 'etl_state.json')
+    state = State(JsonLogStorage(path))
+    state.set_state('a', 1)
+    state.set_state('b', 2)
+    with open(f'{path}.log', 'a') as file:
+        # сбой посреди записи: строка без перевода строки
+        file.write('{"a": 3')
+
+    state = State(JsonLogStorage(path))
+    assert state.current_state == {'a': 1, 'b': 2}
+    with open(f'{path}.log') as file:
+        assert file.read().endswith('{"b": 2}\n')
+
+    # следующая запись не приклеивается к обрывку
+    state.set_state('a', 4)
+    assert State(JsonLogStorage(path)).current_state == {'a': 4, 'b': 2}
+
+
+def test_log_is_compacted_into_snapshot(tmp_path):
+    path = str(tmp_path / 'etl_state.json')
+    state = State(JsonLogStorage(path, compact_every=2))
+    state.set_state('a', 1)
+    with open(f'{path}.log') as file:
+        assert file.read() == '{"a": 1}\n'
+
+    state.set_state('b', 2)
+    with open(path) as file:
+        assert json.load(file) == {'a': 1, 'b': 2}
+    with open(f'{path}.log') as file:
+        assert file.read() == ''
+
+    state.set_state('a', 3)
+    assert State(JsonLogStorage(path, compact_every=2)).current_state == {'a': 3, 'b': 2}
+
+
+def test_crash_during_compaction_does_not_roll_back(tmp_path, monkeypatch):
+    path = str(tmp_path / 'etl_state.json')
+    storage = JsonLogStorage(path, compact_every=2)
+    state = State(storage)
+    state.set_state('a', 1)
+
+    def crash():
+        raise OSError('crash')
+
+    # снимок уже записан, журнал обнулить не успели
+    monkeypatch.setattr(storage, '_truncate_log', crash)
+    with pytest.raises(OSError):
+        state.set_state('a', 2)
+
+    assert State(JsonLogStorage(path, compact_every=2)).current_state == {'a': 2}
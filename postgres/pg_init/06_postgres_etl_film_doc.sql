@@ -0,0 +1,249 @@
+\c movies_database app;
+
+-- Денормализованные документы фильмов: жанры и участники агрегируются
+-- в JSON-массивы на стороне Postgres, один запрос на пачку вместо N+1.
+-- Пачки изменений выбираются функциями etl.get_film_ids_by_*_cursor (09_postgres_etl_cursor.sql).
+
+-- Журнал удалений: триггеры, чтение и очистка - в 12_postgres_etl_tombstone.sql.
+-- version_at - версия удаления: не меньше версии документа, в который входила удалённая строка.
+-- updated_at - позиция в журнале, по ней ETL читает журнал; проставляется не триггером,
+-- а перед чтением (etl.sequence_tombstones), NULL - запись ещё не упорядочена.
+CREATE TABLE IF NOT EXISTS etl.tombstone (
+    id uuid PRIMARY KEY DEFAULT gen_random_uuid(),
+    table_name TEXT NOT NULL,
+    entity_id uuid NOT NULL,
+    film_work_id uuid,
+    version_at timestamp with time zone NOT NULL,
+    updated_at timestamp with time zone
+);
+
+CREATE INDEX IF NOT EXISTS tombstone_updated_at_id_idx ON etl.tombstone (updated_at, id);
+CREATE INDEX IF NOT EXISTS tombstone_film_work_id_idx ON etl.tombstone (film_work_id);
+CREATE INDEX IF NOT EXISTS tombstone_unsequenced_idx ON etl.tombstone (id) WHERE updated_at IS NULL;
+
+-- Все документы фильмов; выборка по id (etl.get_film_docs) фильтрует film_work до LATERAL-подзапросов.
+-- Участники упорядочены по имени побайтно (COLLATE "C", как String.compareTo в RENAME_PERSONS_SCRIPT), затем по id.
+-- updated_at - самое позднее изменение фильма, его связей, жанров и участников, а также удалений его связей
+-- (удалённая связь могла быть самым поздним изменением): из него ETL выводит внешнюю версию документа в ES,
+-- и она не убывает.
+CREATE OR REPLACE VIEW etl.film_docs AS
+SELECT fw.id,
+		fw.title,
+		fw.description,
+		fw.rating,
+		GREATEST(fw.updated_at, g.updated_at, p.updated_at, t.version_at) updated_at,
+		COALESCE(g.genres, '[]'::json) genres,
+		COALESCE(p.directors, '[]'::json) directors,
+		COALESCE(p.actors, '[]'::json) actors,
+		COALESCE(p.writers, '[]'::json) writers
+FROM content.film_work fw
+LEFT JOIN LATERAL (
+	SELECT json_agg(gn.name ORDER BY gn.name) genres,
+		max(GREATEST(gfw.updated_at, gn.updated_at)) updated_at
+	FROM content.genre_film_work gfw
+	JOIN content.genre gn ON gn.id = gfw.genre_id
+	WHERE gfw.film_work_id = fw.id
+) g ON TRUE
+LEFT JOIN LATERAL (
+	SELECT
+		json_agg(json_build_object('id', pn.id, 'name', pn.full_name) ORDER BY pn.full_name COLLATE "C", pn.id)
+			FILTER (WHERE pfw.role = 'director') directors,
+		json_agg(json_build_object('id', pn.id, 'name', pn.full_name) ORDER BY pn.full_name COLLATE "C", pn.id)
+			FILTER (WHERE pfw.role = 'actor') actors,
+		json_agg(json_build_object('id', pn.id, 'name', pn.full_name) ORDER BY pn.full_name COLLATE "C", pn.id)
+			FILTER (WHERE pfw.role = 'writer') writers,
+		max(GREATEST(pfw.updated_at, pn.updated_at)) updated_at
+	FROM content.person_film_work pfw
+	JOIN content.person pn ON pn.id = pfw.person_id
+	WHERE pfw.film_work_id = fw.id
+) p ON TRUE
+LEFT JOIN LATERAL (
+	SELECT max(tb.version_at) version_at
+	FROM etl.tombstone tb
+	WHERE tb.film_work_id = fw.id
+) t ON TRUE
+;
+
+
+-- DROP FUNCTION etl.get_film_docs;
+CREATE OR REPLACE FUNCTION etl.get_film_docs(p_ids uuid[]) RETURNS TABLE (
+		id uuid,
+		title TEXT,
+		description TEXT,
+		rating FLOAT,
+		updated_at timestamp with time zone,
+		genres JSON,
+		directors JSON,
+		actors JSON,
+		writers JSON
+		)
+	AS $$
+BEGIN
+    RETURN QUERY
+SELECT d.id, d.title, d.description, d.rating, d.updated_at, d.genres, d.directors, d.actors, d.writers
+FROM etl.film_docs d
+WHERE d.id = ANY(p_ids)
+;
+END; $$ LANGUAGE plpgsql STRICT;
+
+
+-- Строка с id = NULL: источники изменились, но фильмов у них нет (курсор всё равно сдвигается).
+
+-- DROP FUNCTION etl.get_film_doc_by_person_cursor;
+CREATE OR REPLACE FUNCTION etl.get_film_doc_by_person_cursor(p_updated_at timestamp with time zone, p_id uuid, p_batch_size INTEGER) RETURNS TABLE (
+		id uuid,
+		title TEXT,
+		description TEXT,
+		rating FLOAT,
+		updated_at timestamp with time zone,
+		genres JSON,
+		directors JSON,
+		actors JSON,
+		writers JSON,
+		max_updated_at timestamp with time zone,
+		max_id uuid
+		)
+	AS $$
+BEGIN
+    RETURN QUERY
+	WITH changed as (
+SELECT t.id, t.max_updated_at, t.max_id
+FROM etl.get_film_ids_by_person_cursor(p_updated_at, p_id, p_batch_size) t
+)
+,last as (
+SELECT DISTINCT c.max_updated_at, c.max_id
+FROM changed c
+)
+SELECT d.*, last.max_updated_at, last.max_id
+FROM last
+LEFT JOIN etl.get_film_docs(ARRAY(SELECT c.id FROM changed c WHERE c.id IS NOT NULL)) d ON TRUE
+;
+END; $$ LANGUAGE plpgsql STRICT;
+
+
+-- DROP FUNCTION etl.get_film_doc_by_film_work_cursor;
+CREATE OR REPLACE FUNCTION etl.get_film_doc_by_film_work_cursor(p_updated_at timestamp with time zone, p_id uuid, p_batch_size INTEGER) RETURNS TABLE (
+		id uuid,
+		title TEXT,
+		description TEXT,
+		rating FLOAT,
+		updated_at timestamp with time zone,
+		genres JSON,
+		directors JSON,
+		actors JSON,
+		writers JSON,
+		max_updated_at timestamp with time zone,
+		max_id uuid
+		)
+	AS $$
+BEGIN
+    RETURN QUERY
+	WITH changed as (
+SELECT t.id, t.max_updated_at, t.max_id
+FROM etl.get_film_ids_by_film_work_cursor(p_updated_at, p_id, p_batch_size) t
+)
+,last as (
+SELECT DISTINCT c.max_updated_at, c.max_id
+FROM changed c
+)
+SELECT d.*, last.max_updated_at, last.max_id
+FROM last
+LEFT JOIN etl.get_film_docs(ARRAY(SELECT c.id FROM changed c WHERE c.id IS NOT NULL)) d ON TRUE
+;
+END; $$ LANGUAGE plpgsql STRICT;
+
+
+-- DROP FUNCTION etl.get_film_doc_by_genre_cursor;
+CREATE OR REPLACE FUNCTION etl.get_film_doc_by_genre_cursor(p_updated_at timestamp with time zone, p_id uuid, p_batch_size INTEGER) RETURNS TABLE (
+		id uuid,
+		title TEXT,
+		description TEXT,
+		rating FLOAT,
+		updated_at timestamp with time zone,
+		genres JSON,
+		directors JSON,
+		actors JSON,
+		writers JSON,
+		max_updated_at timestamp with time zone,
+		max_id uuid
+		)
+	AS $$
+BEGIN
+    RETURN QUERY
+	WITH changed as (
+SELECT t.id, t.max_updated_at, t.max_id
+FROM etl.get_film_ids_by_genre_cursor(p_updated_at, p_id, p_batch_size) t
+)
+,last as (
+SELECT DISTINCT c.max_updated_at, c.max_id
+FROM changed c
+)
+SELECT d.*, last.max_updated_at, last.max_id
+FROM last
+LEFT JOIN etl.get_film_docs(ARRAY(SELECT c.id FROM changed c WHERE c.id IS NOT NULL)) d ON TRUE
+;
+END; $$ LANGUAGE plpgsql STRICT;
+
+
+-- DROP FUNCTION etl.get_film_doc_by_person_film_work_cursor;
+CREATE OR REPLACE FUNCTION etl.get_film_doc_by_person_film_work_cursor(p_updated_at timestamp with time zone, p_id uuid, p_batch_size INTEGER) RETURNS TABLE (
+		id uuid,
+		title TEXT,
+		description TEXT,
+		rating FLOAT,
+		updated_at timestamp with time zone,
+		genres JSON,
+		directors JSON,
+		actors JSON,
+		writers JSON,
+		max_updated_at timestamp with time zone,
+		max_id uuid
+		)
+	AS $$
+BEGIN
+    RETURN QUERY
+	WITH changed as (
+SELECT t.id, t.max_updated_at, t.max_id
+FROM etl.get_film_ids_by_person_film_work_cursor(p_updated_at, p_id, p_batch_size) t
+)
+,last as (
+SELECT DISTINCT c.max_updated_at, c.max_id
+FROM changed c
+)
+SELECT d.*, last.max_updated_at, last.max_id
+FROM last
+LEFT JOIN etl.get_film_docs(ARRAY(SELECT c.id FROM changed c WHERE c.id IS NOT NULL)) d ON TRUE
+;
+END; $$ LANGUAGE plpgsql STRICT;
+
+
+-- DROP FUNCTION etl.get_film_doc_by_genre_film_work_cursor;
+CREATE OR REPLACE FUNCTION etl.get_film_doc_by_genre_film_work_cursor(p_updated_at timestamp with time zone, p_id uuid, p_batch_size INTEGER) RETURNS TABLE (
+		id uuid,
+		title TEXT,
+		description TEXT,
+		rating FLOAT,
+		updated_at timestamp with time zone,
+		genres JSON,
+		directors JSON,
+		actors JSON,
+		writers JSON,
+		max_updated_at timestamp with time zone,
+		max_id uuid
+		)
+	AS $$
+BEGIN
+    RETURN QUERY
+	WITH changed as (
+SELECT t.id, t.max_updated_at, t.max_id
+FROM etl.get_film_ids_by_genre_film_work_cursor(p_updated_at, p_id, p_batch_size) t
+)
+,last as (
+SELECT DISTINCT c.max_updated_at, c.max_id
+FROM changed c
+)
+SELECT d.*, last.max_updated_at, last.max_id
+FROM last
+LEFT JOIN etl.get_film_docs(ARRAY(SELECT c.id FROM changed c WHERE c.id IS NOT NULL)) d ON TRUE
+;
+END; $$ LANGUAGE plpgsql STRICT;
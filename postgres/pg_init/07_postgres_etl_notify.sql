@@ -0,0 +1,43 @@
+\c movies_database app;
+
+-- Уведомления ETL об изменениях в схеме content (LISTEN etl_changes).
+-- Одинаковые уведомления в пределах транзакции Postgres отправляет один раз.
+
+-- DROP FUNCTION etl.notify_change CASCADE;
+CREATE OR REPLACE FUNCTION etl.notify_change() RETURNS trigger
+	AS $$
+DECLARE
+	r RECORD;
+BEGIN
+	IF TG_OP = 'DELETE' THEN
+		r := OLD;
+	ELSE
+		r := NEW;
+	END IF;
+	PERFORM pg_notify('etl_changes', json_build_object(
+		'table', TG_TABLE_NAME,
+		'op', TG_OP,
+		'id', r.id
+		)::text);
+	RETURN NULL;
+END; $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER film_work_notify
+AFTER INSERT OR UPDATE OR DELETE ON content.film_work
+FOR EACH ROW EXECUTE FUNCTION etl.notify_change();
+
+CREATE OR REPLACE TRIGGER genre_notify
+AFTER INSERT OR UPDATE OR DELETE ON content.genre
+FOR EACH ROW EXECUTE FUNCTION etl.notify_change();
+
+CREATE OR REPLACE TRIGGER person_notify
+AFTER INSERT OR UPDATE OR DELETE ON content.person
+FOR EACH ROW EXECUTE FUNCTION etl.notify_change();
+
+CREATE OR REPLACE TRIGGER genre_film_work_notify
+AFTER INSERT OR UPDATE OR DELETE ON content.genre_film_work
+FOR EACH ROW EXECUTE FUNCTION etl.notify_change();
+
+CREATE OR REPLACE TRIGGER person_film_work_notify
+AFTER INSERT OR UPDATE OR DELETE ON content.person_film_work
+FOR EACH ROW EXECUTE FUNCTION etl.notify_change();
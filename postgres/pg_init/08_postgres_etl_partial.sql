@@ -0,0 +1,35 @@
+\c movies_database app;
+
+-- Частичное обновление фильмов при изменении жанров: только поле genres,
+-- без пересборки и повторной отправки документов целиком.
+
+-- DROP FUNCTION etl.get_film_genres_by_genre_cursor;
+CREATE OR REPLACE FUNCTION etl.get_film_genres_by_genre_cursor(p_updated_at timestamp with time zone, p_id uuid, p_batch_size INTEGER) RETURNS TABLE (
+		id uuid,
+		genres JSON,
+		max_updated_at timestamp with time zone,
+		max_id uuid
+		)
+	AS $$
+BEGIN
+    RETURN QUERY
+	WITH changed as (
+SELECT t.id, t.max_updated_at, t.max_id
+FROM etl.get_film_ids_by_genre_cursor(p_updated_at, p_id, p_batch_size) t
+)
+,last as (
+SELECT DISTINCT c.max_updated_at, c.max_id
+FROM changed c
+)
+,film_genres as (
+SELECT gfw.film_work_id, json_agg(gn.name ORDER BY gn.name) genres
+FROM content.genre_film_work gfw
+JOIN content.genre gn ON gn.id = gfw.genre_id
+WHERE gfw.film_work_id IN (SELECT c.id FROM changed c)
+GROUP BY gfw.film_work_id
+)
+SELECT fg.film_work_id, fg.genres, last.max_updated_at, last.max_id
+FROM last
+LEFT JOIN film_genres fg ON TRUE
+;
+END; $$ LANGUAGE plpgsql STRICT;
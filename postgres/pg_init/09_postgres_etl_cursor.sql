@@ -0,0 +1,233 @@
+\c movies_database app;
+
+-- Типизированный курсор (updated_at, id) вместо текстового combined_key.
+-- Выборка очередной пачки - диапазонное сканирование составного индекса,
+-- её стоимость не зависит от размера таблицы.
+-- Пачка ограничивается строками таблицы-источника, поэтому изменения
+-- одной персоны или жанра не разрываются между пачками.
+-- Строка с id = NULL означает, что строки-источники есть, но фильмов у них нет:
+-- курсор всё равно сдвигается.
+
+CREATE INDEX IF NOT EXISTS film_work_updated_at_id_idx ON content.film_work (updated_at, id);
+CREATE INDEX IF NOT EXISTS genre_updated_at_id_idx ON content.genre (updated_at, id);
+CREATE INDEX IF NOT EXISTS person_updated_at_id_idx ON content.person (updated_at, id);
+CREATE INDEX IF NOT EXISTS genre_film_work_updated_at_id_idx ON content.genre_film_work (updated_at, id);
+CREATE INDEX IF NOT EXISTS person_film_work_updated_at_id_idx ON content.person_film_work (updated_at, id);
+
+-- для перехода от изменённых персон и жанров к их фильмам
+CREATE INDEX IF NOT EXISTS person_film_work_person_idx ON content.person_film_work (person_id);
+CREATE INDEX IF NOT EXISTS genre_film_work_genre_idx ON content.genre_film_work (genre_id);
+
+
+-- DROP FUNCTION etl.get_film_ids_by_film_work_cursor;
+CREATE OR REPLACE FUNCTION etl.get_film_ids_by_film_work_cursor(p_updated_at timestamp with time zone, p_id uuid, p_batch_size INTEGER) RETURNS TABLE (
+		id uuid,
+		max_updated_at timestamp with time zone,
+		max_id uuid
+		)
+	AS $$
+BEGIN
+    RETURN QUERY
+	WITH src as (
+SELECT t.id, t.updated_at
+FROM content.film_work t
+WHERE (t.updated_at, t.id) > (p_updated_at, p_id)
+ORDER BY t.updated_at, t.id
+LIMIT (p_batch_size)
+)
+,last as (
+SELECT s.updated_at, s.id
+FROM src s
+ORDER BY s.updated_at DESC, s.id DESC
+LIMIT 1
+)
+SELECT s.id, last.updated_at, last.id
+FROM src s, last
+;
+END; $$ LANGUAGE plpgsql STRICT;
+
+
+-- DROP FUNCTION etl.get_film_ids_by_genre_film_work_cursor;
+CREATE OR REPLACE FUNCTION etl.get_film_ids_by_genre_film_work_cursor(p_updated_at timestamp with time zone, p_id uuid, p_batch_size INTEGER) RETURNS TABLE (
+		id uuid,
+		max_updated_at timestamp with time zone,
+		max_id uuid
+		)
+	AS $$
+BEGIN
+    RETURN QUERY
+	WITH src as (
+SELECT t.id, t.film_work_id, t.updated_at
+FROM content.genre_film_work t
+WHERE (t.updated_at, t.id) > (p_updated_at, p_id)
+ORDER BY t.updated_at, t.id
+LIMIT (p_batch_size)
+)
+,last as (
+SELECT s.updated_at, s.id
+FROM src s
+ORDER BY s.updated_at DESC, s.id DESC
+LIMIT 1
+)
+SELECT DISTINCT s.film_work_id, last.updated_at, last.id
+FROM src s, last
+;
+END; $$ LANGUAGE plpgsql STRICT;
+
+
+-- DROP FUNCTION etl.get_film_ids_by_person_film_work_cursor;
+CREATE OR REPLACE FUNCTION etl.get_film_ids_by_person_film_work_cursor(p_updated_at timestamp with time zone, p_id uuid, p_batch_size INTEGER) RETURNS TABLE (
+		id uuid,
+		max_updated_at timestamp with time zone,
+		max_id uuid
+		)
+	AS $$
+BEGIN
+    RETURN QUERY
+	WITH src as (
+SELECT t.id, t.film_work_id, t.updated_at
+FROM content.person_film_work t
+WHERE (t.updated_at, t.id) > (p_updated_at, p_id)
+ORDER BY t.updated_at, t.id
+LIMIT (p_batch_size)
+)
+,last as (
+SELECT s.updated_at, s.id
+FROM src s
+ORDER BY s.updated_at DESC, s.id DESC
+LIMIT 1
+)
+SELECT DISTINCT s.film_work_id, last.updated_at, last.id
+FROM src s, last
+;
+END; $$ LANGUAGE plpgsql STRICT;
+
+
+-- DROP FUNCTION etl.get_film_ids_by_person_cursor;
+CREATE OR REPLACE FUNCTION etl.get_film_ids_by_person_cursor(p_updated_at timestamp with time zone, p_id uuid, p_batch_size INTEGER) RETURNS TABLE (
+		id uuid,
+		max_updated_at timestamp with time zone,
+		max_id uuid
+		)
+	AS $$
+BEGIN
+    RETURN QUERY
+	WITH src as (
+SELECT t.id, t.updated_at
+FROM content.person t
+WHERE (t.updated_at, t.id) > (p_updated_at, p_id)
+ORDER BY t.updated_at, t.id
+LIMIT (p_batch_size)
+)
+,last as (
+SELECT s.updated_at, s.id
+FROM src s
+ORDER BY s.updated_at DESC, s.id DESC
+LIMIT 1
+)
+,films as (
+SELECT DISTINCT pfw.film_work_id
+FROM src s
+JOIN content.person_film_work pfw ON pfw.person_id = s.id
+)
+SELECT f.film_work_id, last.updated_at, last.id
+FROM last
+LEFT JOIN films f ON TRUE
+;
+END; $$ LANGUAGE plpgsql STRICT;
+
+
+-- DROP FUNCTION etl.get_film_ids_by_genre_cursor;
+CREATE OR REPLACE FUNCTION etl.get_film_ids_by_genre_cursor(p_updated_at timestamp with time zone, p_id uuid, p_batch_size INTEGER) RETURNS TABLE (
+		id uuid,
+		max_updated_at timestamp with time zone,
+		max_id uuid
+		)
+	AS $$
+BEGIN
+    RETURN QUERY
+	WITH src as (
+SELECT t.id, t.updated_at
+FROM content.genre t
+WHERE (t.updated_at, t.id) > (p_updated_at, p_id)
+ORDER BY t.updated_at, t.id
+LIMIT (p_batch_size)
+)
+,last as (
+SELECT s.updated_at, s.id
+FROM src s
+ORDER BY s.updated_at DESC, s.id DESC
+LIMIT 1
+)
+,films as (
+SELECT DISTINCT gfw.film_work_id
+FROM src s
+JOIN content.genre_film_work gfw ON gfw.genre_id = s.id
+)
+SELECT f.film_work_id, last.updated_at, last.id
+FROM last
+LEFT JOIN films f ON TRUE
+;
+END; $$ LANGUAGE plpgsql STRICT;
+
+
+-- DROP FUNCTION etl.get_person_by_person_cursor;
+CREATE OR REPLACE FUNCTION etl.get_person_by_person_cursor(p_updated_at timestamp with time zone, p_id uuid, p_batch_size INTEGER) RETURNS TABLE (
+		id uuid,
+		full_name TEXT,
+		gender TEXT,
+		updated_at timestamp with time zone,
+		max_updated_at timestamp with time zone,
+		max_id uuid
+		)
+	AS $$
+BEGIN
+    RETURN QUERY
+	WITH src as (
+SELECT t.id, t.full_name, t.gender, t.updated_at
+FROM content.person t
+WHERE (t.updated_at, t.id) > (p_updated_at, p_id)
+ORDER BY t.updated_at, t.id
+LIMIT (p_batch_size)
+)
+,last as (
+SELECT s.updated_at, s.id
+FROM src s
+ORDER BY s.updated_at DESC, s.id DESC
+LIMIT 1
+)
+SELECT s.id, s.full_name, s.gender, s.updated_at, last.updated_at, last.id
+FROM src s, last
+;
+END; $$ LANGUAGE plpgsql STRICT;
+
+
+-- DROP FUNCTION etl.get_genre_by_genre_cursor;
+CREATE OR REPLACE FUNCTION etl.get_genre_by_genre_cursor(p_updated_at timestamp with time zone, p_id uuid, p_batch_size INTEGER) RETURNS TABLE (
+		id uuid,
+		name TEXT,
+		description TEXT,
+		updated_at timestamp with time zone,
+		max_updated_at timestamp with time zone,
+		max_id uuid
+		)
+	AS $$
+BEGIN
+    RETURN QUERY
+	WITH src as (
+SELECT t.id, t.name, t.description, t.updated_at
+FROM content.genre t
+WHERE (t.updated_at, t.id) > (p_updated_at, p_id)
+ORDER BY t.updated_at, t.id
+LIMIT (p_batch_size)
+)
+,last as (
+SELECT s.updated_at, s.id
+FROM src s
+ORDER BY s.updated_at DESC, s.id DESC
+LIMIT 1
+)
+SELECT s.id, s.name, s.description, s.updated_at, last.updated_at, last.id
+FROM src s, last
+;
+END; $$ LANGUAGE plpgsql STRICT;
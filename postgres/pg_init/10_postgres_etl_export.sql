@@ -0,0 +1,39 @@
+\c movies_database app;
+
+-- Выгрузка всех документов для полной пересборки индексов через COPY ... TO STDOUT (etl/export.py).
+-- doc - готовый _source документа ES в том же виде, что собирает etl.py,
+-- version - внешняя версия документа (микросекунды updated_at, как timestamp_version() в etl.py).
+
+CREATE OR REPLACE VIEW etl.movies_export AS
+SELECT d.id,
+		json_build_object(
+			'id', d.id,
+			'imdb_rating', d.rating,
+			'genres', d.genres,
+			'title', d.title,
+			'description', d.description,
+			'directors_names', (SELECT COALESCE(json_agg(x->>'name'), '[]'::json) FROM json_array_elements(d.directors) x),
+			'actors_names', (SELECT COALESCE(json_agg(x->>'name'), '[]'::json) FROM json_array_elements(d.actors) x),
+			'writers_names', (SELECT COALESCE(json_agg(x->>'name'), '[]'::json) FROM json_array_elements(d.writers) x),
+			'directors', d.directors,
+			'actors', d.actors,
+			'writers', d.writers,
+			'updated_at', d.updated_at
+		) doc,
+		(extract(epoch FROM d.updated_at) * 1000000)::bigint version
+FROM etl.film_docs d
+;
+
+CREATE OR REPLACE VIEW etl.persons_export AS
+SELECT p.id,
+		json_build_object('id', p.id, 'full_name', p.full_name, 'gender', p.gender) doc,
+		(extract(epoch FROM p.updated_at) * 1000000)::bigint version
+FROM content.person p
+;
+
+CREATE OR REPLACE VIEW etl.genres_export AS
+SELECT g.id,
+		json_build_object('id', g.id, 'name', g.name, 'description', g.description) doc,
+		(extract(epoch FROM g.updated_at) * 1000000)::bigint version
+FROM content.genre g
+;
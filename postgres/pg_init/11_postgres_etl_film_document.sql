@@ -0,0 +1,136 @@
+\c movies_database app;
+
+-- Денормализованные документы фильмов, поддерживаемые инкрементально (FILM_EXTRACT_MODE='table').
+-- Триггеры только отмечают затронутые фильмы в etl.film_document_dirty (дёшево для админки),
+-- etl.refresh_film_documents() пересобирает отмеченные документы из etl.movies_export
+-- и меняет строку, только если документ изменился: новые version и updated_at.
+-- version - внешняя версия документа в ES: микросекунды updated_at документа (см. etl.film_docs).
+-- ETL читает готовые документы одним диапазонным сканированием по (updated_at, id).
+
+CREATE TABLE IF NOT EXISTS etl.film_document (
+    id uuid PRIMARY KEY,
+    doc jsonb NOT NULL,
+    version bigint NOT NULL,
+    updated_at timestamp with time zone NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS film_document_updated_at_id_idx ON etl.film_document (updated_at, id);
+
+CREATE TABLE IF NOT EXISTS etl.film_document_dirty (
+    film_id uuid PRIMARY KEY
+);
+
+
+-- DROP FUNCTION etl.mark_film_document_dirty;
+CREATE OR REPLACE FUNCTION etl.mark_film_document_dirty() RETURNS trigger
+	AS $$
+BEGIN
+	IF TG_TABLE_NAME = 'film_work' THEN
+		INSERT INTO etl.film_document_dirty (film_id)
+		VALUES (CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END)
+		ON CONFLICT DO NOTHING;
+	ELSIF TG_TABLE_NAME IN ('genre_film_work', 'person_film_work') THEN
+		IF TG_OP <> 'INSERT' THEN
+			INSERT INTO etl.film_document_dirty (film_id) VALUES (OLD.film_work_id) ON CONFLICT DO NOTHING;
+		END IF;
+		IF TG_OP <> 'DELETE' THEN
+			INSERT INTO etl.film_document_dirty (film_id) VALUES (NEW.film_work_id) ON CONFLICT DO NOTHING;
+		END IF;
+	ELSIF TG_TABLE_NAME = 'person' THEN
+		-- удаление персоны доходит до фильмов через каскадное удаление связей
+		INSERT INTO etl.film_document_dirty (film_id)
+		SELECT pfw.film_work_id FROM content.person_film_work pfw WHERE pfw.person_id = NEW.id
+		ON CONFLICT DO NOTHING;
+	ELSIF TG_TABLE_NAME = 'genre' THEN
+		INSERT INTO etl.film_document_dirty (film_id)
+		SELECT gfw.film_work_id FROM content.genre_film_work gfw WHERE gfw.genre_id = NEW.id
+		ON CONFLICT DO NOTHING;
+	END IF;
+	RETURN NULL;
+END; $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER film_work_film_document AFTER INSERT OR UPDATE OR DELETE ON content.film_work
+	FOR EACH ROW EXECUTE FUNCTION etl.mark_film_document_dirty();
+CREATE OR REPLACE TRIGGER genre_film_work_film_document AFTER INSERT OR UPDATE OR DELETE ON content.genre_film_work
+	FOR EACH ROW EXECUTE FUNCTION etl.mark_film_document_dirty();
+CREATE OR REPLACE TRIGGER person_film_work_film_document AFTER INSERT OR UPDATE OR DELETE ON content.person_film_work
+	FOR EACH ROW EXECUTE FUNCTION etl.mark_film_document_dirty();
+CREATE OR REPLACE TRIGGER person_film_document AFTER UPDATE ON content.person
+	FOR EACH ROW EXECUTE FUNCTION etl.mark_film_document_dirty();
+CREATE OR REPLACE TRIGGER genre_film_document AFTER UPDATE ON content.genre
+	FOR EACH ROW EXECUTE FUNCTION etl.mark_film_document_dirty();
+
+
+-- Пересобрать до p_batch_size отмеченных документов; возвращает число обработанных отметок (0 - больше нет).
+-- Вызовы сериализуются advisory-блокировкой, поэтому updated_at (clock_timestamp) растёт
+-- в порядке фиксации и курсор ETL не пропускает строки.
+-- DROP FUNCTION etl.refresh_film_documents;
+CREATE OR REPLACE FUNCTION etl.refresh_film_documents(p_batch_size INTEGER) RETURNS INTEGER
+	AS $$
+DECLARE
+	v_ids uuid[];
+BEGIN
+	PERFORM pg_advisory_xact_lock(hashtext('etl.refresh_film_documents'));
+
+	WITH picked as (
+	DELETE FROM etl.film_document_dirty d
+	WHERE d.film_id IN (
+		SELECT dd.film_id FROM etl.film_document_dirty dd
+		LIMIT p_batch_size
+		FOR UPDATE SKIP LOCKED
+		)
+	RETURNING d.film_id
+	)
+	SELECT COALESCE(array_agg(p.film_id), '{}') INTO v_ids FROM picked p;
+
+	INSERT INTO etl.film_document AS fd (id, doc, version, updated_at)
+	SELECT m.id, m.doc::jsonb, m.version, clock_timestamp()
+	FROM etl.movies_export m
+	WHERE m.id = ANY(v_ids)
+	ON CONFLICT (id) DO UPDATE
+		-- версия не убывает: после удаления связи самое позднее изменение документа может стать раньше
+		SET doc = EXCLUDED.doc, version = GREATEST(EXCLUDED.version, fd.version), updated_at = EXCLUDED.updated_at
+		WHERE fd.doc IS DISTINCT FROM EXCLUDED.doc;
+
+	DELETE FROM etl.film_document fd
+	WHERE fd.id = ANY(v_ids)
+		AND NOT EXISTS (SELECT 1 FROM content.film_work fw WHERE fw.id = fd.id);
+
+	RETURN cardinality(v_ids);
+END; $$ LANGUAGE plpgsql STRICT;
+
+
+-- DROP FUNCTION etl.get_film_document_cursor;
+CREATE OR REPLACE FUNCTION etl.get_film_document_cursor(p_updated_at timestamp with time zone, p_id uuid, p_batch_size INTEGER) RETURNS TABLE (
+		id uuid,
+		doc jsonb,
+		version bigint,
+		max_updated_at timestamp with time zone,
+		max_id uuid
+		)
+	AS $$
+BEGIN
+    RETURN QUERY
+	WITH src as (
+SELECT t.id, t.doc, t.version, t.updated_at
+FROM etl.film_document t
+WHERE (t.updated_at, t.id) > (p_updated_at, p_id)
+ORDER BY t.updated_at, t.id
+LIMIT (p_batch_size)
+)
+,last as (
+SELECT s.updated_at, s.id
+FROM src s
+ORDER BY s.updated_at DESC, s.id DESC
+LIMIT 1
+)
+SELECT s.id, s.doc, s.version, last.updated_at, last.id
+FROM src s, last
+;
+END; $$ LANGUAGE plpgsql STRICT;
+
+
+-- Первое наполнение: все существующие фильмы отмечаются к сборке.
+INSERT INTO etl.film_document_dirty (film_id)
+SELECT fw.id FROM content.film_work fw
+ON CONFLICT DO NOTHING;
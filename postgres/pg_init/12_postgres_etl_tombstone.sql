@@ -0,0 +1,118 @@
+\c movies_database app;
+
+-- Журнал удалений (tombstones) для инкрементального ETL; таблица etl.tombstone - в 06_postgres_etl_film_doc.sql.
+-- Триггеры уровня оператора пишут по строке на каждую удалённую запись content.*:
+-- ETL удаляет документы фильмов, персон и жанров из индексов и пересобирает фильмы,
+-- у которых удалили связи с жанрами и участниками. Полная пересборка индексов для этого не нужна.
+-- Данные content.* триггеры не меняют: версия удаления хранится в самом журнале.
+
+
+-- DROP FUNCTION etl.record_tombstones;
+CREATE OR REPLACE FUNCTION etl.record_tombstones() RETURNS trigger
+	AS $$
+BEGIN
+	-- Внешняя версия документа фильма выводится из updated_at фильма и его связей (etl.film_docs):
+	-- удалённая связь могла быть самым поздним изменением. Версия удаления не меньше времени
+	-- удаления и updated_at удалённой связи и её жанра/персоны, а etl.film_docs учитывает её,
+	-- поэтому версия пересобранного документа не становится меньше уже загруженной.
+	IF TG_TABLE_NAME = 'genre_film_work' THEN
+		INSERT INTO etl.tombstone (table_name, entity_id, film_work_id, version_at)
+		SELECT TG_TABLE_NAME, o.id, o.film_work_id, GREATEST(clock_timestamp(), o.updated_at, gn.updated_at)
+		FROM old_rows o LEFT JOIN content.genre gn ON gn.id = o.genre_id;
+	ELSIF TG_TABLE_NAME = 'person_film_work' THEN
+		INSERT INTO etl.tombstone (table_name, entity_id, film_work_id, version_at)
+		SELECT TG_TABLE_NAME, o.id, o.film_work_id, GREATEST(clock_timestamp(), o.updated_at, pn.updated_at)
+		FROM old_rows o LEFT JOIN content.person pn ON pn.id = o.person_id;
+	ELSIF TG_TABLE_NAME = 'film_work' THEN
+		INSERT INTO etl.tombstone (table_name, entity_id, film_work_id, version_at)
+		SELECT TG_TABLE_NAME, o.id, o.id, GREATEST(clock_timestamp(), o.updated_at) FROM old_rows o;
+	ELSE
+		INSERT INTO etl.tombstone (table_name, entity_id, version_at)
+		SELECT TG_TABLE_NAME, o.id, GREATEST(clock_timestamp(), o.updated_at) FROM old_rows o;
+	END IF;
+	RETURN NULL;
+END; $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER film_work_tombstone AFTER DELETE ON content.film_work
+	REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION etl.record_tombstones();
+CREATE OR REPLACE TRIGGER person_tombstone AFTER DELETE ON content.person
+	REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION etl.record_tombstones();
+CREATE OR REPLACE TRIGGER genre_tombstone AFTER DELETE ON content.genre
+	REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION etl.record_tombstones();
+CREATE OR REPLACE TRIGGER genre_film_work_tombstone AFTER DELETE ON content.genre_film_work
+	REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION etl.record_tombstones();
+CREATE OR REPLACE TRIGGER person_film_work_tombstone AFTER DELETE ON content.person_film_work
+	REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION etl.record_tombstones();
+
+
+-- Упорядочить новые записи журнала: проставить им позицию updated_at; возвращает их число.
+-- Время записи в триггере не годится для курсора: транзакция, начатая раньше, может зафиксироваться
+-- позже, и её строки окажутся позади уже прочитанной позиции. Вызовы сериализуются advisory-блокировкой,
+-- поэтому updated_at (clock_timestamp) растёт в порядке фиксации вызовов, а записи незафиксированных
+-- транзакций получат позицию позже, чем все видимые сейчас.
+-- DROP FUNCTION etl.sequence_tombstones;
+CREATE OR REPLACE FUNCTION etl.sequence_tombstones() RETURNS INTEGER
+	AS $$
+DECLARE
+	v_count INTEGER;
+BEGIN
+	PERFORM pg_advisory_xact_lock(hashtext('etl.sequence_tombstones'));
+
+	UPDATE etl.tombstone t SET updated_at = clock_timestamp() WHERE t.updated_at IS NULL;
+	GET DIAGNOSTICS v_count = ROW_COUNT;
+	RETURN v_count;
+END; $$ LANGUAGE plpgsql;
+
+
+-- Документы, затронутые удалениями после позиции: индекс ES и id документа (фильм - и для удалённых связей),
+-- наибольшая версия удаления. Позиция (max_updated_at, max_id) - по упорядоченным строкам etl.tombstone.
+-- DROP FUNCTION etl.get_tombstone_cursor;
+CREATE OR REPLACE FUNCTION etl.get_tombstone_cursor(p_updated_at timestamp with time zone, p_id uuid, p_batch_size INTEGER) RETURNS TABLE (
+		id uuid,
+		es_index TEXT,
+		version_at timestamp with time zone,
+		max_updated_at timestamp with time zone,
+		max_id uuid
+		)
+	AS $$
+BEGIN
+    RETURN QUERY
+	WITH src as (
+SELECT t.id, t.table_name, t.entity_id, t.film_work_id, t.version_at, t.updated_at
+FROM etl.tombstone t
+WHERE t.updated_at IS NOT NULL AND (t.updated_at, t.id) > (p_updated_at, p_id)
+ORDER BY t.updated_at, t.id
+LIMIT (p_batch_size)
+)
+,last as (
+SELECT s.updated_at, s.id
+FROM src s
+ORDER BY s.updated_at DESC, s.id DESC
+LIMIT 1
+)
+,docs as (
+SELECT COALESCE(s.film_work_id, s.entity_id) id,
+		CASE s.table_name WHEN 'person' THEN 'persons' WHEN 'genre' THEN 'genres' ELSE 'movies' END es_index,
+		max(s.version_at) version_at
+FROM src s
+GROUP BY 1, 2
+)
+SELECT d.id, d.es_index, d.version_at, last.updated_at, last.id
+FROM docs d, last
+;
+END; $$ LANGUAGE plpgsql STRICT;
+
+
+-- Удалить записи старше p_keep: к этому времени их прочитали все шарды ETL.
+-- Версия удаления перестаёт входить в etl.film_docs; документ с ней уже загружен, а конфликт
+-- версий при повторной загрузке старой версии ETL считает успешным (в ES документ новее).
+-- DROP FUNCTION etl.purge_tombstones;
+CREATE OR REPLACE FUNCTION etl.purge_tombstones(p_keep INTERVAL) RETURNS INTEGER
+	AS $$
+DECLARE
+	v_count INTEGER;
+BEGIN
+	DELETE FROM etl.tombstone t WHERE t.updated_at < now() - p_keep;
+	GET DIAGNOSTICS v_count = ROW_COUNT;
+	RETURN v_count;
+END; $$ LANGUAGE plpgsql STRICT;